@@ -0,0 +1,260 @@
+"""
+Incremental backups using a content-addressed chunk store, and backup retention
+"""
+
+import hashlib
+import json
+import os
+import re
+from datetime import datetime
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+
+# Chunks are stored in this directory, next to the manifests
+CHUNK_DIR = 'chunks'
+
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+
+DATASTORE_FILE = 'global.redis.json'
+SPARK_SUFFIX = '.spark.json'
+
+# Matches backups created by `brewblox-ctl backup save`
+BACKUP_PATTERN = re.compile(r'^brewblox_backup_(\d{8}_\d{4})(\.zip|\.manifest\.json)$')
+
+# Backups are kept per hour, day, or ISO week
+KEEP_PERIODS = {
+    'h': lambda t: (t.date(), t.hour),
+    'd': lambda t: t.date(),
+    'w': lambda t: t.isocalendar()[:2],
+}
+
+# Unused chunks are only removed if they were not written or reused for this long
+# A backup that is being saved does not yet have a manifest
+CHUNK_GRACE_S = 3600
+
+
+def _write_atomic(path: Path, data: bytes):
+    """
+    The new content is written to a temporary file, and then moved.
+    If the process is interrupted, no partial file remains.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _encode(obj) -> bytes:
+    """
+    Equal objects are always encoded to the same bytes, and have the same hash.
+    """
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()
+
+
+class ChunkStore:
+    """
+    Stores data chunks by their SHA-256 hash.
+    Chunks with the same content are only stored once.
+    """
+
+    def __init__(self, directory: str):
+        self.dir = Path(directory)
+        self.added = 0
+        self.stored = 0
+
+    def path(self, key: str) -> Path:
+        return self.dir / key[:2] / key
+
+    def put(self, data: bytes) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        path = self.path(key)
+        self.added += 1
+        if path.exists():
+            # Reused chunks are not removed by a concurrent prune
+            path.touch()
+        else:
+            _write_atomic(path, data)
+            self.stored += 1
+        return key
+
+    def get(self, key: str) -> bytes:
+        return self.path(key).read_bytes()
+
+
+class IncrementalBackup:
+    """
+    Writes a backup manifest, and stores all backed up data in a ChunkStore.
+
+    Datastore entries and Spark blocks are stored as separate chunks.
+    Other files are stored as a single chunk.
+    Unchanged entries, blocks, and files are not stored again.
+
+    The manifest lists the chunks for every file,
+    and is used by ManifestArchive to restore the full backup.
+    """
+
+    def __init__(self, manifest: str):
+        self.manifest = Path(manifest)
+        self.store = ChunkStore(self.manifest.parent / CHUNK_DIR)
+        self.files = {}
+
+    def write(self, fname: str):
+        self.files[fname] = {'chunk': self.store.put(Path(fname).read_bytes())}
+
+    def write_response(self, fname: str, resp: requests.Response):
+        try:
+            content = resp.json()
+        finally:
+            resp.close()
+
+        if fname == DATASTORE_FILE:
+            self.files[fname] = {
+                'values': [self.store.put(_encode(v)) for v in content['values']],
+            }
+        elif fname.endswith(SPARK_SUFFIX):
+            blocks = content.pop('blocks', [])
+            self.files[fname] = {
+                'chunk': self.store.put(_encode(content)),
+                'blocks': [self.store.put(_encode(v)) for v in blocks],
+            }
+        else:
+            self.files[fname] = {'chunk': self.store.put(_encode(content))}
+
+    def close(self):
+        _write_atomic(self.manifest, _encode({
+            'version': MANIFEST_VERSION,
+            'files': self.files,
+        }))
+
+
+class ManifestArchive:
+    """
+    Reads a backup manifest written by IncrementalBackup.
+    Implements the subset of the zipfile.ZipFile interface used to load backups.
+    """
+
+    def __init__(self, manifest: str):
+        self.manifest = Path(manifest)
+        self.store = ChunkStore(self.manifest.parent / CHUNK_DIR)
+        content = json.loads(self.manifest.read_text())
+        if content.get('version') != MANIFEST_VERSION:
+            raise ValueError(f'Unsupported backup manifest version: {content.get("version")}')
+        self.files = content['files']
+
+    def namelist(self) -> List[str]:
+        return list(self.files)
+
+    def _load(self, key: str):
+        return json.loads(self.store.get(key))
+
+    def read(self, fname: str) -> bytes:
+        entry = self.files[fname]
+        if 'values' in entry:
+            return _encode({'values': [self._load(k) for k in entry['values']]})
+        if 'blocks' in entry:
+            return _encode({
+                **self._load(entry['chunk']),
+                'blocks': [self._load(k) for k in entry['blocks']],
+            })
+        return self.store.get(entry['chunk'])
+
+    def extractall(self, path: Optional[str] = None, members: Optional[List[str]] = None):
+        for fname in (members or self.files):
+            _write_atomic(Path(path or '.') / fname, self.read(fname))
+
+    def close(self):
+        pass
+
+
+def is_manifest(fname: str) -> bool:
+    return fname.endswith(MANIFEST_SUFFIX)
+
+
+def list_backups(directory: str) -> List[Tuple[datetime, Path]]:
+    """
+    Returns all backups in `directory`, and the time they were created, sorted newest first.
+    The time is read from the file name.
+    """
+    backups = []
+    if not Path(directory).is_dir():
+        return backups
+
+    for path in Path(directory).iterdir():
+        match = BACKUP_PATTERN.match(path.name)
+        if match:
+            backups.append((datetime.strptime(match.group(1), '%Y%m%d_%H%M'), path))
+    return sorted(backups, reverse=True)
+
+
+def select_kept(backups: List[Tuple[datetime, Path]], keep: Dict[str, int]) -> Set[Path]:
+    """
+    For every period type in `keep` ('h', 'd', 'w'),
+    the newest backup in each of the last N periods with a backup is kept.
+    The newest backup is always kept.
+    """
+    kept = {path for _, path in backups[:1]}
+    for unit, count in keep.items():
+        periods = set()
+        for created, path in backups:
+            period = KEEP_PERIODS[unit](created)
+            if len(periods) >= count:
+                break
+            if period not in periods:
+                periods.add(period)
+                kept.add(path)
+    return kept
+
+
+def _manifest_chunks(manifest: Path) -> Set[str]:
+    chunks = set()
+    for entry in json.loads(manifest.read_text())['files'].values():
+        chunks.update(entry.get('values', []))
+        chunks.update(entry.get('blocks', []))
+        if 'chunk' in entry:
+            chunks.add(entry['chunk'])
+    return chunks
+
+
+def unused_chunks(directory: str, ignored: Set[Path] = set()) -> List[Path]:
+    """
+    Returns chunks that are not used by any manifest in `directory`,
+    and are older than CHUNK_GRACE_S.
+    Manifests in `ignored` are not checked.
+    Only manifests are read. Chunks and zip archives are never opened.
+    """
+    used = set()
+    for manifest in Path(directory).glob('*' + MANIFEST_SUFFIX):
+        if manifest not in ignored:
+            used |= _manifest_chunks(manifest)
+
+    cutoff = time() - CHUNK_GRACE_S
+    return sorted(
+        path for path in (Path(directory) / CHUNK_DIR).glob('*/*')
+        if path.name not in used and path.stat().st_mtime < cutoff
+    )
+
+
+def prune(directory: str, keep: Dict[str, int], dry_run: bool = False) -> Tuple[List[Path], int]:
+    """
+    Removes backups that are not kept according to `keep`,
+    and then removes chunks that are no longer used.
+    Returns the removed backups and the number of removed chunks.
+    If `dry_run` is set, nothing is removed.
+    """
+    backups = list_backups(directory)
+    kept = select_kept(backups, keep)
+    removed = [path for _, path in backups if path not in kept]
+    chunks = unused_chunks(directory, set(removed))
+
+    if not dry_run:
+        for path in removed + chunks:
+            path.unlink()
+        for subdir in {path.parent for path in chunks}:
+            if not any(subdir.iterdir()):
+                subdir.rmdir()
+
+    return removed, len(chunks)
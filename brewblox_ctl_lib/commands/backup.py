@@ -4,9 +4,12 @@ Saving / loading backups
 
 
 import json
+import re
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import suppress
 from datetime import datetime
+from functools import partial
 from glob import glob
 from os import getgid, getuid, mkdir, path
 from tempfile import NamedTemporaryFile, TemporaryDirectory
@@ -17,9 +20,18 @@ import urllib3
 import yaml
 from brewblox_ctl import click_helpers, sh
 from brewblox_ctl.commands import http
-from brewblox_ctl_lib import const, utils
+from brewblox_ctl_lib import backup_store, const, utils
 from dotenv import load_dotenv
 
+# Max number of concurrent requests to the datastore and Spark services
+BACKUP_WORKERS = 4
+
+# Responses are written to the archive in chunks of this size
+BACKUP_CHUNK_SIZE = 64 * 1024
+
+# Retention periods: number of hourly (h), daily (d), or weekly (w) backups
+KEEP_PATTERN = re.compile(r'^(\d+)([hdw])$')
+
 
 @click.group(cls=click_helpers.OrderedGroup)
 def cli():
@@ -31,6 +43,40 @@ def backup():
     """Save or load backups."""
 
 
+def write_response(zipf: zipfile.ZipFile, fname: str, resp: requests.Response):
+    """
+    Streams the response body to a new file in the archive.
+    The full body is never kept in memory.
+    """
+    try:
+        with zipf.open(fname, 'w') as f:
+            for chunk in resp.iter_content(BACKUP_CHUNK_SIZE):
+                f.write(chunk)
+    finally:
+        resp.close()
+
+
+def parse_keep(ctx, param, value):
+    keep = {}
+    for v in value:
+        match = KEEP_PATTERN.match(v)
+        if not match:
+            raise click.BadParameter(f'Invalid retention period `{v}`. Example: 24h, 7d, 4w')
+        keep[match.group(2)] = int(match.group(1))
+    return keep
+
+
+def prune_backups(keep):
+    opts = utils.ctx_opts()
+    if opts.dry_run:
+        utils.info('Dry run. Backups are not removed.')
+
+    removed, num_chunks = backup_store.prune('backup', keep, opts.dry_run)
+    for fname in removed:
+        utils.info(f'Removing {fname}')
+    utils.info(f'Removed {len(removed)} backups and {num_chunks} unused chunks')
+
+
 @backup.command()
 @click.option('--save-compose/--no-save-compose',
               default=True,
@@ -38,7 +84,20 @@ def backup():
 @click.option('--ignore-spark-error',
               is_flag=True,
               help='Skip unreachable or disconnected Spark services')
-def save(save_compose, ignore_spark_error):
+@click.option('--timeout',
+              default=30,
+              type=click.IntRange(min=1),
+              show_default=True,
+              help='Timeout in seconds for every request to the datastore and Spark services.')
+@click.option('--incremental',
+              is_flag=True,
+              help='Only store data that changed since previous incremental backups.')
+@click.option('--keep',
+              multiple=True,
+              callback=parse_keep,
+              help='Remove old backups after saving. See `brewblox-ctl backup prune`. '
+              'Example: [--keep 24h --keep 7d --keep 4w]')
+def save(save_compose, ignore_spark_error, timeout, incremental, keep):
     """Create a backup of Brewblox settings.
 
     A zip archive containing JSON/YAML files is created in the ./backup/ directory.
@@ -51,6 +110,18 @@ def save(save_compose, ignore_spark_error):
 
     The command will fail if any of the Spark services could not be contacted.
 
+    The datastore and all Spark services are exported at the same time.
+    A slow Spark service fails the backup if it does not respond within --timeout seconds.
+    Exported data is streamed to the archive, and not kept in memory.
+
+    Use --incremental to create a manifest file instead of a zip archive.
+    Datastore entries, Spark blocks, and files are stored separately in ./backup/chunks/,
+    and are only stored if they changed since any previous incremental backup.
+    The manifest lists the stored data for this backup.
+    Use `brewblox-ctl backup load` with the manifest file to load the backup.
+
+    Use --keep to remove old backups after the new backup is saved.
+
     As it does not make any destructive changes to configuration,
     this command is not affected by --dry-run.
 
@@ -71,7 +142,8 @@ def save(save_compose, ignore_spark_error):
     utils.check_config()
     urllib3.disable_warnings()
 
-    file = f'backup/brewblox_backup_{datetime.now().strftime("%Y%m%d_%H%M")}.zip'
+    file = f'backup/brewblox_backup_{datetime.now().strftime("%Y%m%d_%H%M")}'
+    file += backup_store.MANIFEST_SUFFIX if incremental else '.zip'
     with suppress(FileExistsError):
         mkdir(path.abspath('backup/'))
 
@@ -85,45 +157,111 @@ def save(save_compose, ignore_spark_error):
         k for k, v in config['services'].items()
         if v.get('image', '').startswith('brewblox/brewblox-devcon-spark')
     ]
-    zipf = zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED)
-
-    # Always save .env
-    utils.info('Exporting .env')
-    zipf.write('.env')
-
-    # Always save datastore
+    if incremental:
+        zipf = backup_store.IncrementalBackup(file)
+        save_response = zipf.write_response
+    else:
+        zipf = zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED)
+        save_response = partial(write_response, zipf)
+
+    executor = ThreadPoolExecutor(max_workers=BACKUP_WORKERS)
+
+    # Start remote exports first
+    # Results are written to the archive as they arrive
+    # The archive is only written by this thread
     utils.info('Exporting datastore')
-    resp = requests.post(store_url + '/mget',
-                         json={'namespace': '', 'filter': '*'},
-                         verify=False)
-    resp.raise_for_status()
-    zipf.writestr('global.redis.json', resp.text)
-
-    if save_compose:
-        utils.info('Exporting docker-compose.yml')
-        zipf.write('docker-compose.yml')
+    # Values are (archive file name, Spark service name)
+    exports = {
+        executor.submit(requests.post,
+                        store_url + '/mget',
+                        json={'namespace': '', 'filter': '*'},
+                        verify=False,
+                        stream=True,
+                        timeout=timeout): ('global.redis.json', None),
+    }
 
     for spark in sparks:
         utils.info(f'Exporting Spark blocks from `{spark}`')
-        resp = requests.post(f'{utils.host_url()}/{spark}/blocks/backup/save', verify=False)
-        try:
-            resp.raise_for_status()
-            zipf.writestr(spark + '.spark.json', resp.text)
-        except Exception as ex:
-            if ignore_spark_error:
-                utils.info(f'Skipping Spark `{spark}` due to error: {str(ex)}')
-            else:
-                raise ex
-
-    for fname in [
-        *glob('node-red/*.js*'),
-        *glob('node-red/lib/**/*.js*'),
-        *glob('mosquitto/*.conf'),
-    ]:
-        zipf.write(fname)
+        exports[executor.submit(requests.post,
+                                f'{utils.host_url()}/{spark}/blocks/backup/save',
+                                verify=False,
+                                stream=True,
+                                timeout=timeout)] = (spark + '.spark.json', spark)
+
+    try:
+        # Always save .env
+        utils.info('Exporting .env')
+        zipf.write('.env')
+
+        if save_compose:
+            utils.info('Exporting docker-compose.yml')
+            zipf.write('docker-compose.yml')
+
+        for fname in [
+            *glob('node-red/*.js*'),
+            *glob('node-red/lib/**/*.js*'),
+            *glob('mosquitto/*.conf'),
+        ]:
+            zipf.write(fname)
+
+        for fut in as_completed(exports):
+            fname, spark = exports[fut]
+            try:
+                resp = fut.result()
+                resp.raise_for_status()
+            except Exception as ex:
+                # Always save datastore
+                if spark and ignore_spark_error:
+                    utils.info(f'Skipping Spark `{spark}` due to error: {str(ex)}')
+                    continue
+                else:
+                    raise ex
+
+            # Errors while streaming are not skipped
+            # The file in the archive would be incomplete
+            save_response(fname, resp)
+    finally:
+        for fut in exports:
+            fut.cancel()
+        executor.shutdown(wait=True)
 
     zipf.close()
+    if incremental:
+        utils.info(f'Stored {zipf.store.stored} new chunks ({zipf.store.added} total)')
     click.echo(path.abspath(file))
+
+    if keep:
+        prune_backups(keep)
+
+    utils.info('Done!')
+
+
+@backup.command()
+@click.option('--keep',
+              multiple=True,
+              required=True,
+              callback=parse_keep,
+              help='Number of hourly (h), daily (d), or weekly (w) backups that are kept. '
+              'Example: [--keep 24h --keep 7d --keep 4w]')
+def prune(keep):
+    """Remove old backups.
+
+    Backups in the ./backup/ directory are kept according to --keep.
+    For each period (hour, day, or week), the newest backup in that period is kept.
+    With `--keep 24h --keep 7d`, the newest backup of the last 24 hours with a backup is kept,
+    along with the newest backup of the last 7 days with a backup.
+    The newest backup is always kept.
+
+    Data stored by incremental backups is removed if no remaining backup uses it.
+
+    Backups are selected by file name. Archives are not opened.
+    Only the manifests of incremental backups are read.
+
+    If dry-run is enabled, backups that would be removed are listed.
+    """
+    utils.check_config()
+    utils.confirm_mode()
+    prune_backups(keep)
     utils.info('Done!')
 
 
@@ -171,6 +309,8 @@ def load(archive,
     This function uses files generated by `brewblox-ctl backup save` as input.
     You can use the --load-XXXX options to partially load the backup.
 
+    ARCHIVE is either a zip archive, or a manifest (.manifest.json) created by an incremental backup.
+
     This does not attempt to merge data: it will overwrite current docker-compose.yml,
     datastore entries, and Spark blocks.
 
@@ -196,7 +336,10 @@ def load(archive,
     host_url = utils.host_url()
     store_url = utils.datastore_url()
 
-    zipf = zipfile.ZipFile(archive, 'r', zipfile.ZIP_DEFLATED)
+    if backup_store.is_manifest(archive):
+        zipf = backup_store.ManifestArchive(archive)
+    else:
+        zipf = zipfile.ZipFile(archive, 'r', zipfile.ZIP_DEFLATED)
     available = zipf.namelist()
     redis_file = 'global.redis.json'
     couchdb_files = [v for v in available if v.endswith('.datastore.json')]
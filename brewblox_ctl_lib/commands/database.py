@@ -26,6 +26,10 @@ def from_couchdb():
 
     This command copies the configuration data from CouchDB to Redis.
 
+    Documents are copied in pages.
+    Progress is stored in ./couchdb-checkpoint.json.
+    If the migration is interrupted, run the command again to resume.
+
     \b
     Steps:
         - Create CouchdDB container.
@@ -39,8 +43,11 @@ def from_couchdb():
 
 @database.command()
 @click.option('--target',
-              default='victoria',
-              help='Where to store exported data',
+              multiple=True,
+              default=['victoria'],
+              show_default=True,
+              help='Where to store exported data. Can be used multiple times. '
+              'Example: [--target victoria --target file]',
               type=click.Choice(['victoria', 'file']))
 @click.option('--duration',
               default='',
@@ -52,19 +59,143 @@ def from_couchdb():
               default=[],
               help='Start given service(s) with an offset. Useful for resuming exports. '
               'Example: [--offset spark-one 10000 --offset spark-two 5000]')
+@click.option('--jobs',
+              default=1,
+              type=click.IntRange(min=1),
+              help='Number of services that are exported concurrently.')
+@click.option('--windows',
+              default=1,
+              type=click.IntRange(min=1),
+              help='Split every service in time windows that are exported concurrently.')
+@click.option('--resume/--no-resume',
+              default=True,
+              help='Continue exporting services from their last checkpoint. '
+              'Services with an --offset ignore their checkpoint.')
+@click.option('--batch-size',
+              type=click.IntRange(min=1),
+              help='Number of points per query. '
+              'By default, batch size is adjusted to the speed of the export.')
+@click.option('--max-batch-memory',
+              type=click.IntRange(min=1),
+              help='Max memory (in MB) used by a single adjusted batch. [default: 16]')
+@click.option('--engine',
+              default='query',
+              type=click.Choice(['query', 'inspect']),
+              help='How data is read from InfluxDB. '
+              '"query" pages through the data using queries. '
+              '"inspect" reads the InfluxDB data files directly, which is much faster.')
+@click.option('--gzip-level',
+              default=1,
+              type=click.IntRange(0, 9),
+              help='Compression level for uploads to Victoria Metrics. 0 disables compression.')
+@click.option('--victoria-api',
+              default='write',
+              type=click.Choice(['write', 'import']),
+              help='Victoria Metrics endpoint for uploads. '
+              '"write" accepts InfluxDB line protocol. '
+              '"import" accepts the native Victoria Metrics JSON line format.')
+@click.option('--compression',
+              default='gzip',
+              type=click.Choice(['gzip', 'zstd', 'none']),
+              help='Compression for exported files. zstd requires the zstandard package.')
+@click.option('--max-file-size',
+              default=100,
+              type=click.IntRange(min=1),
+              help='Max size in MB of exported files.')
+@click.option('--max-file-lines',
+              type=click.IntRange(min=1),
+              help='Max number of lines in exported files.')
+@click.option('--container',
+              help='Read data from this running InfluxDB container, '
+              'instead of starting a temporary container. Example: brewblox_influx_1')
+@click.option('--follow',
+              is_flag=True,
+              help='Keep copying new data after all historic data is exported. Requires --container.')
+@click.option('--follow-interval',
+              default=10,
+              type=click.IntRange(min=1),
+              help='Seconds between checks for new data in --follow mode.')
+@click.option('--policy',
+              multiple=True,
+              default=['downsample_1m'],
+              show_default=True,
+              help='InfluxDB retention policy that is exported. Can be used multiple times. '
+              'Example: [--policy downsample_1m --policy autogen]')
+@click.option('--newest-first/--oldest-first',
+              default=False,
+              help='Export the newest data first. Recent history is available sooner.')
+@click.option('--max-rate',
+              type=click.IntRange(min=1),
+              help='Max number of exported points per second.')
+@click.option('--nice',
+              is_flag=True,
+              help='Limit CPU and disk usage of the migration, to keep other services responsive.')
 @click.argument('services', nargs=-1)
-def from_influxdb(target, duration, offset, services):
+def from_influxdb(target, duration, offset, jobs, windows, resume, batch_size, max_batch_memory, engine,
+                  gzip_level, victoria_api, compression, max_file_size, max_file_lines,
+                  container, follow, follow_interval, policy, newest_first, max_rate, nice, services):
     """Migrate history data from InfluxDB to Victoria Metrics or file.
 
     In config version 0.7.0 Victoria Metrics replaced InfluxDB as history database.
 
     This command exports the history data from InfluxDB,
-    and then either immediately imports it to Victoria Metrics, or saves it to file.
+    and then immediately imports it to Victoria Metrics, and/or saves it to file.
+
+    Use --target multiple times to import data and keep an archive in a single run.
+    Data is only read from InfluxDB once, and then written to every target.
+    Progress is stored separately for every target.
 
     By default, all services are migrated.
     You can override this by listing the services you want to migrate.
 
     When writing data to file, files are stored in the ./influxdb-export/ directory.
+    Files are compressed, and a new file is started when --max-file-size or --max-file-lines is reached.
+    Every file has a .json manifest with its line count and time range.
+
+    Use --jobs to export multiple services at the same time.
+    Use --windows to split services with a lot of data in multiple time windows,
+    and export the windows at the same time.
+    This is faster, but puts more load on the system.
+    At most 8 queries (--jobs x --windows) run at the same time.
+
+    Progress is stored in the ./influxdb-checkpoints/ directory.
+    If the export is interrupted, run the command again to resume.
+    Use --no-resume to export all data again.
+
+    By default, a temporary InfluxDB container is started on the ./influxdb/ directory.
+    Stop the InfluxDB service first: two InfluxDB processes must not use the same data files.
+    Alternatively, use --container to read from the running InfluxDB service.
+    No temporary container is started, and the service can keep recording data.
+
+    Use --follow with --container to keep copying new data after the export is done.
+    This lets you keep using InfluxDB until you switch to Victoria Metrics.
+    Press Ctrl+C to stop.
+
+    Progress shows throughput, ETA, and the time spent querying, converting, and uploading.
+    Use `brewblox-ctl --quiet database from-influxdb` to print progress as JSON events.
+
+    Data is queried in batches. The batch size is automatically adjusted,
+    but can be fixed with --batch-size.
+    If memory is limited, use --max-batch-memory to lower the max batch size.
+
+    With --engine=inspect, all data is exported in a single pass per InfluxDB shard.
+    Progress is stored per shard. --jobs and --offset are not used.
+
+    Uploads to Victoria Metrics are compressed.
+    Use --gzip-level to trade CPU load for network traffic.
+
+    By default, only the downsample_1m retention policy is exported.
+    Use --policy to select other retention policies, such as autogen or downsample_10m.
+    Data from other retention policies is tagged with a 'policy' label,
+    and its progress and files are named '{service}@{policy}'.
+
+    Use --newest-first to export the newest data first.
+    Graphs of recent history can be used while older data is still being exported.
+
+    The migration can take hours, and may slow down other services.
+    Use --max-rate to limit the number of exported points per second.
+    Use --nice to limit the CPU and disk usage of the temporary InfluxDB container,
+    and to lower the CPU priority of the export.
 
     \b
     Steps:
@@ -74,6 +205,140 @@ def from_influxdb(target, duration, offset, services):
         - Write data to Victoria Metrics.     (Optional)
         - OR: write data to file.             (Optional)
     """
+    if follow and not container:
+        raise click.UsageError('--follow requires --container. '
+                               'The temporary InfluxDB container does not receive new data.')
+
+    utils.check_config()
+    utils.confirm_mode()
+    if max_batch_memory:
+        max_batch_memory *= 1024 * 1024
+
+    migration.migrate_influxdb(list(target),
+                               duration,
+                               list(services),
+                               list(offset),
+                               jobs,
+                               resume,
+                               batch_size,
+                               max_batch_memory,
+                               engine,
+                               windows,
+                               gzip_level,
+                               victoria_api,
+                               compression,
+                               max_file_size * 1024 * 1024,
+                               max_file_lines,
+                               follow,
+                               follow_interval,
+                               container,
+                               list(policy),
+                               newest_first,
+                               max_rate,
+                               nice)
+
+
+@database.command()
+@click.option('--jobs',
+              default=2,
+              type=click.IntRange(min=1),
+              help='Number of files that are uploaded concurrently.')
+@click.option('--resume/--no-resume',
+              default=True,
+              help='Skip files that were imported by a previous run.')
+@click.option('--gzip-level',
+              default=1,
+              type=click.IntRange(0, 9),
+              help='Compression level for uploads to Victoria Metrics. 0 disables compression.')
+@click.option('--victoria-api',
+              default='write',
+              type=click.Choice(['write', 'import']),
+              help='Victoria Metrics endpoint for uploads. '
+              '"write" accepts InfluxDB line protocol. '
+              '"import" accepts the native Victoria Metrics JSON line format.')
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def from_file(jobs, resume, gzip_level, victoria_api, files):
+    """Import history data exported by from-influxdb to Victoria Metrics.
+
+    Use this to import the files created by `brewblox-ctl database from-influxdb --target=file`.
+    The files may have been created on another machine.
+
+    By default, all files in the ./influxdb-export/ directory are imported.
+    You can override this by listing the files you want to import.
+    Compressed files (.lines.gz, .lines.zst) are decompressed while reading.
+
+    Imported files are stored in the ./influxdb-checkpoints/ directory.
+    If the import is interrupted, run the command again to resume.
+    Use --no-resume to import all files again.
+
+    Use `brewblox-ctl --quiet database from-file` to print progress as JSON events.
+
+    \b
+    Steps:
+        - Find exported files.
+        - Read data from file.
+        - Write data to Victoria Metrics.
+    """
+    utils.check_config()
+    utils.confirm_mode()
+    migration.import_influxdb_files(list(files),
+                                    jobs,
+                                    resume,
+                                    gzip_level,
+                                    victoria_api)
+
+
+@database.command()
+@click.option('--duration',
+              default='',
+              help='Verify only data newer than this. Example: [--duration 30d]')
+@click.option('--bucket',
+              default='1d',
+              show_default=True,
+              help='Duration of compared time buckets. Example: [--bucket 1h]')
+@click.option('--jobs',
+              default=4,
+              type=click.IntRange(min=1),
+              help='Number of buckets that are compared concurrently.')
+@click.option('--container',
+              help='Read data from this running InfluxDB container, '
+              'instead of starting a temporary container. Example: brewblox_influx_1')
+@click.option('--policy',
+              multiple=True,
+              default=['downsample_1m'],
+              show_default=True,
+              help='InfluxDB retention policy that is verified. Can be used multiple times.')
+@click.argument('services', nargs=-1)
+def verify_influxdb(duration, bucket, jobs, container, policy, services):
+    """Compare history data in InfluxDB and Victoria Metrics.
+
+    Use this after `brewblox-ctl database from-influxdb` to check whether all data was imported.
+
+    By default, all services are verified.
+    You can override this by listing the services you want to verify.
+
+    For every service, history is split in time buckets (--bucket).
+    The number of values and the sum of values of every field are compared for every bucket.
+    Only mismatching buckets are listed, with their start and end timestamps.
+
+    Use `brewblox-ctl --quiet database verify-influxdb` to print mismatches as JSON events.
+
+    By default, a temporary InfluxDB container is started on the ./influxdb/ directory.
+    Use --container to read from the running InfluxDB service instead.
+
+    \b
+    Steps:
+        - Create InfluxDB container.
+        - Get list of services from InfluxDB. (Optional)
+        - Count values in InfluxDB.
+        - Count values in Victoria Metrics.
+        - List mismatching buckets.
+    """
     utils.check_config()
     utils.confirm_mode()
-    migration.migrate_influxdb(target, duration, list(services), list(offset))
+    migration.verify_influxdb(duration,
+                              list(services),
+                              bucket,
+                              jobs,
+                              container,
+                              list(policy))
@@ -2,17 +2,148 @@
 Manual migration steps
 """
 
+import gzip
+import io
 import json
+import math
+import os
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
 from contextlib import suppress
-from datetime import datetime
-from tempfile import NamedTemporaryFile
-from typing import List, Optional, Tuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import compress
+from operator import add
+from pathlib import Path
+from queue import Full, Queue
+from sys import getsizeof
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import (Callable, Dict, Generator, Iterable, List, NamedTuple,
+                    Optional, Set, TextIO, Tuple, TypeVar, Union)
 
+import click
 import requests
 import urllib3
 from brewblox_ctl import sh
+from requests.adapters import HTTPAdapter
 
 from brewblox_ctl_lib import const, utils
+from brewblox_ctl_lib.progress import Progress
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# CouchDB documents are read in pages
+COUCHDB_PAGE_SIZE = 500
+
+# Max size of a single request to the datastore /mset endpoint
+MSET_MAX_BYTES = 1024 * 1024
+
+# Stores the last copied document for every CouchDB database
+COUCHDB_CHECKPOINT = './couchdb-checkpoint.json'
+
+# Query batch sizes are adjusted during export
+# See BatchSizer for details
+QUERY_BATCH_SIZE = 5000
+MIN_QUERY_BATCH_SIZE = 500
+MAX_QUERY_BATCH_SIZE = 100000
+MAX_BATCH_MEMORY = 16 * 1024 * 1024
+BATCH_TARGET_S = 3
+
+FILE_DIR = './influxdb-export'
+FILE_MAX_BYTES = 100 * 1024 * 1024
+FILE_GZIP_LEVEL = 6
+FILE_ZSTD_LEVEL = 3
+FILE_EXTENSIONS = {
+    'none': '.lines',
+    'gzip': '.lines.gz',
+    'zstd': '.lines.zst',
+}
+CHECKPOINT_DIR = './influxdb-checkpoints'
+SHARDS_CHECKPOINT = '.shards'  # Can't be a service name
+IMPORT_CHECKPOINT = '.import'
+FOLLOW_CHECKPOINT = '.follow'
+
+# Retention policy used by the history service
+# Data from other policies is tagged with the policy name
+DEFAULT_POLICY = 'downsample_1m'
+
+# Seconds between polls for new data in follow mode
+FOLLOW_INTERVAL_S = 10
+
+# Follow polls only scan points newer than the start of the previous poll, minus this margin
+FOLLOW_MARGIN_S = 60
+
+# Started by migrate_influxdb if no running InfluxDB container is given
+MIGRATE_CONTAINER = 'influxdb-migrate'
+
+# Approximate size of batches read from exported files
+IMPORT_BATCH_BYTES = 4 * 1024 * 1024
+
+# Approximate size of chunks in HTTP request bodies
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Failed uploads are retried with exponential backoff
+UPLOAD_ATTEMPTS = 5
+UPLOAD_RETRY_DELAY_S = 1
+UPLOAD_TIMEOUT_S = 120
+UPLOAD_POOL_SIZE = 16
+
+# Upload bodies are sent with gzip headers and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Joins sink names if data is written to multiple sinks
+TEE_SEPARATOR = '+'
+
+# Must match the --influxMeasurementFieldSeparator argument for Victoria
+VICTORIA_FIELD_SEPARATOR = '/'
+
+# Container limits used for the temporary InfluxDB container if `nice` is set
+# Docker defaults are --cpu-shares=1024 and --blkio-weight=500
+NICE_CPUS = 1
+NICE_CPU_SHARES = 256
+NICE_BLKIO_WEIGHT = 100
+
+# Increment to the process niceness if `nice` is set
+NICE_INCREMENT = 10
+
+# Max number of concurrent Influx queries (jobs * windows)
+# Every query is a separate process in the InfluxDB container
+MAX_CONCURRENT_QUERIES = 8
+
+# Max number of batches that are queried and converted,
+# but not yet written to target
+PIPELINE_DEPTH = 2
+
+# Verified buckets are compared with this relative tolerance
+# Victoria stores float values with limited precision
+VERIFY_REL_TOLERANCE = 1e-6
+
+DURATION_PATTERN = re.compile(r'(\d+(ms|s|m|h|d|w|y))+')
+DURATION_UNIT_PATTERN = re.compile(r'(\d+)(ms|s|m|h|d|w|y)')
+DURATION_UNITS = {
+    'ms': timedelta(milliseconds=1),
+    's': timedelta(seconds=1),
+    'm': timedelta(minutes=1),
+    'h': timedelta(hours=1),
+    'd': timedelta(days=1),
+    'w': timedelta(weeks=1),
+    'y': timedelta(days=365),
+}
+
+# Influx line protocol, as generated by `influx_inspect export`:
+# MEASUREMENT[,TAGS] k1=1,k2=2,k3=3 TIMESTAMP
+EXPORT_LINE_PATTERN = re.compile(r'^(?P<series>(?:\\.|[^\\ ])+) (?P<fields>.+) (?P<time>-?\d+)$')
+EXPORT_FIELD_PATTERN = re.compile(r'((?:\\.|[^\\=,])+)=("(?:\\.|[^\\"])*"|[^,]*)')
+MEASUREMENT_PATTERN = re.compile(r'^(?:\\.|[^\\,])+')
+ESCAPED_CHAR_PATTERN = re.compile(r'\\(.)')
+UNESCAPED_COMMA_PATTERN = re.compile(r'(?<!\\),')
+
+T = TypeVar('T')
 
 
 def migrate_compose_split():
@@ -59,7 +190,141 @@ def migrate_ipv6_fix():
     utils.enable_ipv6()
 
 
+class CouchPage(NamedTuple):
+    docs: List[dict]
+    cursor: Optional[str]  # ID of the last document
+    total: int  # Number of documents in the database
+
+
+def _couchdb_pages(couch_url: str, db: str, cursor: Optional[str] = None) -> Generator[CouchPage, None, None]:
+    """
+    Yields all documents in `db` in pages of COUCHDB_PAGE_SIZE, sorted by ID.
+    If `cursor` is set, the first page starts after the document with that ID.
+    """
+    while True:
+        params = {'include_docs': 'true', 'limit': COUCHDB_PAGE_SIZE}
+        if cursor is not None:
+            params['startkey'] = json.dumps(cursor)
+            params['skip'] = 1
+        resp = requests.get(f'{couch_url}/{db}/_all_docs', params=params)
+        resp.raise_for_status()
+        content = resp.json()
+        rows = content['rows']
+        cursor = rows[-1]['id'] if rows else cursor
+        yield CouchPage([r['doc'] for r in rows], cursor, content['total_rows'])
+
+        if len(rows) < COUCHDB_PAGE_SIZE:
+            return
+
+
+def _convert_store_docs(db: str, docs: List[dict]) -> List[dict]:
+    """
+    Converts UI and automation documents.
+    IDs are formatted as '{module}__{id}'. Documents with invalid IDs are dropped.
+    """
+    converted = []
+    for d in docs:
+        segments = d.pop('_id').split('__', 1)
+        if len(segments) == 2:
+            del d['_rev']
+            d['namespace'] = f'{db}:{segments[0]}'
+            d['id'] = segments[1]
+            converted.append(d)
+    return converted
+
+
+def _convert_spark_docs(db: str, docs: List[dict]) -> List[dict]:
+    for d in docs:
+        del d['_rev']
+        d['namespace'] = 'spark-service'
+        d['id'] = d.pop('_id')
+    return docs
+
+
+def _mset_chunks(docs: List[dict]) -> Generator[Tuple[str, int], None, None]:
+    """
+    Yields /mset request bodies of at most MSET_MAX_BYTES, and the number of documents in each body.
+    Documents are serialized once, and then joined.
+    A document larger than MSET_MAX_BYTES is sent in a separate request.
+    """
+    chunk = []
+    size = 0
+    for doc in docs:
+        value = json.dumps(doc)
+        if chunk and size + len(value) > MSET_MAX_BYTES:
+            yield '{"values":[' + ','.join(chunk) + ']}', len(chunk)
+            chunk = []
+            size = 0
+        chunk.append(value)
+        size += len(value) + 1
+
+    if chunk:
+        yield '{"values":[' + ','.join(chunk) + ']}', len(chunk)
+
+
+def _copy_couchdb(
+    db: str,
+    convert: Callable[[str, List[dict]], List[dict]],
+    couch_url: str,
+    redis_url: str,
+    progress: Progress,
+    checkpoints: dict,
+):
+    """
+    Copies all documents in `db` to Redis.
+    The ID of the last copied document is stored in `checkpoints` after every page.
+    If `checkpoints` has a cursor for `db`, copying resumes after that document.
+    """
+    state = checkpoints.setdefault(db, {'cursor': None, 'docs': 0, 'done': False})
+
+    if state['done']:
+        utils.info(f'{db}: already migrated')
+        return
+
+    started = False
+    start = monotonic()
+
+    for page in _couchdb_pages(couch_url, db, state['cursor']):
+        if not started:
+            progress.add(db, page.total, state['docs'])
+            started = True
+
+        queried = monotonic()
+        docs = convert(db, page.docs)
+        stages = {
+            'query': queried - start,
+            'convert': monotonic() - queried,
+        }
+
+        for body, count in _mset_chunks(docs):
+            sent = monotonic()
+            resp = requests.post(f'{redis_url}/mset',
+                                 data=body,
+                                 headers={'Content-Type': 'application/json'},
+                                 verify=False)
+            resp.raise_for_status()
+            progress.update(db, count, len(body), upload=monotonic() - sent, **stages)
+            stages = {}
+
+        state['cursor'] = page.cursor
+        state['docs'] += len(page.docs)
+        _write_json(Path(COUCHDB_CHECKPOINT), checkpoints)
+        start = monotonic()
+
+    state['done'] = True
+    _write_json(Path(COUCHDB_CHECKPOINT), checkpoints)
+    progress.done(db)
+
+
 def migrate_couchdb():
+    """
+    Copies configuration data from CouchDB to Redis.
+
+    Documents are read in pages, and sent to the datastore in chunks of at most MSET_MAX_BYTES.
+    Progress is stored in COUCHDB_CHECKPOINT. If the migration is interrupted,
+    the next run continues after the last copied page.
+    The checkpoint is removed after the migration is done.
+    """
     urllib3.disable_warnings()
     sudo = utils.optsudo()
     opts = utils.ctx_opts()
@@ -89,239 +354,1736 @@ def migrate_couchdb():
     resp = requests.get(f'{couch_url}/_all_dbs')
     resp.raise_for_status()
     dbs = resp.json()
+    progress = Progress()
+
+    checkpoints = {}
+    with suppress(FileNotFoundError, ValueError):
+        checkpoints = json.loads(Path(COUCHDB_CHECKPOINT).read_text())
+        utils.info(f'Resuming from {COUCHDB_CHECKPOINT}')
 
-    for db in ['brewblox-ui-store', 'brewblox-automation']:
+    for db, convert in [
+        ('brewblox-ui-store', _convert_store_docs),
+        ('brewblox-automation', _convert_store_docs),
+        ('spark-service', _convert_spark_docs),
+    ]:
         if db in dbs:
-            resp = requests.get(f'{couch_url}/{db}/_all_docs',
-                                params={'include_docs': True})
-            resp.raise_for_status()
-            docs = [v['doc'] for v in resp.json()['rows']]
-            # Drop invalid names
-            docs[:] = [d for d in docs if len(d['_id'].split('__', 1)) == 2]
-            for d in docs:
-                segments = d['_id'].split('__', 1)
-                d['namespace'] = f'{db}:{segments[0]}'
-                d['id'] = segments[1]
-                del d['_rev']
-                del d['_id']
-            resp = requests.post(f'{redis_url}/mset',
-                                 json={'values': docs},
-                                 verify=False)
-            resp.raise_for_status()
-            utils.info(f'Migrated {len(docs)} entries from {db}')
+            _copy_couchdb(db, convert, couch_url, redis_url, progress, checkpoints)
 
-    if 'spark-service' in dbs:
-        resp = requests.get(f'{couch_url}/spark-service/_all_docs',
-                            params={'include_docs': True})
-        resp.raise_for_status()
-        docs = [v['doc'] for v in resp.json()['rows']]
-        for d in docs:
-            d['namespace'] = 'spark-service'
-            d['id'] = d['_id']
-            del d['_rev']
-            del d['_id']
-        resp = requests.post(f'{redis_url}/mset',
-                             json={'values': docs},
-                             verify=False)
-        resp.raise_for_status()
-        utils.info(f'Migrated {len(docs)} entries from spark-service')
+    progress.summary()
 
     sh(f'{sudo}docker stop couchdb-migrate')
     sh('sudo mv couchdb/ couchdb-migrated-' + datetime.now().strftime('%Y%m%d'))
 
+    with suppress(FileNotFoundError):
+        Path(COUCHDB_CHECKPOINT).unlink()
+
+
+class InfluxStats(NamedTuple):
+    count: int  # Number of points. This is the highest count for any field.
+    start: int  # Timestamp of first point
+    end: int  # Timestamp of last point
+
 
-def _influx_measurements() -> List[str]:
+def _influx_stats(
+    args: str = '',
+    measurement: str = '/.*/',
+    container: str = 'influxdb-migrate',
+    policy: str = DEFAULT_POLICY,
+) -> Dict[str, InfluxStats]:
     """
-    Fetch all known measurements from Influx
-    This requires an InfluxDB docker container with name 'influxdb-migrate'
+    Fetch point counts and time ranges for all measurements in `policy` that match `measurement`.
+    All queries are sent in a single call, to reduce process overhead.
+    Measurements without points are not included.
+    This requires an InfluxDB docker container with name `container`
     to have been started.
     """
     sudo = utils.optsudo()
+    source = f'"brewblox"."{policy}".{measurement}'
+    queries = '; '.join([
+        f'SELECT count(*) FROM {source} {args}',
+        f'SELECT * FROM {source} {args} ORDER BY time ASC LIMIT 1',
+        f'SELECT * FROM {source} {args} ORDER BY time DESC LIMIT 1',
+    ])
+    json_result = sh(f'{sudo}docker exec {container} influx '
+                     '-database brewblox '
+                     f"-execute '{queries}' "
+                     '-format json',
+                     capture=True)
 
-    raw_measurements = list(
-        utils.sh_stream(
-            f'{sudo}docker exec influxdb-migrate influx '
-            '-database brewblox '
-            "-execute 'SHOW MEASUREMENTS' "
-            '-format csv'
-        ))
-
-    measurements = [
-        s.strip().split(',')[1]
-        for s in raw_measurements[1:]  # ignore line with headers
-        if s.strip()
+    results = json.loads(json_result).get('results', [])
+    counts, firsts, lasts = [
+        {s['name']: s['values'][0] for s in result.get('series', [])}
+        for result in (results + [{}, {}, {}])[:3]
     ]
 
-    return measurements
+    stats = {}
+    for name, values in counts.items():
+        count = max((v for v in values[1:] if v is not None), default=0)
+        if count and name in firsts and name in lasts:
+            stats[name] = InfluxStats(count, firsts[name][0], lasts[name][0])
+    return stats
 
 
-def _influx_line_count(service: str, args: str) -> Optional[int]:
-    sudo = utils.optsudo()
-    measurement = f'"brewblox"."downsample_1m"."{service}"'
-    points_field = '"m_ Combined Influx points"'
-    json_result = sh(f'{sudo}docker exec influxdb-migrate influx '
-                     '-database brewblox '
-                     f"-execute 'SELECT count({points_field}) FROM {measurement} {args}' "
-                     '-format json',
-                     capture=True)
+class InfluxBatch(NamedTuple):
+    data: str  # Lines converted to Influx line protocol
+    count: int  # Number of lines in data
+    time: str  # Timestamp of last line
+    limit: int  # Batch size used in query
+    query_s: float = 0  # Time spent reading data from Influx
+    convert_s: float = 0  # Time spent converting to line protocol
+
+
+class InfluxShard(NamedTuple):
+    id: str
+    start: datetime
+    end: datetime
+
+
+class BatchSizer:
+    """
+    Chooses the number of rows in the next Influx query.
+
+    Every query has a fixed overhead for starting a process in the container,
+    so sparse measurements benefit from large batches.
+    Batches of wide measurements take more memory, and must be kept small.
+
+    The size is adjusted to approach BATCH_TARGET_S per batch,
+    without exceeding `max_memory` bytes per converted batch.
+    If `size` is set, it is used for all batches.
+    """
+
+    def __init__(self, size: Optional[int] = None, max_memory: Optional[int] = None):
+        self.fixed = size is not None
+        self.size = size or QUERY_BATCH_SIZE
+        self.max_memory = max_memory or MAX_BATCH_MEMORY
+
+    def update(self, num_lines: int, num_bytes: int, elapsed: float):
+        if self.fixed or not num_lines:
+            return
+
+        # Grow gradually, to avoid overshooting after a very fast batch
+        size = self.size * 2
+        if elapsed > 0:
+            size = min(size, num_lines * BATCH_TARGET_S / elapsed)
+        size = min(size, self.max_memory * num_lines / num_bytes)
+        self.size = int(max(MIN_QUERY_BATCH_SIZE, min(MAX_QUERY_BATCH_SIZE, size)))
 
-    result = json.loads(json_result)
+
+class RateLimiter:
+    """
+    Token bucket that limits the number of points per second.
+
+    The bucket holds at most one second of tokens.
+    Batches larger than the bucket are allowed, but later batches wait until the debt is paid.
+    A single limiter is shared by all export threads.
+    If `rate` is not set, points are never delayed.
+    """
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate
+        self._tokens = rate or 0
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self, points: int):
+        if not self.rate:
+            return
+
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.rate)
+            self._updated = now
+            self._tokens -= points
+            delay = -self._tokens / self.rate
+
+        if delay > 0:
+            sleep(delay)
+
+
+def _prefetch(generator: Iterable[T], depth: int) -> Generator[T, None, None]:
+    """
+    Consumes `generator` in a background thread.
+    At most `depth` items are buffered before the producer blocks.
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    queue = Queue(maxsize=depth)
+    stopped = Event()
+    done = object()
+
+    def put(item) -> bool:
+        # Stop blocking if the consumer is gone
+        while not stopped.is_set():
+            with suppress(Full):
+                queue.put(item, timeout=0.1)
+                return True
+        return False
+
+    def produce():
+        try:
+            for item in generator:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as ex:
+            put((None, ex))
+
+    Thread(target=utils.with_ctx(produce), daemon=True).start()
 
     try:
-        return result['results'][0]['series'][0]['values'][0][1]
-    except (IndexError, KeyError):
-        return None
+        while True:
+            item, ex = queue.get()
+            if ex is not None:
+                raise ex
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
 
 
-def _copy_influx_measurement(
-    service: str,
-    date: str,
-    duration: str,
-    target: str,
-    offset: int = 0,
-):
+def _run_jobs(func: Callable, jobs: List[tuple], max_workers: int, stop: Event):
     """
-    Export measurement from Influx, and copy/import to `target`.
-    This requires an InfluxDB docker container with name 'influxdb-migrate'
-    to have been started.
+    Calls `func(*args)` for all `jobs` in a thread pool.
+    Exceptions are raised after all remaining jobs are done.
+
+    If interrupted (Ctrl+C), `stop` is set, and jobs that were not yet started are cancelled.
+    Running jobs are expected to check `stop` between batches.
+    KeyboardInterrupt is re-raised after they returned.
     """
-    QUERY_BATCH_SIZE = 5000
-    FILE_BATCH_SIZE = 50000
-    FILE_DIR = './influxdb-export'
-    sudo = utils.optsudo()
-    measurement = f'"brewblox"."downsample_1m"."{service}"'
-    args = f'where time > now() - {duration}' if duration else ''
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = [executor.submit(utils.with_ctx(func), *args) for args in jobs]
+    try:
+        wait(futures)
+    except KeyboardInterrupt:
+        stop.set()
+        for fut in futures:
+            fut.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
 
-    total_lines = _influx_line_count(service, args)
-    offset = max(offset, 0)
-    offset -= (offset % QUERY_BATCH_SIZE)  # Round down to multiple of batch size
-    num_lines = offset
+    for fut in futures:
+        fut.result()
 
-    if target == 'file':
-        sh(f'mkdir -p {FILE_DIR}')
 
-    if total_lines is None:
-        return
+def _duration_cond(duration: str) -> str:
+    return f'time > now() - {duration}' if duration else ''
+
+
+def _where(*conditions: str) -> str:
+    conditions = [c for c in conditions if c]
+    return f'where {" and ".join(conditions)}' if conditions else ''
+
+
+def _policy_key(service: str, policy: str) -> str:
+    """
+    Name used for checkpoints, progress, and exported files.
+    Services in the default policy keep their own name.
+    """
+    return service if policy == DEFAULT_POLICY else f'{service}@{policy}'
+
+
+def _policy_tags(policy: str) -> str:
+    """
+    Line protocol tags added to exported lines.
+    This keeps data from multiple retention policies apart in Victoria.
+    """
+    return '' if policy == DEFAULT_POLICY else f',policy={policy}'
+
+
+def _influx_windows(stats: InfluxStats, num_windows: int) -> List[dict]:
+    """
+    Splits the time range of a measurement into `num_windows` non-overlapping time windows.
+    The first and last windows are open-ended:
+    if new data is added, it will be exported by the last window.
+    """
+    first, last = stats.start, stats.end
+    bounds = sorted({first + (last - first) * i // num_windows
+                     for i in range(1, num_windows)} - {first})
+
+    return [
+        {'start': start, 'end': end, 'time': None, 'lines': 0}
+        for start, end in zip([None, *bounds], [*bounds, None])
+    ]
+
+
+def _convert_csv_batch(headers: str, rows: List[str], tags: str = '') -> Tuple[str, int, Optional[str]]:
+    """
+    Converts a block of Influx CSV output to Influx line protocol.
+    Returns the converted data, the number of converted lines, and the last timestamp.
+    `tags` are appended to the measurement name.
+
+    CSV rows have a column for every field in the measurement,
+    but only fields with a value are included in the output.
+
+    This function is called for every queried block of rows, and is optimized for speed.
+    Field keys are prefixed and escaped once per block.
+    Empty values are masked out by `compress()` and `filter()`,
+    so no Python code is executed for individual fields.
+    """
+    # Remove 'm_' prefix and escape spaces
+    # Fields in downsampled policies have the prefix, fields in autogen do not
+    # 'name' and 'time' columns are replaced by empty values in the row
+    prefixes = ['', ''] + [
+        (f[2:] if f.startswith('m_') else f).replace(' ', '\\ ') + '='
+        for f in headers.split(',')[2:]
+    ]
+    lines = []
+    time = None
+
+    for row in rows:
+        values = row.split(',')
+        name = values[0]
+        time = values[1]
+        values[0] = values[1] = ''
+
+        # Influx line protocol:
+        # MEASUREMENT k1=1,k2=2,k3=3 TIMESTAMP
+        content = ','.join(map(add, compress(prefixes, values), filter(None, values)))
+        if content:
+            lines.append(f'{name}{tags} {content} {time}\n')
+
+    return ''.join(lines), len(lines), time if lines else None
+
+
+def _influx_batches(
+    service: str,
+    args: str,
+    offset: int,
+    sizer: BatchSizer,
+    bound: str = '',
+    container: str = 'influxdb-migrate',
+    policy: str = DEFAULT_POLICY,
+    descending: bool = False,
+) -> Generator[InfluxBatch, None, None]:
+    """
+    Yields batches of data from Influx, converted to line protocol.
+    `bound` is an additional condition that is applied to all queries.
+    If `descending` is set, the newest data is yielded first,
+    and the `time` of every batch is its oldest timestamp.
+    This requires an InfluxDB docker container with name `container`
+    to have been started.
+    """
+    sudo = utils.optsudo()
+    measurement = f'"brewblox"."{policy}"."{service}"'
+    order = ' DESC' if descending else ''
+    tags = _policy_tags(policy)
 
     while True:
+        start = monotonic()
+        limit = sizer.size
         generator = utils.sh_stream(
-            f'{sudo}docker exec influxdb-migrate influx '
+            f'{sudo}docker exec {container} influx '
             '-database brewblox '
-            f"-execute 'SELECT * FROM {measurement} {args} ORDER BY time LIMIT {QUERY_BATCH_SIZE} OFFSET {offset}' "
+            f"-execute 'SELECT * FROM {measurement} {args} ORDER BY time{order} LIMIT {limit} OFFSET {offset}' "
             '-format csv')
 
         headers = next(generator, '').strip()
-        time = None
 
         if not headers:
             return
 
-        fields = [
-            f[2:].replace(' ', '\\ ')  # Remove 'm_' prefix and escape spaces
-            for f in headers.split(',')[2:]  # Ignore 'name' and 'time' columns
-        ]
+        rows = [v for v in (line.strip() for line in generator) if v]
+        queried = monotonic()
+        data, num_lines, time = _convert_csv_batch(headers, rows, tags)
+        converted = monotonic()
 
-        with NamedTemporaryFile('w') as tmp:
-            for line in generator:
-                if not line:
-                    continue
+        if not num_lines:
+            return
 
-                num_lines += 1
-                values = line.strip().split(',')
-                name = values[0]
-                time = values[1]
-
-                # Influx line protocol:
-                # MEASUREMENT k1=1,k2=2,k3=3 TIMESTAMP
-                tmp.write(f'{name} ')
-                tmp.write(
-                    ','.join((
-                        f'{f}={v}'
-                        for f, v in zip(fields, values[2:])
-                        if v
-                    ))
-                )
-                tmp.write(f' {time}\n')
-
-            tmp.flush()
-
-            if target == 'victoria':
-                with open(tmp.name, 'rb') as rtmp:
-                    url = f'{utils.host_url()}/victoria/write'
-                    urllib3.disable_warnings()
-                    requests.get(url, data=rtmp, verify=False)
-
-            elif target == 'file':
-                idx = str(offset // FILE_BATCH_SIZE + 1).rjust(3, '0')
-                fname = f'{FILE_DIR}/{service}__{date}__{duration or "all"}__{idx}.lines'
-                sh(f'cat "{tmp.name}" >> "{fname}"')
-
-            else:
-                raise ValueError(f'Invalid target: {target}')
+        sizer.update(num_lines, getsizeof(data), converted - start)
+        yield InfluxBatch(data, num_lines, time, limit, queried - start, converted - queried)
 
         offset = 0
-        args = f'where time > {time}'
-        utils.info(f'{service}: exported {num_lines}/{total_lines} lines')
+        args = _where(f'time < {time}' if descending else f'time > {time}', bound)
 
 
-def migrate_influxdb(
-    target: str = 'victoria',
-    duration: str = '',
-    services: List[str] = [],
-    offsets: List[Tuple[str, int]] = [],
-):
-    """Exports InfluxDB history data.
+def _encode_chunks(data: str) -> Generator[bytes, None, None]:
+    """
+    Encodes data in chunks of UPLOAD_CHUNK_SIZE characters.
+    This avoids a full encoded copy of the data being kept in memory.
+    """
+    for idx in range(0, len(data), UPLOAD_CHUNK_SIZE):
+        yield data[idx:idx + UPLOAD_CHUNK_SIZE].encode()
+
+
+def _checkpoint_path(target: str, service: str) -> Path:
+    return Path(CHECKPOINT_DIR) / f'{target}__{service}.json'
 
-    The exported data is either immediately imported to the new history database,
-    or saved to file.
+
+def _read_checkpoint(target: str, service: str) -> Optional[dict]:
     """
-    opts = utils.ctx_opts()
-    sudo = utils.optsudo()
-    date = datetime.now().strftime('%Y%m%d_%H%M')
+    Checkpoints for multiple sinks (eg. 'victoria+file') are stored separately for every sink.
+    They are only used if all sinks have the same checkpoint.
+    """
+    targets = target.split(TEE_SEPARATOR)
+    checkpoints = []
 
-    utils.warn('Depending on the amount of data, this may take some hours.')
-    utils.warn('You can use your system as normal while the migration is in progress.')
-    utils.warn('The migration can safely be stopped and restarted or resumed.')
-    utils.warn('For more info, see https://brewblox.netlify.app/dev/migration/influxdb.html')
+    for name in targets:
+        checkpoint = None
+        with suppress(FileNotFoundError, ValueError):
+            checkpoint = json.loads(_checkpoint_path(name, service).read_text())
+        checkpoints.append(checkpoint)
 
-    if opts.dry_run:
-        utils.info('Dry run. Skipping migration...')
-        return
+    if any(c != checkpoints[0] for c in checkpoints):
+        utils.warn(f'{service}: checkpoints for {", ".join(targets)} are not the same. Starting over...')
+        return None
+    return checkpoints[0]
 
-    if not utils.path_exists('./influxdb/'):
-        utils.info('influxdb/ dir not found. Skipping migration...')
-        return
 
-    utils.info('Starting InfluxDB container...')
+def _write_json(path: Path, content: dict):
+    """
+    Atomically replaces a JSON file.
+    The new content is written to a temporary file, and then moved.
+    If the process is interrupted, either the old or the new content remains.
+    """
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(content, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
-    # Stop container in case previous migration was cancelled
-    sh(f'{sudo}docker stop influxdb-migrate > /dev/null', check=False)
 
-    # Start standalone container
-    # We'll communicate using 'docker exec', so no need to publish a port
-    sh(f'{sudo}docker run '
-       '--rm -d '
-       '--name influxdb-migrate '
-       '-v "$(pwd)/influxdb:/var/lib/influxdb" '
-       'influxdb:1.8 '
-       '> /dev/null')
+def _write_checkpoint(target: str, service: str, checkpoint: dict):
+    for name in target.split(TEE_SEPARATOR):
+        path = _checkpoint_path(name, service)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _write_json(path, checkpoint)
 
-    # Do a health check until startup is done
-    inner_cmd = 'curl --output /dev/null --silent --fail http://localhost:8086/health'
-    bash_cmd = f'until $({inner_cmd}); do sleep 1 ; done'
-    sh(f"{sudo}docker exec influxdb-migrate bash -c '{bash_cmd}'")
 
-    # Determine relevant measurement
-    # Export all of them if not specified by user
-    if not services:
-        services = _influx_measurements()
+class UploadBody:
+    """
+    Request body for uploads to Victoria.
+    Data is encoded and compressed in chunks while it is sent.
+    Every iteration is a new pass over the data, so the body can be sent again on retry.
+    After a pass, `size` is the number of bytes sent.
+    """
+
+    def __init__(self, data: str, gzip_level: int = 0):
+        self.data = data
+        self.gzip_level = gzip_level
+        self.size = 0
+
+    def __iter__(self) -> Generator[bytes, None, None]:
+        self.size = 0
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, GZIP_WBITS) \
+            if self.gzip_level else None
+
+        for chunk in _encode_chunks(self.data):
+            if compressor:
+                chunk = compressor.compress(chunk)
+            # An empty chunk would end the chunked request body
+            if chunk:
+                self.size += len(chunk)
+                yield chunk
+
+        if compressor:
+            chunk = compressor.flush()
+            self.size += len(chunk)
+            yield chunk
+
+
+@lru_cache(maxsize=None)
+def _upload_session() -> requests.Session:
+    """
+    Shared session for all uploads to Victoria.
+    Connections are kept alive, and reused by all export threads.
+    If more threads upload at the same time than the pool holds,
+    they wait for a free connection, instead of opening and discarding extra connections.
+    """
+    urllib3.disable_warnings()
+    session = requests.Session()
+    session.verify = False
+    session.mount('https://', HTTPAdapter(pool_maxsize=UPLOAD_POOL_SIZE, pool_block=True))
+    return session
+
+
+def _upload(url: str, body: UploadBody, headers: dict = {}) -> int:
+    """
+    Sends data to Victoria, and returns the number of bytes sent.
+    Connection errors and 5XX responses are retried with exponential backoff.
+    Raises an exception if the data was not accepted after UPLOAD_ATTEMPTS attempts.
+    """
+    delay = UPLOAD_RETRY_DELAY_S
+    attempt = 0
+
+    while True:
+        attempt += 1
+        try:
+            # An iterable body is sent using chunked transfer encoding
+            resp = _upload_session().get(url,
+                                         data=body,
+                                         headers=headers,
+                                         timeout=UPLOAD_TIMEOUT_S)
+            resp.raise_for_status()
+            return body.size
+        except requests.HTTPError as ex:
+            if ex.response.status_code < 500 or attempt == UPLOAD_ATTEMPTS:
+                raise ex
+            error = ex
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            if attempt == UPLOAD_ATTEMPTS:
+                raise ex
+            error = ex
+
+        utils.warn(f'Upload failed ({attempt}/{UPLOAD_ATTEMPTS}): {error}. Retrying in {delay}s...')
+        sleep(delay)
+        delay *= 2
+
+
+def _parse_field_value(value: str) -> Optional[float]:
+    """
+    Parses a line protocol field value.
+    Returns None for strings, which are not supported by Victoria.
+    """
+    if value.endswith(('i', 'u')):
+        return int(value[:-1])
+    if value in ['t', 'T', 'true', 'True', 'TRUE']:
+        return 1
+    if value in ['f', 'F', 'false', 'False', 'FALSE']:
+        return 0
+    with suppress(ValueError):
+        return float(value)
+    return None
+
+
+def _line_protocol_to_json(data: str) -> str:
+    """
+    Converts Influx line protocol to the JSON line format
+    used by the Victoria /api/v1/import endpoint.
+    Every field in a measurement is a separate metric.
+    All values for the same metric are combined in a single line.
+    """
+    series = {}
+
+    for line in data.splitlines():
+        match = EXPORT_LINE_PATTERN.match(line)
+        if not match:
+            continue
+
+        series_key, fields, time = match.group('series', 'fields', 'time')
+        timestamp = int(time) // 1000000  # ns -> ms
+        measurement, *tags = [
+            ESCAPED_CHAR_PATTERN.sub(r'\1', v)
+            for v in UNESCAPED_COMMA_PATTERN.split(series_key)
+        ]
+
+        for key, value in EXPORT_FIELD_PATTERN.findall(fields):
+            parsed = _parse_field_value(value)
+            if parsed is None:
+                continue
+            name = measurement + VICTORIA_FIELD_SEPARATOR + ESCAPED_CHAR_PATTERN.sub(r'\1', key)
+            values, timestamps = series.setdefault((name, *tags), ([], []))
+            values.append(parsed)
+            timestamps.append(timestamp)
+
+    return ''.join((
+        json.dumps({
+            'metric': {'__name__': name, **dict(tag.split('=', 1) for tag in tags)},
+            'values': values,
+            'timestamps': timestamps,
+        }) + '\n'
+        for (name, *tags), (values, timestamps) in series.items()
+    ))
+
+
+class VictoriaSink:
+    """
+    Imports converted data in Victoria Metrics.
+
+    If `gzip_level` is set, request bodies are compressed.
+    The 'write' API accepts Influx line protocol.
+    The 'import' API accepts the native Victoria JSON line format.
+    """
+    name = 'victoria'
+
+    def __init__(self, gzip_level: int = 0, api: str = 'write'):
+        if api not in ['write', 'import']:
+            raise ValueError(f'Invalid Victoria API: {api}')
+        self.gzip_level = gzip_level
+        self.api = api
+
+    def write(self, service: str, data: str, stream: int = 0) -> int:
+        """
+        Returns after the data is accepted by Victoria.
+        Returns the number of bytes sent.
+        """
+        if self.api == 'import':
+            url = f'{utils.host_url()}/victoria/api/v1/import'
+            data = _line_protocol_to_json(data)
+        else:
+            url = f'{utils.host_url()}/victoria/write'
+        headers = {'Content-Encoding': 'gzip'} if self.gzip_level else {}
+        return _upload(url, UploadBody(data, self.gzip_level), headers)
+
+
+def _line_time(line: str) -> int:
+    return int(line.rsplit(' ', 1)[-1])
+
+
+class FileSink:
+    """
+    Writes converted data to compressed files in FILE_DIR.
+    Files are named after service, export date, duration, and file number.
+
+    Every write is compressed as a separate gzip member or zstd frame,
+    so files remain valid if the export is interrupted.
+    Files are rotated before they exceed `max_bytes` or `max_lines`.
+
+    Every file has a sidecar manifest ('{file}.json')
+    with its line count, size, and time range.
+    Concurrent streams (windows) of the same service write to separate files.
+    Existing files are never appended to: numbering continues after files from previous runs.
+    """
+    name = 'file'
+
+    def __init__(self,
+                 date: str,
+                 duration: str,
+                 compression: str = 'gzip',
+                 max_bytes: Optional[int] = FILE_MAX_BYTES,
+                 max_lines: Optional[int] = None):
+        if compression not in FILE_EXTENSIONS:
+            raise ValueError(f'Invalid compression: {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+
+        self.date = date
+        self.duration = duration
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self._files = {}  # (service, stream) -> manifest
+        self._numbers = {}  # service -> last file number
+        self._lock = Lock()
+        sh(f'mkdir -p {FILE_DIR}')
+
+    def _prefix(self, service: str) -> str:
+        return f'{service}__{self.date}__{self.duration or "all"}__'
+
+    def fname(self, service: str, num: int = 1) -> str:
+        return f'{FILE_DIR}/{self._prefix(service)}{str(num).rjust(3, "0")}' + FILE_EXTENSIONS[self.compression]
+
+    def _last_number(self, service: str) -> int:
+        prefix = self._prefix(service)
+        numbers = [
+            int(num)
+            for num in (
+                name[len(prefix):len(prefix) + 3]
+                for name in os.listdir(FILE_DIR)
+                if name.startswith(prefix)
+            )
+            if num.isdigit()
+        ]
+        return max(numbers, default=0)
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == 'gzip':
+            return gzip.compress(data, FILE_GZIP_LEVEL)
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor(level=FILE_ZSTD_LEVEL).compress(data)
+        return data
+
+    def _fits(self, manifest: dict, num_bytes: int, num_lines: int) -> bool:
+        if self.max_bytes and manifest['bytes'] + num_bytes > self.max_bytes:
+            return False
+        if self.max_lines and manifest['lines'] + num_lines > self.max_lines:
+            return False
+        return True
+
+    def write(self, service: str, data: str, stream: int = 0) -> int:
+        """
+        Returns the number of bytes written.
+        """
+        if not data:
+            return 0
+
+        num_lines = data.count('\n')
+        start = _line_time(data[:data.find('\n')])
+        end = _line_time(data[data.rfind('\n', 0, -1) + 1:])
+        content = self._compress(data.encode())
+
+        with self._lock:
+            manifest = self._files.get((service, stream))
+            if manifest is None or not self._fits(manifest, len(content), num_lines):
+                if service not in self._numbers:
+                    self._numbers[service] = self._last_number(service)
+                num = self._numbers[service] + 1
+                self._numbers[service] = num
+                manifest = {
+                    'file': Path(self.fname(service, num)).name,
+                    'service': service,
+                    'compression': self.compression,
+                    'lines': 0,
+                    'bytes': 0,
+                    'start': start,
+                    'end': end,
+                }
+                self._files[(service, stream)] = manifest
+
+            path = Path(FILE_DIR) / manifest['file']
+            with open(path, 'ab') as f:
+                f.write(content)
+
+            manifest['lines'] += num_lines
+            manifest['bytes'] += len(content)
+            manifest['start'] = min(manifest['start'], start)
+            manifest['end'] = max(manifest['end'], end)
+            _write_json(path.with_name(path.name + '.json'), manifest)
+
+        return len(content)
+
+
+class TeeSink:
+    """
+    Writes the same data to multiple sinks.
+    Data is only read and converted once.
+    Checkpoints are stored for every sink.
+    """
+
+    def __init__(self, sinks: list):
+        self.sinks = sinks
+        self.name = TEE_SEPARATOR.join(sink.name for sink in sinks)
+
+    def write(self, service: str, data: str, stream: int = 0) -> int:
+        """
+        Returns after the data is written to all sinks.
+        Returns the total number of bytes written.
+        """
+        return sum(sink.write(service, data, stream) for sink in self.sinks)
+
+
+class RateLimitedSink:
+    """
+    Delays writes to `sink` to limit the number of written points per second.
+    """
+
+    def __init__(self, sink, limiter: RateLimiter):
+        self.sink = sink
+        self.name = sink.name
+        self.limiter = limiter
+
+    def write(self, service: str, data: str, stream: int = 0) -> int:
+        self.limiter.acquire(data.count('\n'))
+        return self.sink.write(service, data, stream)
+
+
+def _make_sink(
+    targets: List[str],
+    date: str,
+    duration: str,
+    gzip_level: int = 0,
+    victoria_api: str = 'write',
+    compression: str = 'gzip',
+    max_file_bytes: Optional[int] = FILE_MAX_BYTES,
+    max_file_lines: Optional[int] = None,
+    max_rate: Optional[int] = None,
+):
+    sinks = []
+    for target in dict.fromkeys(targets):
+        if target == 'victoria':
+            sinks.append(VictoriaSink(gzip_level, victoria_api))
+        elif target == 'file':
+            sinks.append(FileSink(date, duration, compression, max_file_bytes, max_file_lines))
+        else:
+            raise ValueError(f'Invalid target: {target}')
+
+    sink = sinks[0] if len(sinks) == 1 else TeeSink(sinks)
+    if max_rate:
+        return RateLimitedSink(sink, RateLimiter(max_rate))
+    return sink
+
+
+def _copy_influx_measurement(
+    service: str,
+    duration: str,
+    sink: Union[VictoriaSink, FileSink],
+    offset: int = 0,
+    resume: bool = True,
+    sizer: Optional[BatchSizer] = None,
+    windows: int = 1,
+    progress: Optional[Progress] = None,
+    stats: Optional[InfluxStats] = None,
+    policy: str = DEFAULT_POLICY,
+    newest_first: bool = False,
+    stop: Optional[Event] = None,
+    container: str = MIGRATE_CONTAINER,
+):
+    """
+    Export measurement in retention policy `policy` from Influx, and copy/import to `sink`.
+    This requires an InfluxDB docker container with name `container`
+    to have been started.
+
+    Reading from Influx and writing to `sink` is pipelined:
+    the next batch is queried and converted while the current batch is written.
+
+    If `windows` > 1, the measurement is split in multiple time windows,
+    and the windows are exported concurrently.
+    When writing to file, every window is written to a separate file.
+    Windows are not used if an `offset` is given.
+
+    After every written batch, a checkpoint with the last exported timestamp
+    for each window is stored.
+    If `resume` is set, and no explicit `offset` is given,
+    the export continues from the checkpoint.
+    The checkpoint is ignored if it was made with a different duration, order, or number of windows.
+
+    If no `sizer` is set, batch size is adjusted using default settings.
+    Progress is reported to `progress`, or to a new Progress object.
+
+    `stats` are the pre-flight point count and time range for the measurement.
+    They are fetched if not set. Measurements without points are skipped.
+
+    If `newest_first` is set, windows are paginated from new to old,
+    and the newest window is started first.
+
+    If `stop` is set, all windows stop after their current batch.
+
+    Data from other policies than DEFAULT_POLICY is tagged with the policy name.
+    Its checkpoint, progress, and files are named '{service}@{policy}'.
+    """
+    key = _policy_key(service, policy)
+    duration_cond = _duration_cond(duration)
+    args = _where(duration_cond)
+    order = 'desc' if newest_first else 'asc'
+
+    stats = stats or _influx_stats(args, f'"{service}"', container, policy).get(service)
+    offset = max(offset, 0)
+    sizer = sizer or BatchSizer()
+    progress = progress or Progress()
+    stop = stop or Event()
+    lock = Lock()
+
+    if not stats:
+        utils.info(f'{key}: no data found')
+        return
+
+    settings = {'duration': duration, 'order': order, 'num_windows': windows}
+    checkpoint = _read_checkpoint(sink.name, key) if resume and not offset else None
+    changed = [k for k, v in settings.items() if checkpoint and checkpoint.get(k) != v]
+    if changed:
+        utils.warn(f'{key}: {", ".join(changed)} changed since the last checkpoint. Starting over...')
+        checkpoint = None
+
+    if checkpoint:
+        state = checkpoint['windows']
+        utils.info(f'{key}: resuming after {sum(w["lines"] for w in state)} exported lines')
+    elif windows > 1 and not offset:
+        state = _influx_windows(stats, windows)
+    else:
+        state = [{'start': None, 'end': None, 'time': None, 'lines': offset}]
+
+    progress.add(key, stats.count, sum(w['lines'] for w in state))
+
+    def copy_window(idx: int, window: dict):
+        start_cond = f'time >= {window["start"]}' if window['start'] is not None else ''
+        end_cond = f'time < {window["end"]}' if window['end'] is not None else ''
+        if newest_first:
+            # Pagination moves the upper bound down
+            bound = ' and '.join(filter(None, [duration_cond, start_cond]))
+            time_cond = f'time < {window["time"]}' if window['time'] is not None else ''
+        else:
+            # Pagination moves the lower bound up
+            bound = end_cond
+            time_cond = f'time > {window["time"]}' if window['time'] is not None else ''
+        query_args = _where(duration_cond, start_cond, time_cond, end_cond)
+        batches = _influx_batches(service, query_args, offset, sizer, bound,
+                                  container, policy, newest_first)
+
+        for batch in _prefetch(batches, PIPELINE_DEPTH):
+            start = monotonic()
+            written = sink.write(key, batch.data, idx)
+
+            with lock:
+                window['time'] = batch.time
+                window['lines'] += batch.count
+                _write_checkpoint(sink.name, key, {'windows': state, **settings})
+
+            progress.update(key,
+                            batch.count,
+                            len(batch.data),
+                            written,
+                            batch.limit,
+                            query=batch.query_s,
+                            convert=batch.convert_s,
+                            upload=monotonic() - start)
+
+            if stop.is_set():
+                return
+
+    if len(state) > 1:
+        # Windows are ordered by time
+        indices = range(len(state))
+        if newest_first:
+            indices = reversed(indices)
+        _run_jobs(copy_window, [(idx, state[idx]) for idx in indices], len(state), stop)
+    else:
+        copy_window(0, state[0])
+
+
+def _parse_duration(duration: str) -> timedelta:
+    """
+    Parses Influx-style durations, such as '30d', '1w' or '1d12h'.
+    """
+    if not DURATION_PATTERN.fullmatch(duration):
+        raise ValueError(f'Invalid duration: {duration}')
+
+    return sum((int(v) * DURATION_UNITS[unit]
+                for v, unit in DURATION_UNIT_PATTERN.findall(duration)),
+               timedelta())
+
+
+def _parse_influx_time(value: str) -> datetime:
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+
+
+def _influx_shards(policy: str = DEFAULT_POLICY, container: str = MIGRATE_CONTAINER) -> List[InfluxShard]:
+    """
+    Fetch all shards in retention policy `policy`, sorted by time.
+    This requires an InfluxDB docker container with name `container`
+    to have been started.
+    """
+    sudo = utils.optsudo()
+    shards = []
+
+    for line in utils.sh_stream(f'{sudo}docker exec {container} influx '
+                                "-execute 'SHOW SHARDS' "
+                                '-format csv'):
+        # name,id,database,retention_policy,shard_group,start_time,end_time,expiry_time,owners
+        values = line.strip().split(',')
+        if len(values) < 7 or values[2:4] != ['brewblox', policy]:
+            continue
+        shards.append(InfluxShard(values[1],
+                                  _parse_influx_time(values[5]),
+                                  _parse_influx_time(values[6])))
+
+    return sorted(shards, key=lambda s: s.start)
+
+
+def _convert_exported_line(line: str, tags: str = '') -> Optional[Tuple[str, str]]:
+    """
+    Converts a line from `influx_inspect export` output.
+    The 'm_' prefix is removed from field keys, and `tags` are added to the series.
+    Returns the unescaped measurement name, and the converted line.
+    Returns None if the line is a comment, or a DDL/DML statement.
+    """
+    if line.startswith('#'):
+        return None
+
+    match = EXPORT_LINE_PATTERN.match(line)
+    if not match:
+        return None
+
+    series, fields, time = match.group('series', 'fields', 'time')
+    measurement = ESCAPED_CHAR_PATTERN.sub(r'\1', MEASUREMENT_PATTERN.match(series).group(0))
+    content = ','.join((
+        f'{key[2:] if key.startswith("m_") else key}={value}'
+        for key, value in EXPORT_FIELD_PATTERN.findall(fields)
+    ))
+    return measurement, f'{series}{tags} {content} {time}\n'
+
+
+def _inspect_batches(
+    start: datetime,
+    end: datetime,
+    measurements: Set[str],
+    sizer: BatchSizer,
+    policy: str = DEFAULT_POLICY,
+    container: str = MIGRATE_CONTAINER,
+) -> Generator[Tuple[str, InfluxBatch], None, None]:
+    """
+    Reads data in `policy` between `start` and `end` from the InfluxDB data files,
+    and yields batches of converted lines for each measurement in `measurements`.
+    Consecutive lines from the same measurement are grouped into a single batch.
+    Reading and converting lines is interleaved, and reported as query time.
+    This requires an InfluxDB docker container with name `container`
+    to have been started.
+    """
+    sudo = utils.optsudo()
+    # Shard end times are exclusive, but the -end argument is inclusive
+    end_arg = (end - timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%S.999999999Z')
+    generator = utils.sh_stream(
+        f'{sudo}docker exec {container} influx_inspect export '
+        '-datadir /var/lib/influxdb/data '
+        '-waldir /var/lib/influxdb/wal '
+        '-database brewblox '
+        f'-retention {policy} '
+        f'-start {start:%Y-%m-%dT%H:%M:%SZ} '
+        f'-end {end_arg} '
+        '-out /dev/stdout')
+
+    tags = _policy_tags(policy)
+    service = None
+    lines = []
+    time = None
+    limit = sizer.size
+    batch_start = monotonic()
+
+    for raw in generator:
+        converted = _convert_exported_line(raw.strip(), tags)
+        if converted is None or converted[0] not in measurements:
+            continue
+
+        name, line = converted
+        if lines and (name != service or len(lines) >= limit):
+            data = ''.join(lines)
+            elapsed = monotonic() - batch_start
+            sizer.update(len(lines), getsizeof(data), elapsed)
+            yield service, InfluxBatch(data, len(lines), time, limit, elapsed)
+            lines = []
+            limit = sizer.size
+            batch_start = monotonic()
+
+        service = name
+        time = line[line.rindex(' ') + 1:-1]
+        lines.append(line)
+
+    if lines:
+        yield service, InfluxBatch(''.join(lines), len(lines), time, limit, monotonic() - batch_start)
+
+
+def _copy_influx_shards(
+    services: List[str],
+    duration: str,
+    sink: Union[VictoriaSink, FileSink],
+    resume: bool = True,
+    sizer: Optional[BatchSizer] = None,
+    progress: Optional[Progress] = None,
+    policy: str = DEFAULT_POLICY,
+    newest_first: bool = False,
+    container: str = MIGRATE_CONTAINER,
+):
+    """
+    Export all data for `services` in retention policy `policy` from the InfluxDB data files,
+    and copy/import to `sink`.
+    This requires an InfluxDB docker container with name `container`
+    to have been started.
+
+    Data files are read by `influx_inspect export`, one shard at a time.
+    This is much faster than paginated queries.
+
+    A checkpoint is stored after every exported shard.
+    If `resume` is set, shards in the checkpoint are skipped.
+    An interrupted shard is exported again in full.
+    If `newest_first` is set, the newest shard is exported first.
+
+    Progress is reported per shard.
+    """
+    checkpoint_name = _policy_key(SHARDS_CHECKPOINT, policy)
+    start = datetime.utcnow() - _parse_duration(duration) if duration else None
+    sizer = sizer or BatchSizer()
+    progress = progress or Progress()
+    checkpoint = {
+        'services': sorted(services),
+        'duration': duration,
+        'shards': [],
+        'lines': 0,
+    }
+
+    if resume:
+        stored = _read_checkpoint(sink.name, checkpoint_name)
+        if stored and [stored['services'], stored['duration']] == [checkpoint['services'], duration]:
+            checkpoint = stored
+            utils.info(f'Resuming after {len(stored["shards"])} exported shards')
+
+    shards = _influx_shards(policy, container)
+    if newest_first:
+        shards.reverse()
+
+    for shard in shards:
+        if shard.id in checkpoint['shards'] or (start and shard.end <= start):
+            continue
+
+        task = _policy_key(f'Shard {shard.id} ({shard.start:%Y-%m-%d} - {shard.end:%Y-%m-%d})', policy)
+        num_lines = 0
+        batches = _inspect_batches(max(shard.start, start or shard.start),
+                                   shard.end,
+                                   set(services),
+                                   sizer,
+                                   policy,
+                                   container)
+        progress.add(task)
+
+        for service, batch in _prefetch(batches, PIPELINE_DEPTH):
+            upload_start = monotonic()
+            written = sink.write(_policy_key(service, policy), batch.data)
+            num_lines += batch.count
+            progress.update(task,
+                            batch.count,
+                            len(batch.data),
+                            written,
+                            batch.limit,
+                            query=batch.query_s,
+                            upload=monotonic() - upload_start)
+
+        checkpoint['shards'].append(shard.id)
+        checkpoint['lines'] += num_lines
+        _write_checkpoint(sink.name, checkpoint_name, checkpoint)
+        progress.done(task)
+
+
+def _last_exported_time(sink_name: str, service: str, stats: InfluxStats) -> int:
+    """
+    Returns the timestamp of the newest point of `service` that was copied to `sink_name`.
+    Falls back to the pre-flight `stats` if no checkpoint is available.
+    Checkpoints of newest-first exports only hold the oldest copied points, and are ignored.
+    """
+    times = [stats.end]
+    checkpoint = _read_checkpoint(sink_name, service)
+    if checkpoint and checkpoint.get('order', 'asc') == 'asc':
+        times += [int(w['time']) for w in checkpoint['windows'] if w['time'] is not None]
+    follow_checkpoint = _read_checkpoint(sink_name, FOLLOW_CHECKPOINT)
+    if follow_checkpoint and service in follow_checkpoint['times']:
+        times.append(follow_checkpoint['times'][service])
+    return max(times)
+
+
+def _follow_influx(
+    last_times: Dict[str, int],
+    sink: Union[VictoriaSink, FileSink],
+    interval: float = FOLLOW_INTERVAL_S,
+    container: str = MIGRATE_CONTAINER,
+    sizer: Optional[BatchSizer] = None,
+    policies: List[str] = [DEFAULT_POLICY],
+):
+    """
+    Polls InfluxDB for points newer than `last_times` for each service,
+    and copies them to `sink`. Runs until interrupted.
+    `last_times` are keyed by `_policy_key()` for each retention policy in `policies`.
+
+    Every poll starts with a single stats query per policy for all measurements.
+    Services are only queried if they have new points.
+    The newest copied timestamp for each service is stored in a checkpoint.
+
+    The first poll scans all points after the oldest time in `last_times`.
+    Later polls only scan points written since the start of the previous poll (minus FOLLOW_MARGIN_S),
+    so idle services do not keep the scanned range large.
+    Points that are written with a timestamp older than that are not copied.
+    """
+    sizer = sizer or BatchSizer()
+    progress = Progress()
+    checkpoint = {'times': dict(last_times)}
+    times = checkpoint['times']
+
+    if not times:
+        return
+
+    utils.info(f'Following {len(times)} services. Polling every {interval}s. Press Ctrl+C to stop...')
+
+    scan_from = min(times.values())
+
+    while True:
+        poll_start = int((datetime.now().timestamp() - FOLLOW_MARGIN_S) * 1e9)
+
+        for policy in policies:
+            stats = _influx_stats(_where(f'time > {scan_from}'), container=container, policy=policy)
+
+            for service, service_stats in stats.items():
+                key = _policy_key(service, policy)
+                time = times.get(key)
+                if time is None or service_stats.end <= time:
+                    continue
+
+                for batch in _influx_batches(service, _where(f'time > {time}'), 0, sizer,
+                                             container=container, policy=policy):
+                    start = monotonic()
+                    written = sink.write(key, batch.data)
+                    times[key] = int(batch.time)
+                    _write_checkpoint(sink.name, FOLLOW_CHECKPOINT, checkpoint)
+                    progress.update(key,
+                                    batch.count,
+                                    len(batch.data),
+                                    written,
+                                    batch.limit,
+                                    query=batch.query_s,
+                                    convert=batch.convert_s,
+                                    upload=monotonic() - start)
+
+        scan_from = max(min(times.values()), poll_start)
+        sleep(interval)
+
+
+def _start_influx_container(nice: bool = False):
+    """
+    Starts a standalone InfluxDB container (MIGRATE_CONTAINER) on the ./influxdb/ dir.
+    If `nice` is set, the container gets a limited share of CPU and disk I/O.
+    """
+    sudo = utils.optsudo()
+    limits = f'--cpus={NICE_CPUS} --cpu-shares={NICE_CPU_SHARES} --blkio-weight={NICE_BLKIO_WEIGHT} ' \
+        if nice else ''
+    utils.info('Starting InfluxDB container...')
+
+    # Stop container in case previous migration was cancelled
+    _stop_influx_container()
+
+    # Start standalone container
+    # We'll communicate using 'docker exec', so no need to publish a port
+    sh(f'{sudo}docker run '
+       '--rm -d '
+       f'--name {MIGRATE_CONTAINER} '
+       f'{limits}'
+       '-v "$(pwd)/influxdb:/var/lib/influxdb" '
+       'influxdb:1.8 '
+       '> /dev/null')
+
+
+def _stop_influx_container():
+    sudo = utils.optsudo()
+    sh(f'{sudo}docker stop {MIGRATE_CONTAINER} > /dev/null', check=False)
+
+
+def _wait_influx_container(container: str):
+    """
+    Does a health check until InfluxDB startup is done.
+    """
+    sudo = utils.optsudo()
+    inner_cmd = 'curl --output /dev/null --silent --fail http://localhost:8086/health'
+    bash_cmd = f'until $({inner_cmd}); do sleep 1 ; done'
+    sh(f"{sudo}docker exec {container} bash -c '{bash_cmd}'")
+
+
+def migrate_influxdb(
+    targets: List[str] = ['victoria'],
+    duration: str = '',
+    services: List[str] = [],
+    offsets: List[Tuple[str, int]] = [],
+    jobs: int = 1,
+    resume: bool = True,
+    batch_size: Optional[int] = None,
+    max_batch_memory: Optional[int] = None,
+    engine: str = 'query',
+    windows: int = 1,
+    gzip_level: int = 1,
+    victoria_api: str = 'write',
+    compression: str = 'gzip',
+    max_file_bytes: Optional[int] = FILE_MAX_BYTES,
+    max_file_lines: Optional[int] = None,
+    follow: bool = False,
+    follow_interval: float = FOLLOW_INTERVAL_S,
+    container: Optional[str] = None,
+    policies: List[str] = [DEFAULT_POLICY],
+    newest_first: bool = False,
+    max_rate: Optional[int] = None,
+    nice: bool = False,
+):
+    """Exports InfluxDB history data.
+
+    The exported data is immediately imported to the new history database,
+    and/or saved to file.
+    If multiple `targets` are set, data is read once, and written to every target.
+    Every target has its own checkpoints.
+
+    If `jobs` > 1, multiple measurements are exported concurrently.
+
+    If `resume` is set, services continue from their last stored checkpoint.
+
+    Query batch size is adjusted per service, unless `batch_size` is set.
+    `max_batch_memory` sets the max size in bytes of a single batch.
+
+    If `windows` > 1, every measurement is split in time windows,
+    and the windows are exported concurrently.
+    `jobs` is reduced if `jobs` * `windows` exceeds MAX_CONCURRENT_QUERIES.
+
+    The 'query' engine reads data from InfluxDB using paginated queries.
+    The 'inspect' engine reads the InfluxDB data files directly.
+    It is much faster, but ignores `jobs`, `offsets`, and `windows`.
+
+    Uploads to Victoria are compressed using `gzip_level`. Level 0 disables compression.
+    `victoria_api` determines whether data is sent as line protocol ('write'),
+    or in the native Victoria JSON format ('import').
+
+    Files are compressed using `compression` ('gzip', 'zstd', or 'none'),
+    and rotated at `max_file_bytes` or `max_file_lines`.
+
+    By default, a temporary InfluxDB container (MIGRATE_CONTAINER) is started on the ./influxdb/ dir.
+    The InfluxDB service must not be running at the same time,
+    as two InfluxDB processes must not use the same data files.
+    If `container` is set, data is read from that running InfluxDB container instead,
+    and no temporary container is started.
+
+    If `follow` is set, the export continues after all historic data is copied.
+    Every `follow_interval` seconds, new points are queried from `container`,
+    and copied. This continues until interrupted.
+    The temporary container does not receive new data, so `follow` requires `container`.
+
+    Data is exported from all retention policies in `policies`.
+    Data from other policies than DEFAULT_POLICY is tagged with its policy name.
+
+    If `newest_first` is set, the newest data is exported first.
+    This makes recent history available while older data is still being exported.
+
+    If the migration is interrupted, running exports stop after their current batch,
+    and the temporary InfluxDB container is stopped.
+
+    If `max_rate` is set, at most `max_rate` points per second are written to the targets.
+    If `nice` is set, the temporary InfluxDB container gets a limited share of CPU and disk I/O,
+    and this process gets a lower CPU priority.
+    This keeps other services responsive, at the cost of a slower migration.
+    """
+    if follow and not container:
+        raise ValueError('Following new data requires a running InfluxDB container')
+
+    opts = utils.ctx_opts()
+    date = datetime.now().strftime('%Y%m%d_%H%M')
+
+    utils.warn('Depending on the amount of data, this may take some hours.')
+    utils.warn('You can use your system as normal while the migration is in progress.')
+    utils.warn('The migration can safely be stopped and restarted or resumed.')
+    utils.warn('For more info, see https://brewblox.netlify.app/dev/migration/influxdb.html')
+
+    if opts.dry_run:
+        utils.info('Dry run. Skipping migration...')
+        return
+
+    if not container and not utils.path_exists('./influxdb/'):
+        utils.info('influxdb/ dir not found. Skipping migration...')
+        return
+
+    sink = _make_sink(targets, date, duration, gzip_level, victoria_api,
+                      compression, max_file_bytes, max_file_lines, max_rate)
+
+    windows = min(windows, MAX_CONCURRENT_QUERIES)
+    if jobs * windows > MAX_CONCURRENT_QUERIES:
+        jobs = max(MAX_CONCURRENT_QUERIES // windows, 1)
+        utils.warn(f'Limiting concurrent queries to {MAX_CONCURRENT_QUERIES}: using {jobs} jobs x {windows} windows')
+
+    temporary = not container
+    container = container or MIGRATE_CONTAINER
+
+    if nice:
+        os.nice(NICE_INCREMENT)
+
+    if temporary:
+        _start_influx_container(nice)
+
+    try:
+        _wait_influx_container(container)
+
+        # Pre-flight scan of all measurements
+        # The results are used for the remainder of the run
+        utils.info('Counting points...')
+        stats = {
+            policy: _influx_stats(_where(_duration_cond(duration)), container=container, policy=policy)
+            for policy in policies
+        }
+        progress = Progress()
+
+        # Determine relevant measurements in each policy
+        # Export all of them if not specified by user
+        # Measurements without points are skipped
+        exports = [(svc, policy)
+                   for policy in policies
+                   for svc in (services or sorted(stats[policy]))]
+        skipped = [_policy_key(svc, policy) for svc, policy in exports if svc not in stats[policy]]
+        exports = [(svc, policy) for svc, policy in exports if svc in stats[policy]]
+
+        if skipped:
+            utils.info(f'No data found for services: {", ".join(skipped)}')
+
+        utils.info(f'Exporting services: {", ".join(_policy_key(svc, policy) for svc, policy in exports)} '
+                   f'({sum(stats[policy][svc].count for svc, policy in exports)} points)')
+
+        for svc, policy in exports:
+            progress.plan(_policy_key(svc, policy), stats[policy][svc].count)
+
+        stop = Event()
+
+        def copy(svc: str, policy: str):
+            offset = next((v for v in offsets if v[0] == svc), ('default', 0))[1]
+            sizer = BatchSizer(batch_size, max_batch_memory)
+            _copy_influx_measurement(svc, duration, sink, offset, resume, sizer, windows, progress,
+                                     stats[policy][svc], policy, newest_first, stop, container)
+            progress.done(_policy_key(svc, policy))
+
+        # Export data and import to target
+        if engine == 'inspect':
+            sizer = BatchSizer(batch_size, max_batch_memory)
+            for policy in policies:
+                policy_services = [svc for svc, p in exports if p == policy]
+                if policy_services:
+                    _copy_influx_shards(policy_services, duration, sink, resume, sizer, progress,
+                                        policy, newest_first, container)
+        elif jobs > 1:
+            # Measurements are independent, and can be exported in parallel
+            _run_jobs(copy, exports, jobs, stop)
+        else:
+            for svc, policy in exports:
+                copy(svc, policy)
+
+        progress.summary()
+
+        if follow:
+            last_times = {
+                _policy_key(svc, policy): _last_exported_time(sink.name,
+                                                              _policy_key(svc, policy),
+                                                              stats[policy][svc])
+                for svc, policy in exports
+            }
+            try:
+                _follow_influx(last_times,
+                               sink,
+                               follow_interval,
+                               container,
+                               BatchSizer(batch_size, max_batch_memory),
+                               policies)
+            except KeyboardInterrupt:
+                utils.info('Stopped following')
+    except KeyboardInterrupt:
+        utils.warn('Migration stopped. Run the command again to resume.')
+    finally:
+        # Stop migration container
+        if temporary:
+            _stop_influx_container()
+
+
+class BucketMismatch(NamedTuple):
+    service: str  # Service name, including policy
+    start: int  # Timestamp of the first point in the bucket
+    end: int  # Timestamp after the last point in the bucket
+    field: str
+    influx_count: int
+    victoria_count: int
+    influx_sum: Optional[float]
+    victoria_sum: Optional[float]
+
+
+def _influx_buckets(
+    service: str,
+    since: int,
+    bucket: str,
+    policy: str = DEFAULT_POLICY,
+    container: str = MIGRATE_CONTAINER,
+) -> Dict[int, Dict[str, Tuple[int, Optional[float]]]]:
+    """
+    Fetch the number of values and the sum of values for every field in `service`,
+    grouped by time buckets of `bucket` duration.
+    Only points at or after `since` are included.
+    Returns {bucket_start: {field: (count, sum)}}.
+    Empty buckets are not included.
+    """
+    sudo = utils.optsudo()
+    query = ' '.join([
+        'SELECT count(*), sum(*)',
+        f'FROM "brewblox"."{policy}"."{service}"',
+        f'WHERE time >= {since}',
+        f'GROUP BY time({bucket}) fill(none)',
+    ])
+    json_result = sh(f'{sudo}docker exec {container} influx '
+                     '-database brewblox '
+                     f"-execute '{query}' "
+                     '-format json',
+                     capture=True)
+
+    buckets = {}
+    for result in json.loads(json_result).get('results', []):
+        for series in result.get('series', []):
+            columns = series['columns']
+            for values in series['values']:
+                fields = buckets.setdefault(values[0], {})
+                for column, value in zip(columns[1:], values[1:]):
+                    func, field = column.split('_', 1)
+                    field = field[2:] if field.startswith('m_') else field
+                    count, total = fields.get(field, (0, None))
+                    if func == 'count':
+                        count = value or 0
+                    else:
+                        total = value
+                    fields[field] = (count, total)
+
+    return {
+        start: {k: v for k, v in fields.items() if v[0]}
+        for start, fields in buckets.items()
+    }
+
+
+def _victoria_time(timestamp: int) -> str:
+    """
+    Formats a ns timestamp as seconds with ms precision.
+    """
+    ms = timestamp // 1000000
+    return f'{ms // 1000}.{ms % 1000:03}'
+
+
+def _victoria_bucket(
+    service: str,
+    start: int,
+    end: int,
+    policy: str = DEFAULT_POLICY,
+) -> Dict[str, Tuple[int, float]]:
+    """
+    Fetch the number of values and the sum of values for every field in `service`,
+    in the time range `start` <= time < `end`.
+    Returns {field: (count, sum)}.
+
+    Raw samples are fetched using the Victoria /api/v1/export endpoint.
+    Rollup functions (eg. count_over_time) drop the metric name,
+    and would not show which field is mismatched.
+    Victoria stores timestamps in ms.
+    """
+    prefix = service + VICTORIA_FIELD_SEPARATOR
+    pattern = re.escape(prefix).replace('\\', '\\\\').replace('"', '\\"')
+    match = f'{{__name__=~"{pattern}.*",policy="{"" if policy == DEFAULT_POLICY else policy}"}}'
+
+    resp = _upload_session().get(f'{utils.host_url()}/victoria/api/v1/export',
+                                 params={
+                                     'match[]': match,
+                                     'start': _victoria_time(start),
+                                     'end': _victoria_time(end - 1000000),
+                                 },
+                                 stream=True,
+                                 timeout=UPLOAD_TIMEOUT_S)
+    resp.raise_for_status()
+
+    fields = {}
+    for line in resp.iter_lines():
+        if not line:
+            continue
+        series = json.loads(line)
+        field = series['metric']['__name__'][len(prefix):]
+        count, total = fields.get(field, (0, 0))
+        fields[field] = (count + len(series['values']), total + sum(series['values']))
+    return fields
+
+
+def _compare_bucket(
+    service: str,
+    start: int,
+    end: int,
+    influx: Dict[str, Tuple[int, Optional[float]]],
+    victoria: Dict[str, Tuple[int, float]],
+) -> List[BucketMismatch]:
+    mismatches = []
+    for field in sorted(set(influx) | set(victoria)):
+        influx_count, influx_sum = influx.get(field, (0, None))
+        victoria_count, victoria_sum = victoria.get(field, (0, None))
+        # Influx does not sum boolean values
+        sums_match = influx_sum is None \
+            or victoria_sum is None \
+            or math.isclose(influx_sum, victoria_sum, rel_tol=VERIFY_REL_TOLERANCE)
+        if influx_count != victoria_count or not sums_match:
+            mismatches.append(BucketMismatch(service, start, end, field,
+                                             influx_count, victoria_count,
+                                             influx_sum, victoria_sum))
+    return mismatches
+
+
+def _format_time(timestamp: int) -> str:
+    return datetime.utcfromtimestamp(timestamp // 1000000000).isoformat() + 'Z'
+
+
+def verify_influxdb(
+    duration: str = '',
+    services: List[str] = [],
+    bucket: str = '1d',
+    jobs: int = 4,
+    container: Optional[str] = None,
+    policies: List[str] = [DEFAULT_POLICY],
+) -> List[BucketMismatch]:
+    """Compares InfluxDB history data with the data in Victoria.
+
+    For every measurement, the number of values and the sum of values of every field
+    is compared per time bucket of `bucket` duration.
+    Buckets are compared using `jobs` concurrent Victoria queries.
+    Only mismatching buckets are reported and returned.
+
+    Mismatching buckets can be exported again using the `start` and `end` timestamps.
+
+    By default, a temporary InfluxDB container (MIGRATE_CONTAINER) is started on the ./influxdb/ dir.
+    If `container` is set, data is read from that running InfluxDB container instead.
+    Data in Victoria is only compared for buckets that contain data in InfluxDB.
+    """
+    opts = utils.ctx_opts()
+
+    if opts.dry_run:
+        utils.info('Dry run. Skipping verification...')
+        return []
+
+    if not container and not utils.path_exists('./influxdb/'):
+        utils.info('influxdb/ dir not found. Skipping verification...')
+        return []
+
+    temporary = not container
+    container = container or MIGRATE_CONTAINER
+    bucket_ns = _parse_duration(bucket) // timedelta(microseconds=1) * 1000
+    since = 0
+    if duration:
+        # Victoria has ms precision: don't split the first ms
+        since = (datetime.now().timestamp() - _parse_duration(duration).total_seconds()) * 1000
+        since = int(since) * 1000000
+
+    if temporary:
+        _start_influx_container()
+
+    try:
+        _wait_influx_container(container)
+
+        utils.info('Counting points...')
+        jobs_args = []
+        for policy in policies:
+            stats = _influx_stats(_where(_duration_cond(duration)), container=container, policy=policy)
+            for svc in (services or sorted(stats)):
+                if svc not in stats:
+                    utils.info(f'No data found for {_policy_key(svc, policy)}')
+                    continue
+                buckets = _influx_buckets(svc, max(since, stats[svc].start), bucket, policy, container)
+                for start, influx in sorted(buckets.items()):
+                    jobs_args.append((svc, policy, max(start, since), start + bucket_ns, influx))
+
+        utils.info(f'Comparing {len(jobs_args)} buckets...')
+        totals = {}
+        mismatches = []
+        lock = Lock()
+
+        def compare(svc: str, policy: str, start: int, end: int, influx: dict):
+            key = _policy_key(svc, policy)
+            victoria = _victoria_bucket(svc, start, end, policy)
+            result = _compare_bucket(key, start, end, influx, victoria)
+            with lock:
+                influx_total, victoria_total = totals.get(key, (0, 0))
+                totals[key] = (influx_total + sum(v[0] for v in influx.values()),
+                               victoria_total + sum(v[0] for v in victoria.values()))
+                mismatches.extend(result)
+
+        _run_jobs(compare, jobs_args, jobs, Event())
+    finally:
+        if temporary:
+            _stop_influx_container()
+
+    for key, (influx_total, victoria_total) in sorted(totals.items()):
+        utils.info(f'{key}: {influx_total} values in InfluxDB, {victoria_total} values in Victoria')
+
+    mismatches.sort()
+    for m in mismatches:
+        if opts.quiet:
+            click.echo(json.dumps({'event': 'mismatch', **m._asdict()}))
+        else:
+            utils.warn(f'{m.service} [{_format_time(m.start)} - {_format_time(m.end)}] ({m.start} - {m.end}) '
+                       f'{m.field}: InfluxDB count={m.influx_count} sum={m.influx_sum}, '
+                       f'Victoria count={m.victoria_count} sum={m.victoria_sum}')
+
+    if mismatches:
+        utils.warn(f'{len(mismatches)} mismatched fields in '
+                   f'{len({(m.service, m.start) for m in mismatches})} buckets')
+    else:
+        utils.info('All buckets match')
+
+    return mismatches
+
+
+def _export_files() -> List[Path]:
+    return sorted(
+        path
+        for ext in FILE_EXTENSIONS.values()
+        for path in Path(FILE_DIR).glob(f'*{ext}')
+    )
+
+
+def _open_export_file(path: Path) -> TextIO:
+    """
+    Opens an exported file for reading.
+    Compression is determined by file extension.
+    """
+    if path.name.endswith(FILE_EXTENSIONS['gzip']):
+        return gzip.open(path, 'rt')
+    if path.name.endswith(FILE_EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise ValueError(f'{path.name}: zstd decompression requires the zstandard package')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True)
+        return io.TextIOWrapper(reader)
+    return open(path)
+
+
+def _file_batches(path: Path) -> Generator[Tuple[str, int, float], None, None]:
+    """
+    Reads an exported file in batches of whole lines.
+    Yields the batch data, its line count, and the time spent reading.
+    """
+    with _open_export_file(path) as f:
+        while True:
+            start = monotonic()
+            lines = f.readlines(IMPORT_BATCH_BYTES)
+            if not lines:
+                return
+            yield ''.join(lines), len(lines), monotonic() - start
+
+
+def _export_file_lines(path: Path) -> Optional[int]:
+    """
+    Returns the line count from the manifest of an exported file, if available.
+    """
+    with suppress(FileNotFoundError, ValueError, KeyError):
+        return json.loads(path.with_name(path.name + '.json').read_text())['lines']
+    return None
+
+
+def import_influxdb_files(
+    files: List[str] = [],
+    jobs: int = 1,
+    resume: bool = True,
+    gzip_level: int = 1,
+    victoria_api: str = 'write',
+):
+    """Imports files exported by `migrate_influxdb` in Victoria.
+
+    If no `files` are set, all files in FILE_DIR are imported.
+    gzip and zstd compressed files are decompressed while reading.
+
+    If `jobs` > 1, multiple files are uploaded concurrently.
+
+    Completed files are stored in a checkpoint.
+    If `resume` is set, completed files are skipped.
+    Partially imported files are imported again in full.
+
+    If the import is interrupted, running uploads stop after their current batch.
+    """
+    opts = utils.ctx_opts()
+
+    if opts.dry_run:
+        utils.info('Dry run. Skipping import...')
+        return
+
+    paths = [Path(f) for f in files] or _export_files()
+    checkpoint = (_read_checkpoint(VictoriaSink.name, IMPORT_CHECKPOINT) if resume else None) or {'files': []}
+    paths = [p for p in paths if p.name not in checkpoint['files']]
+
+    if checkpoint['files']:
+        utils.info(f'Skipping {len(checkpoint["files"])} imported files')
+
+    if not paths:
+        utils.info('No files to import')
+        return
+
+    sink = VictoriaSink(gzip_level, victoria_api)
+    lock = Lock()
+    stop = Event()
+    progress = Progress()
+
+    for path in paths:
+        progress.add(path.name, _export_file_lines(path))
+
+    def copy(path: Path):
+        for data, num_lines, read_s in _prefetch(_file_batches(path), PIPELINE_DEPTH):
+            start = monotonic()
+            written = sink.write(path.name, data)
+            progress.update(path.name,
+                            num_lines,
+                            len(data),
+                            written,
+                            read=read_s,
+                            upload=monotonic() - start)
+            if stop.is_set():
+                return
 
-    utils.info(f'Exporting services: {", ".join(services)}')
+        with lock:
+            checkpoint['files'].append(path.name)
+            _write_checkpoint(VictoriaSink.name, IMPORT_CHECKPOINT, checkpoint)
+        progress.done(path.name)
 
-    # Export data and import to target
-    for svc in services:
-        offset = next((v for v in offsets if v[0] == svc), ('default', 0))[1]
-        _copy_influx_measurement(svc, date, duration, target, offset)
+    if jobs > 1:
+        _run_jobs(copy, [(path,) for path in paths], jobs, stop)
+    else:
+        for path in paths:
+            copy(path)
 
-    # Stop migration container
-    sh(f'{sudo}docker stop influxdb-migrate > /dev/null', check=False)
+    progress.summary()
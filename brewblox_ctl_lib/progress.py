@@ -0,0 +1,218 @@
+"""
+Progress reports for long-running migrations
+"""
+
+import json
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import Optional
+
+import click
+
+from brewblox_ctl_lib import utils
+
+# Rates are calculated over the last RATE_WINDOW_S seconds
+RATE_WINDOW_S = 60
+
+# Known stages are reported in this order
+STAGES = ['read', 'query', 'convert', 'upload']
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02}s'
+    return f'{seconds}s'
+
+
+class RollingRate:
+    """
+    Tracks the rate at which lines and bytes are processed.
+    Only samples from the last `window_s` seconds are used.
+    """
+
+    def __init__(self, window_s: float = RATE_WINDOW_S):
+        self.window_s = window_s
+        self.lines = 0
+        self.bytes = 0
+        self._samples = deque([(monotonic(), 0, 0)])
+
+    def add(self, lines: int, num_bytes: int = 0):
+        now = monotonic()
+        self.lines += lines
+        self.bytes += num_bytes
+        self._samples.append((now, self.lines, self.bytes))
+        # Always keep one sample that is older than the window
+        while len(self._samples) > 2 and self._samples[1][0] < now - self.window_s:
+            self._samples.popleft()
+
+    def rates(self):
+        """
+        Returns lines/sec and bytes/sec.
+        """
+        start, start_lines, start_bytes = self._samples[0]
+        elapsed = max(monotonic() - start, 0.001)
+        return (self.lines - start_lines) / elapsed, (self.bytes - start_bytes) / elapsed
+
+
+class Progress:
+    """
+    Collects and reports the progress of a migration.
+
+    Work is divided in tasks (services, databases, files).
+    If the total number of lines for a task is known, ETA is calculated
+    using the rolling rate of the task.
+    Overall ETA is calculated using the rolling rate of all tasks.
+
+    Time spent in each stage (eg. query, convert, upload) is summed over all threads.
+    Stages are pipelined, so the report shows the relative share of each stage.
+
+    Progress is reported using `utils.info()`.
+    If the --quiet option is used, progress is printed as JSON events instead.
+    Every event has an 'event' field ('start', 'progress', 'done', or 'summary').
+    """
+
+    def __init__(self, window_s: float = RATE_WINDOW_S):
+        self.window_s = window_s
+        self._lock = Lock()
+        self._tasks = {}
+        self._overall = RollingRate(window_s)
+        self._stages = {}
+        self._raw = 0
+        self._written = 0
+        self._start = monotonic()
+
+    def _emit(self, event: dict, message: str):
+        if utils.ctx_opts().quiet:
+            click.echo(json.dumps(event))
+        else:
+            utils.info(message)
+
+    def _new_task(self, total: Optional[int] = None, done: int = 0) -> dict:
+        return {
+            'total': total,
+            'done': done,
+            'rate': RollingRate(self.window_s),
+        }
+
+    def _task_eta(self, task: dict) -> Optional[float]:
+        lines_per_sec = task['rate'].rates()[0]
+        if task['total'] is None or not lines_per_sec:
+            return None
+        return max(task['total'] - task['done'], 0) / lines_per_sec
+
+    def _overall_eta(self) -> Optional[float]:
+        lines_per_sec = self._overall.rates()[0]
+        if not lines_per_sec or any(t['total'] is None for t in self._tasks.values()):
+            return None
+        return sum(max(t['total'] - t['done'], 0) for t in self._tasks.values()) / lines_per_sec
+
+    def _stage_shares(self) -> dict:
+        busy = sum(self._stages.values())
+        keys = [k for k in STAGES if k in self._stages] + [k for k in self._stages if k not in STAGES]
+        return {k: round(self._stages[k] / busy, 3) if busy else 0 for k in keys}
+
+    def plan(self, task: str, total: Optional[int] = None):
+        """
+        Registers a task that is started later.
+        Planned tasks are included in the overall ETA.
+        """
+        with self._lock:
+            self._tasks[task] = self._new_task(total)
+
+    def add(self, task: str, total: Optional[int] = None, done: int = 0):
+        """
+        Registers a task.
+        `done` is the number of lines processed in a previous run.
+        """
+        with self._lock:
+            self._tasks[task] = self._new_task(total, done)
+        self._emit({'event': 'start', 'task': task, 'total': total, 'done': done},
+                   f'{task}: started ({done}/{total if total is not None else "?"} lines)')
+
+    def update(self,
+               task: str,
+               lines: int,
+               raw: int = 0,
+               written: Optional[int] = None,
+               batch_size: Optional[int] = None,
+               **stages: float):
+        """
+        Reports that `lines` lines with a size of `raw` bytes were processed.
+        `written` is the number of bytes sent or stored after compression.
+        `batch_size` is the number of lines requested for the batch, if applicable.
+        Keyword arguments are the seconds spent in each stage.
+        """
+        written = raw if written is None else written
+
+        with self._lock:
+            if task not in self._tasks:
+                self._tasks[task] = self._new_task()
+            state = self._tasks[task]
+            state['done'] += lines
+            state['rate'].add(lines, written)
+            self._overall.add(lines, written)
+            self._raw += raw
+            self._written += written
+            for k, v in stages.items():
+                self._stages[k] = self._stages.get(k, 0) + v
+
+            lines_per_sec, bytes_per_sec = self._overall.rates()
+            event = {
+                'event': 'progress',
+                'task': task,
+                'done': state['done'],
+                'total': state['total'],
+                'batch_size': batch_size,
+                'lines_per_sec': round(lines_per_sec, 1),
+                'bytes_per_sec': round(bytes_per_sec, 1),
+                'raw_bytes': self._raw,
+                'written_bytes': self._written,
+                'eta_s': self._task_eta(state),
+                'overall_eta_s': self._overall_eta(),
+                'stages': self._stage_shares(),
+            }
+
+        total = event['total'] if event['total'] is not None else '?'
+        stage_msg = ' '.join(f'{k} {v:.0%}' for k, v in event['stages'].items())
+        self._emit(event, ' | '.join(filter(None, [
+            f'{task}: {event["done"]}/{total} lines',
+            f'batch size {batch_size}' if batch_size else '',
+            f'{lines_per_sec:.0f} lines/s, {bytes_per_sec / 1e6:.2f} MB/s',
+            f'{event["written_bytes"] / 1e6:.1f}/{event["raw_bytes"] / 1e6:.1f} MB written',
+            f'ETA {format_duration(event["eta_s"])} (all: {format_duration(event["overall_eta_s"])})',
+            stage_msg,
+        ])))
+
+    def done(self, task: str):
+        with self._lock:
+            done = self._tasks[task]['done'] if task in self._tasks else 0
+        self._emit({'event': 'done', 'task': task, 'done': done},
+                   f'{task}: done ({done} lines)')
+
+    def summary(self):
+        with self._lock:
+            elapsed = monotonic() - self._start
+            lines = self._overall.lines
+            event = {
+                'event': 'summary',
+                'tasks': len(self._tasks),
+                'done': lines,
+                'elapsed_s': round(elapsed, 1),
+                'lines_per_sec': round(lines / max(elapsed, 0.001), 1),
+                'raw_bytes': self._raw,
+                'written_bytes': self._written,
+                'stages': self._stage_shares(),
+            }
+        stage_msg = ' '.join(f'{k} {v:.0%}' for k, v in event['stages'].items())
+        self._emit(event, ' | '.join(filter(None, [
+            f'Processed {lines} lines in {format_duration(elapsed)}',
+            f'{event["lines_per_sec"]:.0f} lines/s',
+            f'{event["written_bytes"] / 1e6:.1f}/{event["raw_bytes"] / 1e6:.1f} MB written',
+            stage_msg,
+        ])))
@@ -6,13 +6,15 @@ import json
 import re
 import shlex
 import subprocess
+from functools import wraps
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Generator
+from typing import Callable, Generator
 
 import click
 import yaml
 from brewblox_ctl import utils
+from click.globals import pop_context, push_context
 from configobj import ConfigObj
 
 from brewblox_ctl_lib import const
@@ -142,6 +144,27 @@ def sh_stream(cmd: str) -> Generator[str, None, None]:
             yield output
 
 
+def with_ctx(func: Callable) -> Callable:
+    """
+    Binds the current Click context to `func`.
+    Click keeps its context stack in thread-local storage,
+    so functions submitted to a thread pool can't otherwise call ctx_opts().
+    """
+    ctx = click.get_current_context(silent=True)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if ctx is None:
+            return func(*args, **kwargs)
+        push_context(ctx)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            pop_context()
+
+    return wrapper
+
+
 def pip_install(*libs):
     user = getenv('USER')
     args = '--quiet --upgrade --no-cache-dir ' + ' '.join(libs)
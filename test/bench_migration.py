@@ -0,0 +1,247 @@
+"""
+Benchmarks brewblox_ctl_lib.migration
+
+Run with `python -m test.bench_migration [convert|copy]`
+
+The copy benchmark runs _copy_influx_measurement against synthetic Influx CSV output,
+and uploads to a local HTTP server that imitates /victoria/write.
+No InfluxDB container or Victoria service is required.
+
+Every copy configuration runs in a new process, so peak RSS is measured per configuration.
+It includes the generated input data.
+"""
+
+import gzip
+import multiprocessing
+import random
+import re
+import resource
+import sys
+import tempfile
+import timeit
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import monotonic
+from unittest.mock import patch
+
+from brewblox_ctl_lib import migration, utils
+from brewblox_ctl_lib.progress import Progress
+
+START_NS = 1626096480000000000
+INTERVAL_NS = 60000000000
+
+
+def csv_block(num_fields: int, num_rows: int, sparsity: float):
+    """
+    Generates Influx CSV output for a single query.
+    A `sparsity` fraction of fields never has a value.
+    """
+    rand = random.Random(0)
+    headers = 'name,time,' + ','.join(f'm_Field {i}[degC]' for i in range(num_fields))
+    active = [rand.random() >= sparsity for _ in range(num_fields)]
+    rows = [
+        f'spark-one,{START_NS + i * INTERVAL_NS},'
+        + ','.join(f'{rand.random() * 100:.3f}' if a else '' for a in active)
+        for i in range(num_rows)
+    ]
+    return headers, rows
+
+
+def legacy_convert(headers, rows):
+    """
+    Row-by-row conversion, as used before batch conversion was introduced.
+    """
+    fields = [
+        f[2:].replace(' ', '\\ ')
+        for f in headers.split(',')[2:]
+    ]
+    lines = []
+    for line in rows:
+        values = line.strip().split(',')
+        content = ','.join((
+            f'{f}={v}'
+            for f, v in zip(fields, values[2:])
+            if v
+        ))
+        lines.append(f'{values[0]} {content} {values[1]}\n')
+    return ''.join(lines)
+
+
+def batch_convert(headers, rows):
+    return migration._convert_csv_batch(headers, rows)[0]
+
+
+def rows_per_sec(func, headers, rows, repeat=5):
+    elapsed = min(timeit.repeat(lambda: func(headers, rows), number=1, repeat=repeat))
+    return len(rows) / elapsed
+
+
+def bench_convert():
+    print('CSV to line protocol conversion (rows/sec)')
+    print(f'{"fields":>8} {"sparsity":>9} {"before":>10} {"after":>10} {"ratio":>6}')
+    for num_fields, sparsity in [(5, 0), (50, 0.5), (200, 0.5), (200, 0.9)]:
+        headers, rows = csv_block(num_fields, 5000, sparsity)
+        assert legacy_convert(headers, rows) == batch_convert(headers, rows)
+        before = rows_per_sec(legacy_convert, headers, rows)
+        after = rows_per_sec(batch_convert, headers, rows)
+        print(f'{num_fields:>8} {sparsity:>9} {before:>10.0f} {after:>10.0f} {after / before:>6.2f}')
+
+
+class InfluxImitation:
+    """
+    Generates Influx CSV output for queries sent by _influx_batches.
+    LIMIT, OFFSET, and time conditions in the query are applied to a synthetic measurement.
+    """
+
+    def __init__(self, num_fields: int, num_rows: int, sparsity: float):
+        self.headers, self.rows = csv_block(num_fields, num_rows, sparsity)
+
+    def _index(self, time: int) -> int:
+        return max(0, min(len(self.rows), -(-(time - START_NS) // INTERVAL_NS)))
+
+    def stats(self, args, measurement, **kwargs):
+        return {'spark-one': migration.InfluxStats(len(self.rows),
+                                                   START_NS,
+                                                   START_NS + (len(self.rows) - 1) * INTERVAL_NS)}
+
+    def sh_stream(self, cmd: str):
+        limit, offset = map(int, re.search(r'LIMIT (\d+) OFFSET (\d+)', cmd).groups())
+        start = 0
+        end = len(self.rows)
+        for op, value in re.findall(r'time (>=|>|<) (\d+)', cmd):
+            if op == '>=':
+                start = max(start, self._index(int(value)))
+            elif op == '>':
+                start = max(start, self._index(int(value) + 1))
+            else:
+                end = min(end, self._index(int(value)))
+        start += offset
+        rows = self.rows[start:min(start + limit, end)]
+        if rows:
+            yield self.headers + '\n'
+            for row in rows:
+                yield row + '\n'
+
+
+class VictoriaImitation(BaseHTTPRequestHandler):
+    """
+    Accepts chunked and gzipped uploads, and counts received lines and bytes.
+    """
+    lock = Lock()
+    stats = Counter()
+
+    def _read_chunked(self) -> bytes:
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_GET(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = self._read_chunked()
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        sent = len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['lines'] += body.count(b'\n')
+            self.stats['sent'] += sent
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class VictoriaServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BenchProgress(Progress):
+    """
+    Sums stage times, and does not print progress.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stage_s = Counter()
+
+    def update(self, task, lines, raw=0, written=None, batch_size=None, **stages):
+        self.stage_s.update(stages)
+        super().update(task, lines, raw, written, batch_size, **stages)
+
+    def _emit(self, event, message):
+        pass
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is the peak of the whole process, reported in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def copy_measurement(influx: InfluxImitation, port: int, gzip_level: int, windows: int):
+    VictoriaImitation.stats.clear()
+    progress = BenchProgress()
+
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            patch.object(migration, 'CHECKPOINT_DIR', tmpdir), \
+            patch.object(migration, '_influx_stats', influx.stats), \
+            patch.object(utils, 'sh_stream', influx.sh_stream), \
+            patch.object(utils, 'optsudo', return_value=''), \
+            patch.object(utils, 'host_url', return_value=f'http://127.0.0.1:{port}'):
+        start = monotonic()
+        migration._copy_influx_measurement('spark-one',
+                                           '',
+                                           migration.VictoriaSink(gzip_level),
+                                           windows=windows,
+                                           progress=progress)
+        elapsed = monotonic() - start
+
+    assert VictoriaImitation.stats['lines'] == len(influx.rows)
+    return elapsed, progress.stage_s
+
+
+def measure_copy(num_fields: int, sparsity: float, num_rows: int, gzip_level: int, windows: int):
+    """
+    Runs a single copy configuration. Called in a new process.
+    """
+    server = VictoriaServer(('127.0.0.1', 0), VictoriaImitation)
+    Thread(target=server.serve_forever, daemon=True).start()
+    influx = InfluxImitation(num_fields, num_rows, sparsity)
+    elapsed, stage_s = copy_measurement(influx, server.server_address[1], gzip_level, windows)
+    server.shutdown()
+    return elapsed, stage_s, VictoriaImitation.stats['sent'], peak_rss_mb()
+
+
+def bench_copy():
+    print('Influx to Victoria copy (_copy_influx_measurement)')
+    print(f'{"fields":>8} {"sparsity":>9} {"rows":>8} {"gzip":>5} {"windows":>8} '
+          f'{"rows/sec":>10} {"MB sent":>8} {"peak RSS":>9} {"query":>7} {"convert":>8} {"upload":>7}')
+
+    for num_fields, sparsity, num_rows in [(5, 0, 100000), (50, 0.5, 100000), (200, 0.9, 50000)]:
+        for gzip_level, windows in [(0, 1), (1, 1), (1, 4)]:
+            # A spawned process does not inherit the memory of this process
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                elapsed, stage_s, sent, rss = executor.submit(
+                    measure_copy, num_fields, sparsity, num_rows, gzip_level, windows).result()
+            print(f'{num_fields:>8} {sparsity:>9} {num_rows:>8} {gzip_level:>5} {windows:>8} '
+                  f'{num_rows / elapsed:>10.0f} {sent / 1e6:>8.1f} '
+                  f'{rss:>7.0f}MB '
+                  f'{stage_s["query"]:>6.2f}s {stage_s["convert"]:>7.2f}s {stage_s["upload"]:>6.2f}s')
+
+
+if __name__ == '__main__':
+    benchmarks = sys.argv[1:] or ['convert', 'copy']
+    if 'convert' in benchmarks:
+        bench_convert()
+    if 'copy' in benchmarks:
+        bench_copy()
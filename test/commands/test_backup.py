@@ -195,14 +195,118 @@ def test_save_backup(mocker, m_utils, f_read_compose):
     m_zipfile.assert_called_once_with(
         matching(r'^backup/brewblox_backup_\d{8}_\d{4}.zip'), 'w', zipfile.ZIP_DEFLATED)
     m_zipfile.return_value.write.assert_any_call('docker-compose.yml')
-    assert m_zipfile.return_value.writestr.call_args_list == [
-        call('global.redis.json', json.dumps(redis_data())),
-        call('spark-one.spark.json', json.dumps(blocks_data())),
+    # Results are written in order of arrival
+    assert sorted(m_zipfile.return_value.open.call_args_list) == [
+        call('global.redis.json', 'w'),
+        call('spark-one.spark.json', 'w'),
     ]
     # wait, get datastore, get spark
     assert len(httpretty.latest_requests()) == 3
 
 
+@httpretty.activate(allow_net_connect=False)
+def test_save_backup_archive(mocker, m_utils, m_glob, f_read_compose, tmp_path, monkeypatch):
+    set_responses()
+    monkeypatch.chdir(tmp_path)
+    mocker.patch(TESTED + '.BACKUP_CHUNK_SIZE', 10)
+    m_glob.return_value = []
+    (tmp_path / '.env').write_text('BREWBLOX_RELEASE=edge')
+
+    invoke(backup.save, '--no-save-compose')
+
+    fname = next((tmp_path / 'backup').iterdir())
+    with zipfile.ZipFile(fname) as zipf:
+        assert sorted(zipf.namelist()) == ['.env', 'global.redis.json', 'spark-one.spark.json']
+        assert json.loads(zipf.read('global.redis.json')) == redis_data()
+        assert json.loads(zipf.read('spark-one.spark.json')) == blocks_data()
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_save_backup_incremental(mocker, m_utils, m_sh, m_glob, f_read_compose, tmp_path, monkeypatch):
+    set_responses()
+    monkeypatch.chdir(tmp_path)
+    m_glob.return_value = []
+    (tmp_path / '.env').write_text('BREWBLOX_RELEASE=edge')
+    m_echo = mocker.patch(TESTED + '.click.echo')
+
+    invoke(backup.save, '--no-save-compose --incremental')
+
+    manifest = m_echo.call_args[0][0]
+    assert manifest.endswith('.manifest.json')
+    assert (tmp_path / 'backup' / 'chunks').is_dir()
+    assert not list((tmp_path / 'backup').glob('*.zip'))
+
+    # Load from manifest
+    m_tmp = mocker.patch(TESTED + '.NamedTemporaryFile', wraps=backup.NamedTemporaryFile)
+    m_show = m_utils.show_data
+    invoke(backup.load, f'{manifest} --no-update')
+    assert m_tmp.call_count == 3  # .env, datastore, spark
+    assert m_show.call_args_list[1][0][0] == redis_data()
+    assert m_show.call_args_list[2][0][0] == blocks_data()
+
+
+def test_save_backup_keep(mocker, m_zipf, m_utils, f_read_compose):
+    mocker.patch(TESTED + '.mkdir')
+    mocker.patch(TESTED + '.http.wait')
+    mocker.patch(TESTED + '.requests.post')
+    m_prune = mocker.patch(TESTED + '.backup_store.prune')
+    m_prune.return_value = ([], 0)
+
+    invoke(backup.save)
+    assert m_prune.call_count == 0
+
+    m_utils.ctx_opts.return_value.dry_run = False
+    invoke(backup.save, '--keep 24h --keep 7d --keep 4w --keep 12h')
+    m_prune.assert_called_once_with('backup', {'h': 12, 'd': 7, 'w': 4}, False)
+
+    invoke(backup.save, '--keep 24x', _err=True)
+
+
+def test_prune_backup(mocker, m_utils):
+    m_prune = mocker.patch(TESTED + '.backup_store.prune')
+    m_prune.return_value = (['backup/brewblox_backup_20211010_1010.zip'], 10)
+    m_utils.info = mocker.Mock()
+
+    m_utils.ctx_opts.return_value.dry_run = True
+    invoke(backup.prune, '--keep 7d')
+    m_utils.confirm_mode.assert_called_once()
+    m_prune.assert_called_once_with('backup', {'d': 7}, True)
+    assert [c[0][0] for c in m_utils.info.call_args_list] == [
+        'Dry run. Backups are not removed.',
+        'Removing backup/brewblox_backup_20211010_1010.zip',
+        'Removed 1 backups and 10 unused chunks',
+        'Done!',
+    ]
+
+    invoke(backup.prune, _err=True)
+
+
+def test_save_backup_concurrent(mocker, m_zipf, m_utils, f_read_compose):
+    mocker.patch(TESTED + '.mkdir')
+    mocker.patch(TESTED + '.http.wait')
+    m_utils.read_compose.return_value['services']['spark-two'] = {
+        'image': 'brewblox/brewblox-devcon-spark:rpi-edge',
+    }
+    m_post = mocker.patch(TESTED + '.requests.post')
+    m_post.return_value.iter_content.return_value = [b'{', b'}']
+
+    invoke(backup.save, '--timeout=5')
+    assert sorted(c[0][0] for c in m_post.call_args_list) == [
+        STORE_URL + '/mget',
+        HOST_URL + '/spark-one/blocks/backup/save',
+        HOST_URL + '/spark-two/blocks/backup/save',
+    ]
+    assert all(c[1]['timeout'] == 5 for c in m_post.call_args_list)
+    assert all(c[1]['stream'] for c in m_post.call_args_list)
+    assert m_zipf.open.call_count == 3
+    assert m_zipf.open.return_value.__enter__.return_value.write.call_count == 6
+    assert m_post.return_value.close.call_count == 3
+
+    # The datastore is always required
+    m_post.return_value.raise_for_status.side_effect = HTTPError
+    invoke(backup.save, '--ignore-spark-error', _err=HTTPError)
+
+
 @httpretty.activate(allow_net_connect=False)
 def test_save_backup_no_compose(mocker, m_zipf, m_utils, f_read_compose):
     set_responses()
@@ -227,9 +331,7 @@ def test_save_backup_spark_err(mocker, m_zipf, m_utils, f_read_compose):
 
     invoke(backup.save, '--no-save-compose', _err=HTTPError)
 
-    assert m_zipfile.return_value.writestr.call_args_list == [
-        call('global.redis.json', json.dumps(redis_data())),
-    ]
+    assert call('spark-one.spark.json', 'w') not in m_zipfile.return_value.open.call_args_list
     # wait, get datastore, get spark
     assert len(httpretty.latest_requests()) == 3
 
@@ -250,8 +352,8 @@ def test_save_backup_ignore_spark_err(mocker, m_zipf, m_utils, f_read_compose):
 
     invoke(backup.save, '--no-save-compose --ignore-spark-error')
 
-    assert m_zipfile.return_value.writestr.call_args_list == [
-        call('global.redis.json', json.dumps(redis_data())),
+    assert m_zipfile.return_value.open.call_args_list == [
+        call('global.redis.json', 'w'),
     ]
     # wait, get datastore, get spark
     assert len(httpretty.latest_requests()) == 3
@@ -33,5 +33,139 @@ def test_from_influxdb(m_utils, m_migration):
     m_utils.check_config.assert_called_once()
     m_utils.confirm_mode.assert_called_once()
     m_migration.migrate_influxdb.assert_called_once_with(
-        'victoria', '1d', ['s1', 's2'], [('s1', 1000), ('s2', 5000)]
+        ['victoria'], '1d', ['s1', 's2'], [('s1', 1000), ('s2', 5000)], 1, True, None, None, 'query', 1,
+        1, 'write', 'gzip', 100 * 1024 * 1024, None,
+        False, 10, None,
+        ['downsample_1m'], False, None, False
     )
+
+
+def test_from_influxdb_jobs(m_utils, m_migration):
+    invoke(database.from_influxdb, '--duration=1d --jobs=4 --windows=4 --no-resume')
+    m_migration.migrate_influxdb.assert_called_once_with(
+        ['victoria'], '1d', [], [], 4, False, None, None, 'query', 4,
+        1, 'write', 'gzip', 100 * 1024 * 1024, None,
+        False, 10, None,
+        ['downsample_1m'], False, None, False
+    )
+    invoke(database.from_influxdb, '--duration=1d --jobs=0', _err=True)
+
+
+def test_from_influxdb_upload(m_utils, m_migration):
+    invoke(database.from_influxdb, '--duration=1d --gzip-level=0 --victoria-api=import')
+    m_migration.migrate_influxdb.assert_called_once_with(
+        ['victoria'], '1d', [], [], 1, True, None, None, 'query', 1,
+        0, 'import', 'gzip', 100 * 1024 * 1024, None,
+        False, 10, None,
+        ['downsample_1m'], False, None, False
+    )
+    invoke(database.from_influxdb, '--duration=1d --gzip-level=10', _err=True)
+
+
+def test_from_influxdb_files(m_utils, m_migration):
+    invoke(database.from_influxdb,
+           '--target=file --duration=1d --compression=zstd --max-file-size=10 --max-file-lines=1000')
+    m_migration.migrate_influxdb.assert_called_once_with(
+        ['file'], '1d', [], [], 1, True, None, None, 'query', 1,
+        1, 'write', 'zstd', 10 * 1024 * 1024, 1000,
+        False, 10, None,
+        ['downsample_1m'], False, None, False
+    )
+
+
+def test_from_influxdb_targets(m_utils, m_migration):
+    invoke(database.from_influxdb, '--duration=1d --target=victoria --target=file')
+    m_migration.migrate_influxdb.assert_called_once_with(
+        ['victoria', 'file'], '1d', [], [], 1, True, None, None, 'query', 1,
+        1, 'write', 'gzip', 100 * 1024 * 1024, None,
+        False, 10, None,
+        ['downsample_1m'], False, None, False
+    )
+
+    invoke(database.from_influxdb, '--duration=1d --target=space', _err=True)
+
+
+def test_from_influxdb_follow(m_utils, m_migration):
+    invoke(database.from_influxdb, '--duration=1d --follow --follow-interval=60 --container=influx')
+    m_migration.migrate_influxdb.assert_called_once_with(
+        ['victoria'], '1d', [], [], 1, True, None, None, 'query', 1,
+        1, 'write', 'gzip', 100 * 1024 * 1024, None,
+        True, 60, 'influx',
+        ['downsample_1m'], False, None, False
+    )
+    invoke(database.from_influxdb, '--duration=1d --follow --follow-interval=0 --container=influx', _err=True)
+
+    # The temporary container does not receive new data
+    m_migration.migrate_influxdb.reset_mock()
+    invoke(database.from_influxdb, '--duration=1d --follow', _err=True)
+    assert m_migration.migrate_influxdb.call_count == 0
+
+
+def test_from_influxdb_batch_size(m_utils, m_migration):
+    invoke(database.from_influxdb, '--duration=1d --batch-size=1000 --max-batch-memory=8')
+    m_migration.migrate_influxdb.assert_called_once_with(
+        ['victoria'], '1d', [], [], 1, True, 1000, 8 * 1024 * 1024, 'query', 1,
+        1, 'write', 'gzip', 100 * 1024 * 1024, None,
+        False, 10, None,
+        ['downsample_1m'], False, None, False
+    )
+
+
+def test_from_influxdb_engine(m_utils, m_migration):
+    invoke(database.from_influxdb, '--duration=1d --engine=inspect')
+    m_migration.migrate_influxdb.assert_called_once_with(
+        ['victoria'], '1d', [], [], 1, True, None, None, 'inspect', 1,
+        1, 'write', 'gzip', 100 * 1024 * 1024, None,
+        False, 10, None,
+        ['downsample_1m'], False, None, False
+    )
+
+
+def test_from_influxdb_policy(m_utils, m_migration):
+    invoke(database.from_influxdb, '--duration=1d --policy=autogen --policy=downsample_10m --newest-first')
+    m_migration.migrate_influxdb.assert_called_once_with(
+        ['victoria'], '1d', [], [], 1, True, None, None, 'query', 1,
+        1, 'write', 'gzip', 100 * 1024 * 1024, None,
+        False, 10, None,
+        ['autogen', 'downsample_10m'], True, None, False
+    )
+
+
+def test_from_influxdb_throttled(m_utils, m_migration):
+    invoke(database.from_influxdb, '--duration=1d --max-rate=1000 --nice')
+    m_migration.migrate_influxdb.assert_called_once_with(
+        ['victoria'], '1d', [], [], 1, True, None, None, 'query', 1,
+        1, 'write', 'gzip', 100 * 1024 * 1024, None,
+        False, 10, None,
+        ['downsample_1m'], False, 1000, True
+    )
+
+    invoke(database.from_influxdb, '--duration=1d --max-rate=0', _err=True)
+
+
+def test_from_file(m_utils, m_migration, tmp_path):
+    invoke(database.from_file)
+    m_utils.check_config.assert_called_once()
+    m_utils.confirm_mode.assert_called_once()
+    m_migration.import_influxdb_files.assert_called_once_with([], 2, True, 1, 'write')
+
+    fname = tmp_path / 'sparkey__today__all__001.lines.gz'
+    fname.write_bytes(b'')
+    m_migration.import_influxdb_files.reset_mock()
+    invoke(database.from_file, f'--jobs=1 --no-resume --gzip-level=0 {fname}')
+    m_migration.import_influxdb_files.assert_called_once_with([str(fname)], 1, False, 0, 'write')
+
+    invoke(database.from_file, str(tmp_path / 'missing.lines'), _err=True)
+
+
+def test_verify_influxdb(m_utils, m_migration):
+    invoke(database.verify_influxdb)
+    m_utils.check_config.assert_called_once()
+    m_utils.confirm_mode.assert_called_once()
+    m_migration.verify_influxdb.assert_called_once_with('', [], '1d', 4, None, ['downsample_1m'])
+
+    m_migration.verify_influxdb.reset_mock()
+    invoke(database.verify_influxdb,
+           '--duration=30d --bucket=1h --jobs=2 --container=brewblox_influx_1 --policy=autogen spark-one')
+    m_migration.verify_influxdb.assert_called_once_with('30d', ['spark-one'], '1h', 2,
+                                                        'brewblox_influx_1', ['autogen'])
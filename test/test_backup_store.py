@@ -0,0 +1,172 @@
+"""
+Tests brewblox_ctl_lib.backup_store
+"""
+
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from brewblox_ctl_lib import backup_store
+
+
+def response(mocker, content):
+    m = mocker.Mock()
+    m.json.return_value = content
+    return m
+
+
+def test_chunk_store(tmp_path):
+    store = backup_store.ChunkStore(tmp_path / 'chunks')
+    key = store.put(b'data')
+    assert store.put(b'data') == key
+    assert store.put(b'other') != key
+    assert store.get(key) == b'data'
+    assert store.path(key) == tmp_path / 'chunks' / key[:2] / key
+    assert store.added == 3
+    assert store.stored == 2
+
+
+def test_incremental_backup(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / '.env').write_text('BREWBLOX_RELEASE=edge')
+    redis = {'values': [
+        {'id': 'id1', 'namespace': 'n1', 'k': 'v1'},
+        {'id': 'id2', 'namespace': 'n1', 'k': 'v2'},
+    ]}
+    blocks = {'blocks': [{'id': 'b1'}, {'id': 'b2'}], 'store': [{'keys': ['b1', 1]}]}
+
+    backup = backup_store.IncrementalBackup('backup/first' + backup_store.MANIFEST_SUFFIX)
+    backup.write('.env')
+    backup.write_response('global.redis.json', response(mocker, redis))
+    backup.write_response('spark-one.spark.json', response(mocker, dict(blocks)))
+    backup.write_response('other.json', response(mocker, {'k': 'v'}))
+    backup.close()
+    assert backup.store.stored == 7
+
+    # Unchanged data is not stored again
+    redis['values'][0]['k'] = 'changed'
+    backup = backup_store.IncrementalBackup('backup/second' + backup_store.MANIFEST_SUFFIX)
+    backup.write('.env')
+    backup.write_response('global.redis.json', response(mocker, redis))
+    backup.write_response('spark-one.spark.json', response(mocker, dict(blocks)))
+    backup.close()
+    assert backup.store.added == 6
+    assert backup.store.stored == 1
+
+    archive = backup_store.ManifestArchive('backup/first' + backup_store.MANIFEST_SUFFIX)
+    assert sorted(archive.namelist()) == ['.env', 'global.redis.json', 'other.json', 'spark-one.spark.json']
+    assert archive.read('.env') == b'BREWBLOX_RELEASE=edge'
+    assert json.loads(archive.read('global.redis.json'))['values'][0]['k'] == 'v1'
+    assert json.loads(archive.read('spark-one.spark.json')) == blocks
+    assert json.loads(archive.read('other.json')) == {'k': 'v'}
+
+    archive = backup_store.ManifestArchive('backup/second' + backup_store.MANIFEST_SUFFIX)
+    assert json.loads(archive.read('global.redis.json')) == redis
+
+    archive.extractall(str(tmp_path / 'extracted'), members=['.env'])
+    assert (tmp_path / 'extracted' / '.env').read_text() == 'BREWBLOX_RELEASE=edge'
+    (tmp_path / '.env').unlink()
+    archive.extractall()
+    assert (tmp_path / '.env').read_text() == 'BREWBLOX_RELEASE=edge'
+    assert json.loads((tmp_path / 'global.redis.json').read_text()) == redis
+    archive.close()
+
+
+def test_manifest_version(tmp_path):
+    fname = tmp_path / 'backup.manifest.json'
+    fname.write_text(json.dumps({'version': 9001, 'files': {}}))
+    with pytest.raises(ValueError):
+        backup_store.ManifestArchive(str(fname))
+
+
+def test_is_manifest():
+    assert backup_store.is_manifest('backup/brewblox_backup_20211010_1010.manifest.json')
+    assert not backup_store.is_manifest('backup/brewblox_backup_20211010_1010.zip')
+
+
+def test_list_backups(tmp_path):
+    assert backup_store.list_backups(str(tmp_path / 'missing')) == []
+
+    for fname in [
+        'brewblox_backup_20211010_1010.zip',
+        'brewblox_backup_20211010_1110.manifest.json',
+        'brewblox_backup_20211010_1210.tmp',
+        'other.zip',
+    ]:
+        (tmp_path / fname).write_text('')
+
+    assert backup_store.list_backups(str(tmp_path)) == [
+        (datetime(2021, 10, 10, 11, 10), tmp_path / 'brewblox_backup_20211010_1110.manifest.json'),
+        (datetime(2021, 10, 10, 10, 10), tmp_path / 'brewblox_backup_20211010_1010.zip'),
+    ]
+
+
+def test_select_kept():
+    start = datetime(2021, 10, 10)
+    # Hourly backups for 3 weeks, newest first
+    backups = [(start - timedelta(minutes=30 * i), f'b{i}') for i in range(3 * 7 * 48)]
+
+    assert backup_store.select_kept([], {'h': 24}) == set()
+    assert backup_store.select_kept(backups, {}) == {'b0'}
+    assert backup_store.select_kept(backups, {'h': 3}) == {'b0', 'b1', 'b3'}
+    assert backup_store.select_kept(backups, {'d': 2}) == {'b0', 'b1'}
+    assert len(backup_store.select_kept(backups, {'h': 24, 'd': 7, 'w': 4})) == 24 + 6 + 2
+
+
+def test_prune(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / '.env').write_text('BREWBLOX_RELEASE=edge')
+    (tmp_path / 'mosquitto.conf').write_text('listener 1883')
+
+    old = backup_store.IncrementalBackup('backup/brewblox_backup_20211009_1010.manifest.json')
+    old.write('.env')
+    old.write('mosquitto.conf')
+    old.write_response('global.redis.json', response(mocker, {'values': [{'id': 'id1'}]}))
+    old.close()
+
+    (tmp_path / 'mosquitto.conf').write_text('listener 1884')
+    new = backup_store.IncrementalBackup('backup/brewblox_backup_20211010_1010.manifest.json')
+    new.write('.env')
+    new.write('mosquitto.conf')
+    new.close()
+
+    (tmp_path / 'backup' / 'brewblox_backup_20211008_1010.zip').write_text('')
+    unused = old.store.path(old.files['mosquitto.conf']['chunk'])
+
+    # Recently written chunks are not removed
+    assert backup_store.unused_chunks('backup') == []
+    mocker.patch(backup_store.__name__ + '.time').return_value = time.time() + 2 * backup_store.CHUNK_GRACE_S
+    assert backup_store.unused_chunks('backup') == []
+    assert len(backup_store.unused_chunks('backup', {old.manifest})) == 2
+    assert unused in backup_store.unused_chunks('backup', {old.manifest})
+
+    removed, num_chunks = backup_store.prune('backup', {'d': 1}, dry_run=True)
+    assert sorted(p.name for p in removed) == [
+        'brewblox_backup_20211008_1010.zip',
+        'brewblox_backup_20211009_1010.manifest.json',
+    ]
+    assert num_chunks == 2
+    assert unused.exists()
+
+    # Files written in the grace period are not removed
+    recent = unused.parent / 'recent.tmp'
+    recent.write_text('')
+    os.utime(recent, (time.time() + 10 * backup_store.CHUNK_GRACE_S,) * 2)
+
+    removed, num_chunks = backup_store.prune('backup', {'d': 1})
+    assert len(removed) == 2
+    assert num_chunks == 2
+    assert not unused.exists()
+    assert recent.exists()
+
+    # Empty chunk dirs are removed
+    os.utime(recent, (0, 0))
+    assert backup_store.prune('backup', {'d': 1}) == ([], 1)
+    assert not unused.parent.exists()
+    assert [p.name for p in (tmp_path / 'backup').glob('*.json')] == ['brewblox_backup_20211010_1010.manifest.json']
+
+    archive = backup_store.ManifestArchive(str(new.manifest))
+    assert archive.read('.env') == b'BREWBLOX_RELEASE=edge'
+    assert archive.read('mosquitto.conf') == b'listener 1884'
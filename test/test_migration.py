@@ -2,13 +2,19 @@
 Tests brewblox_ctl_lib.migration
 """
 
+import gzip
 import json
+import threading
+import time
+from datetime import datetime, timedelta
 from functools import partial
+from itertools import count
 
 import httpretty
 import pytest
 from brewblox_ctl.testing import check_sudo
-from brewblox_ctl_lib import migration
+from brewblox_ctl_lib import migration, progress
+from requests import ConnectionError, HTTPError, Timeout
 
 TESTED = migration.__name__
 
@@ -16,12 +22,6 @@ TESTED = migration.__name__
 STORE_URL = 'https://localhost/history/datastore'
 
 
-def csv_measurement_stream(cmd):
-    yield 'name,name'
-    yield 'name,s1'
-    yield 'name,s2'
-
-
 def csv_data_stream(opts, cmd):
     if opts.setdefault('calls', 0) < 3:
         opts['calls'] += 1
@@ -35,12 +35,38 @@ def csv_data_stream(opts, cmd):
         return
 
 
+@pytest.fixture(autouse=True)
+def f_checkpoint_dir(mocker, tmp_path):
+    mocker.patch(TESTED + '.CHECKPOINT_DIR', str(tmp_path / 'checkpoints'))
+    return tmp_path / 'checkpoints'
+
+
+@pytest.fixture(autouse=True)
+def f_upload_session():
+    migration._upload_session.cache_clear()
+    yield
+    migration._upload_session.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def m_progress(mocker):
+    m = mocker.patch(progress.__name__ + '.utils')
+    m.ctx_opts.return_value.quiet = False
+    return m
+
+
+@pytest.fixture
+def m_sleep(mocker):
+    return mocker.patch(TESTED + '.sleep')
+
+
 @pytest.fixture
 def m_utils(mocker):
     m = mocker.patch(TESTED + '.utils')
     m.optsudo.return_value = 'SUDO '
     m.getenv.return_value = '/usr/local/bin'
     m.datastore_url.return_value = STORE_URL
+    m.with_ctx.side_effect = lambda f: f
     m.read_compose.side_effect = lambda: {
         'version': '3.7',
         'services': {
@@ -127,7 +153,7 @@ def test_migrate_couchdb_not_found(m_utils, m_sh):
 
 
 @httpretty.activate(allow_net_connect=False)
-def test_migrate_couchdb_empty(m_utils, m_sh, mocker):
+def test_migrate_couchdb_empty(m_utils, m_sh, mocker, f_couchdb_checkpoint):
     m_utils.ctx_opts.return_value.dry_run = False
     httpretty.register_uri(
         httpretty.GET,
@@ -139,8 +165,31 @@ def test_migrate_couchdb_empty(m_utils, m_sh, mocker):
     assert len(httpretty.latest_requests()) == 1
 
 
+@pytest.fixture
+def f_couchdb_checkpoint(mocker, tmp_path):
+    path = tmp_path / 'couchdb-checkpoint.json'
+    mocker.patch(TESTED + '.COUCHDB_CHECKPOINT', str(path))
+    return path
+
+
+def couchdb_docs(ids):
+    def callback(request, uri, headers):
+        params = request.querystring
+        limit = int(params['limit'][0])
+        remaining = sorted(ids)
+        if 'startkey' in params:
+            remaining = [v for v in remaining if v >= json.loads(params['startkey'][0])]
+            remaining = remaining[int(params['skip'][0]):]
+        rows = [
+            {'id': v, 'doc': {'_id': v, '_rev': '1234', 'k': 'v'}}
+            for v in remaining[:limit]
+        ]
+        return [200, headers, json.dumps({'total_rows': len(ids), 'rows': rows})]
+    return callback
+
+
 @httpretty.activate(allow_net_connect=False)
-def test_migrate_couchdb(m_utils, m_sh, mocker):
+def test_migrate_couchdb(m_utils, m_sh, mocker, f_couchdb_checkpoint):
     m_utils.ctx_opts.return_value.dry_run = False
     httpretty.register_uri(
         httpretty.GET,
@@ -151,20 +200,12 @@ def test_migrate_couchdb(m_utils, m_sh, mocker):
     httpretty.register_uri(
         httpretty.GET,
         'http://localhost:5984/brewblox-ui-store/_all_docs',
-        body=json.dumps({'rows': [
-            {'doc': {'_id': 'module__obj', '_rev': '1234', 'k': 'v'}},
-            {'doc': {'_id': 'invalid', '_rev': '1234', 'k': 'v'}},
-        ]}),
-        adding_headers={'ContentType': 'application/json'},
+        body=couchdb_docs(['module__obj', 'invalid']),
     )
     httpretty.register_uri(
         httpretty.GET,
         'http://localhost:5984/spark-service/_all_docs',
-        body=json.dumps({'rows': [
-            {'doc': {'_id': 'spaced__id', '_rev': '1234', 'k': 'v'}},
-            {'doc': {'_id': 'valid', '_rev': '1234', 'k': 'v'}},
-        ]}),
-        adding_headers={'ContentType': 'application/json'},
+        body=couchdb_docs(['spaced__id', 'valid']),
     )
     httpretty.register_uri(
         httpretty.POST,
@@ -175,99 +216,1533 @@ def test_migrate_couchdb(m_utils, m_sh, mocker):
 
     migration.migrate_couchdb()
     assert len(httpretty.latest_requests()) == 5
+    assert json.loads(httpretty.latest_requests()[2].body) == {'values': [
+        {'k': 'v', 'namespace': 'brewblox-ui-store:module', 'id': 'obj'},
+    ]}
+    assert json.loads(httpretty.last_request().body) == {'values': [
+        {'k': 'v', 'namespace': 'spark-service', 'id': 'spaced__id'},
+        {'k': 'v', 'namespace': 'spark-service', 'id': 'valid'},
+    ]}
+
+    # Checkpoint is removed when done
+    assert not f_couchdb_checkpoint.exists()
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_migrate_couchdb_paginated(m_utils, m_sh, mocker, f_couchdb_checkpoint):
+    m_utils.ctx_opts.return_value.dry_run = False
+    mocker.patch(TESTED + '.COUCHDB_PAGE_SIZE', 2)
+    mocker.patch(TESTED + '.MSET_MAX_BYTES', 100)
+    ids = [f'doc{i}' for i in range(5)]
+
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://localhost:5984/_all_dbs',
+        body=json.dumps(['spark-service']),
+    )
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://localhost:5984/spark-service/_all_docs',
+        body=couchdb_docs(ids),
+    )
+    httpretty.register_uri(
+        httpretty.POST,
+        STORE_URL + '/mset',
+        responses=[
+            httpretty.Response(body='{}'),
+            httpretty.Response(body='{}'),
+            httpretty.Response(body='{}'),
+            httpretty.Response(body='{}', status=500),
+        ])
+
+    # Interrupted after the first page
+    with pytest.raises(HTTPError):
+        migration.migrate_couchdb()
+
+    reqs = httpretty.latest_requests()
+    queries = [r.querystring for r in reqs if r.method == 'GET'][1:]
+    assert queries[0] == {'include_docs': ['true'], 'limit': ['2']}
+    assert queries[1] == {'include_docs': ['true'], 'limit': ['2'], 'startkey': ['"doc1"'], 'skip': ['1']}
+
+    # Documents are sent in chunks of at most MSET_MAX_BYTES
+    bodies = [json.loads(r.body) for r in reqs if r.method == 'POST']
+    assert [len(b['values']) for b in bodies] == [1, 1, 1, 1]
+
+    assert json.loads(f_couchdb_checkpoint.read_text()) == {
+        'spark-service': {'cursor': 'doc1', 'docs': 2, 'done': False},
+    }
+
+    # Resume after the last copied page
+    httpretty.reset()
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://localhost:5984/_all_dbs',
+        body=json.dumps(['spark-service']),
+    )
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://localhost:5984/spark-service/_all_docs',
+        body=couchdb_docs(ids),
+    )
+    httpretty.register_uri(httpretty.POST, STORE_URL + '/mset', body='{}')
+
+    migration.migrate_couchdb()
+    bodies = [json.loads(r.body) for r in httpretty.latest_requests() if r.method == 'POST']
+    assert [v['id'] for b in bodies for v in b['values']] == ['doc2', 'doc3', 'doc4']
+    assert not f_couchdb_checkpoint.exists()
 
 
-def test_influx_measurements(m_utils):
-    m_utils.sh_stream.side_effect = csv_measurement_stream
+@httpretty.activate(allow_net_connect=False)
+def test_migrate_couchdb_done(m_utils, m_sh, mocker, f_couchdb_checkpoint):
+    m_utils.ctx_opts.return_value.dry_run = False
+    f_couchdb_checkpoint.write_text(json.dumps({
+        'spark-service': {'cursor': 'doc1', 'docs': 2, 'done': True},
+    }))
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://localhost:5984/_all_dbs',
+        body=json.dumps(['spark-service']),
+    )
+
+    migration.migrate_couchdb()
+    assert len(httpretty.latest_requests()) == 1
+    assert 'spark-service: already migrated' in [c[0][0] for c in m_utils.info.call_args_list]
 
-    assert migration._influx_measurements() == ['s1', 's2']
 
+def test_mset_chunks(mocker):
+    mocker.patch(TESTED + '.MSET_MAX_BYTES', 30)
+    docs = [{'id': 'a'}, {'id': 'b'}, {'id': 'c' * 100}, {'id': 'd'}]
+    assert [(json.loads(body)['values'], count) for body, count in migration._mset_chunks(docs)] == [
+        ([{'id': 'a'}, {'id': 'b'}], 2),
+        ([{'id': 'c' * 100}], 1),
+        ([{'id': 'd'}], 1),
+    ]
+    assert list(migration._mset_chunks([])) == []
 
-def test_influx_line_count(m_utils, m_sh):
-    m_sh.return_value = \
-        '{"results":[{"series":[{"name":"spark-one","columns":["time","count"],"values":[[0,825518]]}]}]}'
-    assert migration._influx_line_count('spark-one', '') == 825518
+
+def stats_result(*stats):
+    return json.dumps({'results': [
+        {'series': [
+            {'name': name, 'columns': ['time', 'count_k1', 'count_k2'], 'values': [[0, count, None]]}
+            for name, count, _, _ in stats
+        ]},
+        {'series': [
+            {'name': name, 'columns': ['time', 'm_k1'], 'values': [[start, 1]]}
+            for name, _, start, _ in stats
+        ]},
+        {'series': [
+            {'name': name, 'columns': ['time', 'm_k1'], 'values': [[end, 1]]}
+            for name, _, _, end in stats
+        ]},
+    ]})
+
+
+def test_influx_stats(m_utils, m_sh):
+    m_sh.return_value = stats_result(
+        ('sparkey', 1000, 1000, 5000),
+        ('plaato', 0, 1000, 5000),
+    )
+    assert migration._influx_stats('WHERE time > now() - 1d') == {
+        'sparkey': migration.InfluxStats(1000, 1000, 5000),
+    }
+    assert m_sh.call_count == 1
+    assert '"brewblox"."downsample_1m"./.*/ WHERE time > now() - 1d ORDER BY time ASC LIMIT 1; SELECT' \
+        in m_sh.call_args[0][0]
 
     m_sh.return_value = '{"results":[{}]}'
-    assert migration._influx_line_count('spark-one', '') is None
+    assert migration._influx_stats() == {}
+
+    m_sh.return_value = '{}'
+    assert migration._influx_stats('', '"sparkey"') == {}
+    assert 'count(*) FROM "brewblox"."downsample_1m"."sparkey"' in m_sh.call_args[0][0]
+
+    migration._influx_stats(policy='autogen')
+    assert 'count(*) FROM "brewblox"."autogen"./.*/' in m_sh.call_args[0][0]
+
+
+def test_policy_key():
+    assert migration._policy_key('sparkey', 'downsample_1m') == 'sparkey'
+    assert migration._policy_key('sparkey', 'autogen') == 'sparkey@autogen'
+    assert migration._policy_tags('downsample_1m') == ''
+    assert migration._policy_tags('autogen') == ',policy=autogen'
+
+
+def test_prefetch(m_utils):
+    assert list(migration._prefetch(iter(range(10)), 2)) == list(range(10))
+    assert list(migration._prefetch(iter([]), 2)) == []
+
+
+def test_prefetch_error(m_utils):
+    def gen():
+        yield 1
+        raise RuntimeError('boo')
+
+    results = []
+    with pytest.raises(RuntimeError):
+        for v in migration._prefetch(gen(), 2):
+            results.append(v)
+    assert results == [1]
+
+
+def test_prefetch_stopped(m_utils):
+    produced = []
+
+    def gen():
+        for v in count():
+            produced.append(v)
+            yield v
+
+    prefetched = migration._prefetch(gen(), 2)
+    assert next(prefetched) == 0
+    prefetched.close()
+
+    # Producer stops when the consumer is gone
+    time.sleep(0.3)
+    num_produced = len(produced)
+    time.sleep(0.3)
+    assert len(produced) == num_produced
+    assert num_produced <= 5
+
+
+def test_batch_sizer():
+    sizer = migration.BatchSizer()
+    assert sizer.size == migration.QUERY_BATCH_SIZE
+    assert sizer.max_memory == migration.MAX_BATCH_MEMORY
+
+    # Fast batch: grow, but not more than double
+    sizer.update(5000, 1000, 0.1)
+    assert sizer.size == 10000
+    sizer.update(10000, 1000, 0)
+    assert sizer.size == 20000
+
+    # Slow batch: shrink to match target time
+    sizer.update(20000, 1000, migration.BATCH_TARGET_S * 4)
+    assert sizer.size == 5000
+
+    # Large batch: shrink to match max memory
+    sizer.update(5000, sizer.max_memory * 2, 0.1)
+    assert sizer.size == 2500
+
+    # Limited by min/max
+    sizer.update(2500, 1000, 1000)
+    assert sizer.size == migration.MIN_QUERY_BATCH_SIZE
+    sizer.size = migration.MAX_QUERY_BATCH_SIZE
+    sizer.update(sizer.size, 1000, 0)
+    assert sizer.size == migration.MAX_QUERY_BATCH_SIZE
+
+    # Empty batch: no change
+    sizer.update(0, 0, 1)
+    assert sizer.size == migration.MAX_QUERY_BATCH_SIZE
+
+
+def test_batch_sizer_fixed():
+    sizer = migration.BatchSizer(1234, 1000)
+    assert sizer.max_memory == 1000
+    sizer.update(1234, 10000, 100)
+    assert sizer.size == 1234
+
+
+def test_rate_limiter(m_sleep, mocker):
+    m_monotonic = mocker.patch(TESTED + '.monotonic')
+    m_monotonic.return_value = 100
+    limiter = migration.RateLimiter(1000)
+
+    # The bucket starts full
+    limiter.acquire(1000)
+    assert m_sleep.call_count == 0
+
+    # Larger batches wait until the debt is paid
+    limiter.acquire(2000)
+    m_sleep.assert_called_once_with(2)
+
+    # Tokens are refilled over time
+    # The debt was paid by sleeping 2s
+    m_sleep.reset_mock()
+    m_monotonic.return_value = 102.5
+    limiter.acquire(1000)
+    m_sleep.assert_called_once_with(pytest.approx(0.5))
+
+    # Unlimited
+    m_sleep.reset_mock()
+    limiter = migration.RateLimiter()
+    limiter.acquire(100000)
+    assert m_sleep.call_count == 0
+
+
+def test_influx_batches_sized(m_utils):
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    sizer = migration.BatchSizer(max_memory=1)
+
+    batches = list(migration._influx_batches('sparkey', '', 0, sizer))
+    assert [b.limit for b in batches] == [5000, 500, 500]
+    assert 'LIMIT 500 OFFSET 0' in m_utils.sh_stream.call_args_list[-1][0][0]
+
+
+def test_influx_batches_descending(m_utils):
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+
+    batches = list(migration._influx_batches('sparkey', '', 0, migration.BatchSizer(), 'time >= 1000',
+                                             policy='autogen', descending=True))
+    assert len(batches) == 3
+    assert batches[0].data.startswith('sparkey,policy=autogen k1=10,k2=20,k3=30 ')
+    queries = [c[0][0] for c in m_utils.sh_stream.call_args_list]
+    assert 'FROM "brewblox"."autogen"."sparkey"  ORDER BY time DESC LIMIT' in queries[0]
+    assert 'where time < 1626096480000000003 and time >= 1000 ORDER BY time DESC' in queries[1]
+
+
+def test_influx_batches_empty_rows(m_utils):
+    def stream(cmd):
+        yield 'name,time,m_k1'
+        yield ''
+
+    m_utils.sh_stream.side_effect = stream
+    assert list(migration._influx_batches('sparkey', '', 0, migration.BatchSizer())) == []
+
+
+def test_encode_chunks(mocker):
+    mocker.patch(TESTED + '.UPLOAD_CHUNK_SIZE', 10)
+    assert list(migration._encode_chunks('')) == []
+    assert list(migration._encode_chunks('abcd\nefgh\nijkl\n')) == [
+        b'abcd\nefgh\n',
+        b'ijkl\n',
+    ]
+
+
+def test_convert_csv_batch():
+    headers = 'name,time,m_k1,m_k 2,m_{k3}'
+    rows = [
+        'sparkey,1626096480000000000,10,20,30',
+        'sparkey,1626096480000000001,,21,',
+        'sparkey,1626096480000000002,,,',
+        'sparkey,1626096480000000003,13,23,33',
+        'sparkey,1626096480000000004,14',
+    ]
+    assert migration._convert_csv_batch(headers, rows) == (
+        'sparkey k1=10,k\\ 2=20,{k3}=30 1626096480000000000\n'
+        'sparkey k\\ 2=21 1626096480000000001\n'
+        'sparkey k1=13,k\\ 2=23,{k3}=33 1626096480000000003\n'
+        'sparkey k1=14 1626096480000000004\n',
+        4,
+        '1626096480000000004',
+    )
+    assert migration._convert_csv_batch(headers, rows[:1], ',policy=autogen')[0] == \
+        'sparkey,policy=autogen k1=10,k\\ 2=20,{k3}=30 1626096480000000000\n'
+    assert migration._convert_csv_batch(headers, []) == ('', 0, None)
+
+    # Fields in autogen are not prefixed
+    assert migration._convert_csv_batch('name,time,Sensor/value[degC],m_k1', ['sparkey,1000,10,20']) == (
+        'sparkey Sensor/value[degC]=10,k1=20 1000\n',
+        1,
+        '1000',
+    )
+    assert migration._convert_csv_batch(headers, [rows[2]]) == ('', 0, None)
+
+
+def test_upload_session():
+    session = migration._upload_session()
+    assert session is migration._upload_session()
+    assert session.verify is False
+    adapter = session.get_adapter('https://localhost/victoria/write')
+    assert adapter._pool_maxsize == migration.UPLOAD_POOL_SIZE
+    assert adapter._pool_block is True
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_upload_retry(m_utils, m_sleep):
+    url = 'https://localhost/victoria/write'
+    httpretty.register_uri(
+        httpretty.GET,
+        url,
+        responses=[
+            httpretty.Response(body='', status=503),
+            httpretty.Response(body='', status=502),
+            httpretty.Response(body='', status=204),
+        ],
+    )
+
+    assert migration._upload(url, migration.UploadBody('sparkey k1=1 1626096480000000000\n')) == 33
+    assert len(httpretty.latest_requests()) == 3
+    assert [c[0][0] for c in m_sleep.call_args_list] == [1, 2]
+    assert m_utils.warn.call_count == 2
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_upload_error(m_utils, m_sleep):
+    url = 'https://localhost/victoria/write'
+    httpretty.register_uri(httpretty.GET, url, status=400)
+
+    # Client errors are not retried
+    with pytest.raises(HTTPError):
+        migration._upload(url, migration.UploadBody('data'))
+    assert len(httpretty.latest_requests()) == 1
+
+    httpretty.reset()
+    httpretty.register_uri(httpretty.GET, url, status=500)
+    with pytest.raises(HTTPError):
+        migration._upload(url, migration.UploadBody('data'))
+    assert len(httpretty.latest_requests()) == migration.UPLOAD_ATTEMPTS
+    assert m_sleep.call_count == migration.UPLOAD_ATTEMPTS - 1
+
+
+def test_upload_connection_error(m_utils, m_sleep, mocker):
+    m_session = mocker.patch(TESTED + '._upload_session').return_value
+    m_session.get.side_effect = ConnectionError
+
+    with pytest.raises(ConnectionError):
+        migration._upload('https://localhost/victoria/write', migration.UploadBody('data'))
+    assert m_session.get.call_count == migration.UPLOAD_ATTEMPTS
+
+    m_session.get.reset_mock()
+    m_session.get.side_effect = [Timeout, mocker.Mock()]
+    migration._upload('https://localhost/victoria/write', migration.UploadBody('data'))
+    assert m_session.get.call_count == 2
+
+
+def test_upload_body(mocker):
+    mocker.patch(TESTED + '.UPLOAD_CHUNK_SIZE', 4)
+    data = 'sparkey k1=1 1626096480000000000\n' * 10
+
+    body = migration.UploadBody(data)
+    assert b''.join(body) == data.encode()
+    assert body.size == len(data)
+
+    body = migration.UploadBody(data, 9)
+    compressed = b''.join(body)
+    assert body.size == len(compressed) < len(data)
+    assert b''.join(c for c in body if not c) == b''
+    assert gzip.decompress(compressed).decode() == data
+
+    # Every iteration is a new pass
+    assert b''.join(body) == compressed
+    assert body.size == len(compressed)
+
+
+def test_parse_field_value():
+    assert migration._parse_field_value('1.5') == 1.5
+    assert migration._parse_field_value('-2i') == -2
+    assert migration._parse_field_value('3u') == 3
+    assert migration._parse_field_value('t') == 1
+    assert migration._parse_field_value('false') == 0
+    assert migration._parse_field_value('"text"') is None
+
+
+def test_line_protocol_to_json():
+    data = ''.join([
+        'sparkey k1=1,k\\ 2=2i 1626096480000000000\n',
+        'sparkey k1=1.5,k3="text" 1626096540000000000\n',
+        'spark\\,two,tag=val k1=t 1626096480000000000\n',
+        'invalid\n',
+    ])
+    lines = [json.loads(v) for v in migration._line_protocol_to_json(data).splitlines()]
+    assert lines == [
+        {
+            'metric': {'__name__': 'sparkey/k1'},
+            'values': [1, 1.5],
+            'timestamps': [1626096480000, 1626096540000],
+        },
+        {
+            'metric': {'__name__': 'sparkey/k 2'},
+            'values': [2],
+            'timestamps': [1626096480000],
+        },
+        {
+            'metric': {'__name__': 'spark,two/k1', 'tag': 'val'},
+            'values': [1],
+            'timestamps': [1626096480000],
+        },
+    ]
+    assert migration._line_protocol_to_json('') == ''
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_victoria_sink_import(m_utils):
+    m_utils.host_url.return_value = 'https://localhost'
+    httpretty.register_uri(httpretty.GET, 'https://localhost/victoria/api/v1/import')
+
+    sink = migration.VictoriaSink(gzip_level=0, api='import')
+    assert sink.write('sparkey', 'sparkey k1=1 1626096480000000000\n') > 0
+    assert httpretty.last_request().path == '/victoria/api/v1/import'
 
 
-def test_copy_influx_measurement_file(m_utils, m_sh, mocker):
+def test_copy_influx_measurement_file(m_utils, m_sh, m_progress, mocker, tmp_path):
     m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
-    mocker.patch(TESTED + '.NamedTemporaryFile', wraps=migration.NamedTemporaryFile)
-    mocker.patch(TESTED + '._influx_line_count', return_value=1000)
+    mocker.patch(TESTED + '._influx_stats', return_value={'sparkey': migration.InfluxStats(1000, 1000, 3000)})
+    mocker.patch(TESTED + '.FILE_DIR', str(tmp_path))
 
-    migration._copy_influx_measurement('sparkey', 'today', '1d', 'file')
-    assert m_sh.call_count == 4
+    migration._copy_influx_measurement('sparkey', '1d', migration.FileSink('today', '1d'))
+    assert m_sh.call_count == 1  # mkdir
+    assert 'MB written' in m_progress.info.call_args_list[-1][0][0]
+    assert 'batch size 5000' in m_progress.info.call_args_list[-3][0][0]
+
+    fname = tmp_path / 'sparkey__today__1d__001.lines.gz'
+    with gzip.open(fname, 'rt') as f:
+        lines = f.read().split('\n')
+    assert len(lines) == 3 * 4 + 1
+    assert lines[0] == 'sparkey k1=10,k2=20,k3=30 1626096480000000000'
+
+    manifest = json.loads((tmp_path / 'sparkey__today__1d__001.lines.gz.json').read_text())
+    assert manifest['lines'] == 3 * 4
+    assert manifest['bytes'] == fname.stat().st_size
+    assert manifest['start'] == 1626096480000000000
 
 
 @httpretty.activate(allow_net_connect=False)
 def test_copy_influx_measurement_victoria(m_utils, m_sh, mocker):
     m_utils.host_url.return_value = 'https://localhost'
     m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
-    mocker.patch(TESTED + '.NamedTemporaryFile', wraps=migration.NamedTemporaryFile)
-    mocker.patch(TESTED + '._influx_line_count', return_value=1000)
+    mocker.patch(TESTED + '._influx_stats', return_value={'sparkey': migration.InfluxStats(1000, 1000, 3000)})
 
     httpretty.register_uri(
         httpretty.GET,
         'https://localhost/victoria/write',
     )
 
-    migration._copy_influx_measurement('sparkey', 'today', '1d', 'victoria')
+    migration._copy_influx_measurement('sparkey', '1d', migration.VictoriaSink())
     assert len(httpretty.latest_requests()) == 3
     assert m_sh.call_count == 0
 
+    req = httpretty.last_request()
+    assert req.headers['Transfer-Encoding'] == 'chunked'
+    assert 'Content-Encoding' not in req.headers
+
+    # Compressed upload
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    migration._copy_influx_measurement('sparkey', '1d', migration.VictoriaSink(gzip_level=1), resume=False)
+    req = httpretty.last_request()
+    assert len(httpretty.latest_requests()) == 6
+    assert req.headers['Content-Encoding'] == 'gzip'
+
 
 def test_copy_influx_measurement_empty(m_utils, m_sh, mocker):
     def empty(cmd):
         yield ''
         return
     m_utils.sh_stream.side_effect = empty
-    m_tmp = mocker.patch(TESTED + '.NamedTemporaryFile', wraps=migration.NamedTemporaryFile)
-    mocker.patch(TESTED + '._influx_line_count', return_value=None)
+    m_batches = mocker.patch(TESTED + '._influx_batches')
+    mocker.patch(TESTED + '._influx_stats', return_value={})
+
+    migration._copy_influx_measurement('sparkey', '1d', migration.FileSink('today', '1d'))
+    assert m_batches.call_count == 0
+
+
+def test_checkpoint(f_checkpoint_dir):
+    assert migration._read_checkpoint('file', 'sparkey') is None
+
+    migration._write_checkpoint('file', 'sparkey', {'time': '123', 'lines': 10})
+    migration._write_checkpoint('file', 'sparkey', {'time': '456', 'lines': 20})
+    assert migration._read_checkpoint('file', 'sparkey') == {'time': '456', 'lines': 20}
+    assert migration._read_checkpoint('victoria', 'sparkey') is None
+    assert [p.name for p in f_checkpoint_dir.iterdir()] == ['file__sparkey.json']
+
+    # Corrupt files are ignored
+    (f_checkpoint_dir / 'file__sparkey.json').write_text('{"time')
+    assert migration._read_checkpoint('file', 'sparkey') is None
+
+
+def test_checkpoint_tee(m_utils, f_checkpoint_dir):
+    migration._write_checkpoint('victoria+file', 'sparkey', {'time': '123'})
+    assert sorted(p.name for p in f_checkpoint_dir.iterdir()) == ['file__sparkey.json', 'victoria__sparkey.json']
+    assert migration._read_checkpoint('victoria', 'sparkey') == {'time': '123'}
+    assert migration._read_checkpoint('victoria+file', 'sparkey') == {'time': '123'}
+    assert m_utils.warn.call_count == 0
+
+    # Data was exported to one sink, but not the other
+    migration._write_checkpoint('victoria', 'sparkey', {'time': '456'})
+    assert migration._read_checkpoint('victoria+file', 'sparkey') is None
+    assert 'sparkey: checkpoints for victoria, file are not the same' in m_utils.warn.call_args[0][0]
+
+
+def test_copy_influx_measurement_resume(m_utils, m_sh, mocker, tmp_path):
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    mocker.patch(TESTED + '._influx_stats', return_value={'sparkey': migration.InfluxStats(1000, 1000, 3000)})
+    mocker.patch(TESTED + '.FILE_DIR', str(tmp_path))
+
+    migration._copy_influx_measurement('sparkey', '1d', migration.FileSink('today', '1d'))
+    assert migration._read_checkpoint('file', 'sparkey') == {
+        'windows': [{
+            'start': None,
+            'end': None,
+            'time': '1626096480000000003',
+            'lines': 12,
+        }],
+        'duration': '1d',
+        'order': 'asc',
+        'num_windows': 1,
+    }
+    # The last checkpoint was written after the final batch
+    assert m_utils.sh_stream.call_count == 4
+
+    # Continue from last timestamp
+    m_utils.sh_stream.reset_mock()
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    migration._copy_influx_measurement('sparkey', '1d', migration.FileSink('today', '1d'))
+    assert 'where time > now() - 1d and time > 1626096480000000003 ' \
+        in m_utils.sh_stream.call_args_list[0][0][0]
+    assert migration._read_checkpoint('file', 'sparkey')['windows'][0]['lines'] == 24
+
+    m_utils.sh_stream.reset_mock()
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    # A checkpoint with a different duration is not used
+    migration._copy_influx_measurement('sparkey', '', migration.FileSink('today', ''))
+    assert migration._read_checkpoint('file', 'sparkey')['windows'][0]['lines'] == 12
+    assert 'duration changed' in m_utils.warn.call_args[0][0]
+    assert '"sparkey"  ORDER BY time LIMIT 5000 OFFSET 0' in m_utils.sh_stream.call_args_list[0][0][0]
+
+    # Explicit offsets and --no-resume ignore the checkpoint
+    m_utils.sh_stream.reset_mock()
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    migration._copy_influx_measurement('sparkey', '1d', migration.FileSink('today', '1d'), 4321)
+    assert 'where time > now() - 1d ORDER BY time LIMIT 5000 OFFSET 4321' \
+        in m_utils.sh_stream.call_args_list[0][0][0]
+
+    m_utils.sh_stream.reset_mock()
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    migration._copy_influx_measurement('sparkey', '1d', migration.FileSink('today', '1d'), resume=False)
+    assert 'where time > now() - 1d ORDER BY time LIMIT 5000 OFFSET 0' \
+        in m_utils.sh_stream.call_args_list[0][0][0]
+    assert migration._read_checkpoint('file', 'sparkey')['windows'][0]['lines'] == 12
 
-    migration._copy_influx_measurement('sparkey', 'today', '1d', 'file')
-    assert m_tmp.call_count == 0
 
+def test_influx_windows():
+    assert migration._influx_windows(migration.InfluxStats(10, 1000, 5000), 4) == [
+        {'start': None, 'end': 2000, 'time': None, 'lines': 0},
+        {'start': 2000, 'end': 3000, 'time': None, 'lines': 0},
+        {'start': 3000, 'end': 4000, 'time': None, 'lines': 0},
+        {'start': 4000, 'end': None, 'time': None, 'lines': 0},
+    ]
 
-def test_copy_influx_measurement_error(m_utils, m_sh, mocker):
+    # Duplicate boundaries are removed
+    windows = migration._influx_windows(migration.InfluxStats(10, 1000, 1002), 4)
+    assert [w['start'] for w in windows] == [None, 1001]
+
+    # Single point
+    assert migration._influx_windows(migration.InfluxStats(1, 1000, 1000), 4) == [
+        {'start': None, 'end': None, 'time': None, 'lines': 0},
+    ]
+
+
+def windowed_data_stream(cmd):
+    # Every window returns a single batch
+    if 'time > 1626096480000000003' not in cmd:
+        yield from csv_data_stream({}, cmd)
+
+
+def test_copy_influx_measurement_windows(m_utils, m_sh, mocker, tmp_path):
+    m_utils.sh_stream.side_effect = windowed_data_stream
+    mocker.patch(TESTED + '._influx_stats', return_value={'sparkey': migration.InfluxStats(1000, 1000, 3000)})
+    mocker.patch(TESTED + '.FILE_DIR', str(tmp_path))
+
+    migration._copy_influx_measurement('sparkey', '1d', migration.FileSink('today', '1d', 'none'), windows=2)
+    assert sorted(p.name for p in tmp_path.glob('*.lines')) == [
+        'sparkey__today__1d__001.lines',
+        'sparkey__today__1d__002.lines',
+    ]
+    state = migration._read_checkpoint('file', 'sparkey')['windows']
+    assert [(w['start'], w['end']) for w in state] == [(None, 2000), (2000, None)]
+    assert [w['lines'] for w in state] == [4, 4]
+
+    queries = [c[0][0] for c in m_utils.sh_stream.call_args_list]
+    assert any('where time > now() - 1d and time < 2000 ORDER BY' in q for q in queries)
+    assert any('where time > now() - 1d and time >= 2000 ORDER BY' in q for q in queries)
+    assert any('where time > 1626096480000000003 and time < 2000 ORDER BY' in q for q in queries)
+
+    # Resume uses stored windows
+    m_utils.sh_stream.reset_mock()
+    migration._copy_influx_measurement('sparkey', '1d', migration.FileSink('today', '1d'), windows=2)
+    queries = [c[0][0] for c in m_utils.sh_stream.call_args_list]
+    assert any('where time > now() - 1d and time > 1626096480000000003 and time < 2000 ORDER BY' in q
+               for q in queries)
+    assert len(migration._read_checkpoint('file', 'sparkey')['windows']) == 2
+
+    # A different number of windows starts over
+    m_utils.sh_stream.reset_mock()
+    migration._copy_influx_measurement('sparkey', '1d', migration.FileSink('today', '1d'), windows=4)
+    assert 'num_windows changed' in m_utils.warn.call_args[0][0]
+    assert len(migration._read_checkpoint('file', 'sparkey')['windows']) == 4
+
+
+def test_copy_influx_measurement_newest_first(m_utils, m_sh, mocker, tmp_path):
+    def stream(cmd):
+        # Every window returns a single batch
+        if 'time < 1626096480000000003' not in cmd:
+            yield from csv_data_stream({}, cmd)
+
+    m_utils.sh_stream.side_effect = stream
+    mocker.patch(TESTED + '._influx_stats', return_value={'sparkey': migration.InfluxStats(1000, 1000, 3000)})
+    sink = mocker.Mock(spec=migration.VictoriaSink)
+    sink.name = 'victoria'
+    sink.write.return_value = 10
+
+    migration._copy_influx_measurement('sparkey', '1d', sink, windows=2, policy='autogen', newest_first=True)
+    assert [c[0][0] for c in sink.write.call_args_list] == ['sparkey@autogen'] * 2
+    checkpoint = migration._read_checkpoint('victoria', 'sparkey@autogen')
+    assert checkpoint['order'] == 'desc'
+    assert [w['time'] for w in checkpoint['windows']] == ['1626096480000000003'] * 2
+
+    queries = [c[0][0] for c in m_utils.sh_stream.call_args_list]
+    assert any('where time > now() - 1d and time >= 2000 ORDER BY time DESC' in q for q in queries)
+    assert any('where time > now() - 1d and time < 2000 ORDER BY time DESC' in q for q in queries)
+    assert any('where time < 1626096480000000003 and time > now() - 1d and time >= 2000 ORDER BY' in q
+               for q in queries)
+
+    # Resume continues below the oldest exported time
+    m_utils.sh_stream.reset_mock()
+    migration._copy_influx_measurement('sparkey', '1d', sink, windows=2, policy='autogen', newest_first=True)
+    queries = [c[0][0] for c in m_utils.sh_stream.call_args_list]
+    assert any('where time > now() - 1d and time >= 2000 and time < 1626096480000000003 ORDER BY' in q
+               for q in queries)
+
+    # Checkpoints made in a different order are not used
+    m_utils.sh_stream.reset_mock()
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    migration._copy_influx_measurement('sparkey', '1d', sink, windows=2, policy='autogen')
+    queries = [c[0][0] for c in m_utils.sh_stream.call_args_list]
+    assert any('where time > now() - 1d and time < 2000 ORDER BY time LIMIT' in q for q in queries)
+    assert 'order changed' in m_utils.warn.call_args[0][0]
+    assert migration._read_checkpoint('victoria', 'sparkey@autogen')['order'] == 'asc'
+
+
+def test_copy_influx_measurement_stopped(m_utils, m_sh, mocker):
+    # Data never runs out
+    m_utils.sh_stream.side_effect = lambda cmd: csv_data_stream({}, cmd)
+    mocker.patch(TESTED + '._influx_stats', return_value={'sparkey': migration.InfluxStats(1000, 1000, 3000)})
+    sink = mocker.Mock(spec=migration.VictoriaSink)
+    sink.name = 'victoria'
+    sink.write.return_value = 10
+    stop = migration.Event()
+    stop.set()
+
+    # Windows stop after their current batch
+    migration._copy_influx_measurement('sparkey', '1d', sink, windows=2, stop=stop)
+    assert sink.write.call_count == 2
+
+
+def test_copy_influx_measurement_windows_error(m_utils, m_sh, mocker):
     m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
-    mocker.patch(TESTED + '.NamedTemporaryFile', wraps=migration.NamedTemporaryFile)
-    mocker.patch(TESTED + '._influx_line_count', return_value=1000)
+    mocker.patch(TESTED + '._influx_stats', return_value={'sparkey': migration.InfluxStats(1000, 1000, 3000)})
+    sink = mocker.Mock(spec=migration.VictoriaSink)
+    sink.name = 'victoria'
+    sink.write.side_effect = RuntimeError
+
+    with pytest.raises(RuntimeError):
+        migration._copy_influx_measurement('sparkey', '1d', sink, windows=2)
+    assert migration._read_checkpoint('victoria', 'sparkey') is None
+
+
+def test_make_sink(m_sh):
+    sink = migration._make_sink(['victoria'], 'today', '1d', 5, 'import')
+    assert isinstance(sink, migration.VictoriaSink)
+    assert sink.gzip_level == 5
+    assert sink.api == 'import'
+    assert m_sh.call_count == 0
+
+    sink = migration._make_sink(['file'], 'today', '')
+    assert isinstance(sink, migration.FileSink)
+    assert sink.fname('sparkey', 12) == f'{migration.FILE_DIR}/sparkey__today__all__012.lines.gz'
+    assert m_sh.call_count == 1
+
+    sink = migration._make_sink(['file'], 'today', '', compression='none', max_file_bytes=None, max_file_lines=10)
+    assert sink.fname('sparkey') == f'{migration.FILE_DIR}/sparkey__today__all__001.lines'
+    assert sink.max_bytes is None
+    assert sink.max_lines == 10
+
+    with pytest.raises(ValueError):
+        migration._make_sink(['space magic'], 'today', '1d')
+
+    with pytest.raises(ValueError):
+        migration._make_sink(['victoria'], 'today', '1d', 1, 'space magic')
+
+    sink = migration._make_sink(['victoria'], 'today', '1d', max_rate=100)
+    assert isinstance(sink, migration.RateLimitedSink)
+    assert sink.name == 'victoria'
+    assert sink.limiter.rate == 100
+
+
+def test_make_sink_tee(m_sh):
+    sink = migration._make_sink(['victoria', 'file', 'victoria'], 'today', '1d', max_rate=100)
+    assert isinstance(sink, migration.RateLimitedSink)
+    assert sink.name == 'victoria+file'
+    assert isinstance(sink.sink, migration.TeeSink)
+    assert [type(s) for s in sink.sink.sinks] == [migration.VictoriaSink, migration.FileSink]
+
+
+def test_tee_sink(mocker):
+    m_sinks = [mocker.Mock(), mocker.Mock()]
+    m_sinks[0].name = 'victoria'
+    m_sinks[0].write.return_value = 10
+    m_sinks[1].name = 'file'
+    m_sinks[1].write.return_value = 20
+
+    sink = migration.TeeSink(m_sinks)
+    assert sink.name == 'victoria+file'
+    assert sink.write('sparkey', 'sparkey k1=1 1\n', 2) == 30
+    for m in m_sinks:
+        m.write.assert_called_once_with('sparkey', 'sparkey k1=1 1\n', 2)
+
+
+def test_rate_limited_sink(mocker):
+    m_sink = mocker.Mock()
+    m_sink.name = 'victoria'
+    m_sink.write.return_value = 10
+    m_limiter = mocker.Mock()
+
+    sink = migration.RateLimitedSink(m_sink, m_limiter)
+    assert sink.write('sparkey', 'sparkey k1=1 1\nsparkey k1=2 2\n', 1) == 10
+    m_limiter.acquire.assert_called_once_with(2)
+    m_sink.write.assert_called_once_with('sparkey', 'sparkey k1=1 1\nsparkey k1=2 2\n', 1)
+
+
+def test_file_sink(m_sh, mocker, tmp_path):
+    mocker.patch(TESTED + '.FILE_DIR', str(tmp_path))
+    sink = migration.FileSink('today', '1d', max_lines=4)
+
+    def batch(start, num_lines):
+        return ''.join(f'sparkey k1={v} {v}\n' for v in range(start, start + num_lines))
+
+    assert sink.write('sparkey', '') == 0
+    assert sink.write('sparkey', batch(0, 2)) > 0
+    assert sink.write('sparkey', batch(2, 2)) > 0
+    sink.write('sparkey', batch(4, 1))  # Rotated
+    sink.write('sparkey', batch(100, 10), 1)  # Separate stream, too large for a single file
+    sink.write('sparkey', batch(110, 1), 1)  # Rotated
+
+    manifests = [json.loads(p.read_text()) for p in sorted(tmp_path.glob('*.json'))]
+    assert [(m['file'], m['lines'], m['start'], m['end']) for m in manifests] == [
+        ('sparkey__today__1d__001.lines.gz', 4, 0, 3),
+        ('sparkey__today__1d__002.lines.gz', 1, 4, 4),
+        ('sparkey__today__1d__003.lines.gz', 10, 100, 109),
+        ('sparkey__today__1d__004.lines.gz', 1, 110, 110),
+    ]
+    with gzip.open(tmp_path / 'sparkey__today__1d__001.lines.gz', 'rt') as f:
+        assert f.read() == batch(0, 4)
+
+    # Rotate on size
+    sink = migration.FileSink('yesterday', '', 'none', max_bytes=50)
+    sink.write('sparkey', batch(0, 2))
+    sink.write('sparkey', batch(2, 2))
+    assert (tmp_path / 'sparkey__yesterday__all__001.lines').read_text() == batch(0, 2)
+    assert (tmp_path / 'sparkey__yesterday__all__002.lines').read_text() == batch(2, 2)
+
+    # A new sink (resumed export) does not append to existing files
+    (tmp_path / 'sparkey__yesterday__all__002.lines.json.tmp').write_text('')
+    sink = migration.FileSink('yesterday', '', 'none', max_bytes=50)
+    sink.write('sparkey', batch(4, 2))
+    sink.write('plaato', batch(4, 2))
+    assert (tmp_path / 'sparkey__yesterday__all__002.lines').read_text() == batch(2, 2)
+    assert (tmp_path / 'sparkey__yesterday__all__003.lines').read_text() == batch(4, 2)
+    assert (tmp_path / 'plaato__yesterday__all__001.lines').read_text() == batch(4, 2)
+
+
+def test_file_sink_zstd(m_sh, mocker, tmp_path):
+    mocker.patch(TESTED + '.FILE_DIR', str(tmp_path))
+    m_zstd = mocker.patch(TESTED + '.zstandard')
+    m_zstd.ZstdCompressor.return_value.compress.return_value = b'compressed'
+
+    sink = migration.FileSink('today', '1d', 'zstd')
+    assert sink.write('sparkey', 'sparkey k1=1 1\n') == len(b'compressed')
+    assert (tmp_path / 'sparkey__today__1d__001.lines.zst').read_bytes() == b'compressed'
+
+    mocker.patch(TESTED + '.zstandard', None)
+    with pytest.raises(ValueError):
+        migration.FileSink('today', '1d', 'zstd')
 
     with pytest.raises(ValueError):
-        migration._copy_influx_measurement('sparkey', 'today', '1d', 'space magic')
+        migration.FileSink('today', '1d', 'rar')
 
 
 def test_migrate_influxdb(m_utils, m_sh, mocker):
-    m_meas = mocker.patch(TESTED + '._influx_measurements')
-    m_meas.return_value = ['s1', 's2']
+    m_meas = mocker.patch(TESTED + '._influx_stats')
+    m_meas.return_value = {
+        's1': migration.InfluxStats(10, 1000, 2000),
+        's2': migration.InfluxStats(10, 1000, 2000),
+        's3': migration.InfluxStats(10, 1000, 2000),
+    }
     m_copy = mocker.patch(TESTED + '._copy_influx_measurement')
 
     # Dry run noop
     m_utils.ctx_opts.return_value.dry_run = True
     m_utils.path_exists.return_value = True
-    migration.migrate_influxdb('victoria', '1d', [])
+    migration.migrate_influxdb(['victoria'], '1d', [])
     assert m_meas.call_count == 0
     assert m_copy.call_count == 0
 
     # No influx data dir found
     m_utils.ctx_opts.return_value.dry_run = False
     m_utils.path_exists.return_value = False
-    migration.migrate_influxdb('victoria', '1d', [])
+    migration.migrate_influxdb(['victoria'], '1d', [])
     assert m_meas.call_count == 0
     assert m_copy.call_count == 0
 
     # preconditions OK, services predefined
     m_utils.ctx_opts.return_value.dry_run = False
     m_utils.path_exists.return_value = True
-    migration.migrate_influxdb('victoria', '1d', ['s1', 's2', 's3'])
-    assert m_meas.call_count == 0
-    assert m_copy.call_count == 3
+    migration.migrate_influxdb(['victoria'], '1d', ['s1', 's2', 's4'])
+    assert m_meas.call_count == 1
+    assert m_copy.call_count == 2
+    m_copy.assert_called_with('s2', '1d', mocker.ANY, 0, True, mocker.ANY, 1, mocker.ANY,
+                              migration.InfluxStats(10, 1000, 2000), 'downsample_1m', False, mocker.ANY,
+                              'influxdb-migrate')
+    assert any('No data found for services: s4' in c[0][0] for c in m_utils.info.call_args_list)
 
     # preconditions OK, services wildcard
     m_utils.ctx_opts.return_value.dry_run = False
     m_utils.path_exists.return_value = True
-    migration.migrate_influxdb('victoria', '1d', [])
-    assert m_meas.call_count == 1
-    assert m_copy.call_count == 3 + 2
+    migration.migrate_influxdb(['victoria'], '1d', [])
+    assert m_meas.call_count == 2
+    assert m_copy.call_count == 2 + 3
+
+
+def test_migrate_influxdb_nice(m_utils, m_sh, mocker):
+    m_utils.ctx_opts.return_value.dry_run = False
+    m_utils.path_exists.return_value = True
+    mocker.patch(TESTED + '._influx_stats').return_value = {}
+    m_nice = mocker.patch(TESTED + '.os.nice')
+
+    migration.migrate_influxdb(['victoria'], '1d', [])
+    assert m_nice.call_count == 0
+    assert '--cpus' not in m_sh.call_args_list[1][0][0]
+
+    m_sh.reset_mock()
+    migration.migrate_influxdb(['victoria'], '1d', [], nice=True)
+    m_nice.assert_called_once_with(migration.NICE_INCREMENT)
+    assert '--cpus=1 --cpu-shares=256 --blkio-weight=100' in m_sh.call_args_list[1][0][0]
+
+
+def test_migrate_influxdb_policies(m_utils, m_sh, mocker):
+    m_utils.ctx_opts.return_value.dry_run = False
+    m_utils.path_exists.return_value = True
+    m_stats = mocker.patch(TESTED + '._influx_stats')
+    m_stats.side_effect = lambda args, container, policy: {
+        's1': migration.InfluxStats(10, 1000, 2000),
+        's2': migration.InfluxStats(10, 1000, 2000),
+    } if policy == 'downsample_1m' else {
+        's1': migration.InfluxStats(100, 1000, 2000),
+    }
+    m_copy = mocker.patch(TESTED + '._copy_influx_measurement')
+    m_shards = mocker.patch(TESTED + '._copy_influx_shards')
+
+    migration.migrate_influxdb(['victoria'], '1d', [], policies=['downsample_1m', 'autogen'], newest_first=True)
+    assert m_stats.call_count == 2
+    assert [c[0][0] for c in m_copy.call_args_list] == ['s1', 's2', 's1']
+    m_copy.assert_called_with('s1', '1d', mocker.ANY, 0, True, mocker.ANY, 1, mocker.ANY,
+                              migration.InfluxStats(100, 1000, 2000), 'autogen', True, mocker.ANY, 'influxdb-migrate')
+
+    migration.migrate_influxdb(['victoria'], '1d', ['s2'], policies=['downsample_1m', 'autogen'])
+    assert any('No data found for services: s2@autogen' in c[0][0] for c in m_utils.info.call_args_list)
+
+    # Policies without data are not scanned
+    migration.migrate_influxdb(['file'], '1d', ['s2'], engine='inspect', policies=['downsample_1m', 'autogen'])
+    m_shards.assert_called_once_with(['s2'], '1d', mocker.ANY, True, mocker.ANY, mocker.ANY,
+                                     'downsample_1m', False, 'influxdb-migrate')
+
+
+def test_migrate_influxdb_interrupted(m_utils, m_sh, mocker):
+    m_utils.ctx_opts.return_value.dry_run = False
+    m_utils.path_exists.return_value = True
+    mocker.patch(TESTED + '._influx_stats').return_value = {
+        's1': migration.InfluxStats(10, 1000, 2000),
+    }
+    mocker.patch(TESTED + '._copy_influx_measurement', side_effect=KeyboardInterrupt)
+
+    migration.migrate_influxdb(['victoria'], '1d', [])
+    assert 'Migration stopped' in m_utils.warn.call_args[0][0]
+    assert 'docker stop influxdb-migrate' in m_sh.call_args[0][0]
+
+
+def test_run_jobs(m_utils, mocker):
+    stop = migration.Event()
+    results = []
+    migration._run_jobs(lambda v: results.append(v), [(1,), (2,), (3,)], 2, stop)
+    assert sorted(results) == [1, 2, 3]
+    assert not stop.is_set()
+
+    # Remaining jobs are done before the error is raised
+    with pytest.raises(ZeroDivisionError):
+        migration._run_jobs(lambda v: results.append(1 / v), [(0,), (4,)], 1, stop)
+    assert results[-1] == 0.25
+
+
+def test_run_jobs_interrupted(m_utils, mocker):
+    stop = migration.Event()
+    started = migration.Event()
+    calls = []
+
+    def job(v):
+        calls.append(v)
+        started.set()
+        stop.wait(5)
+
+    def interrupt(futures):
+        started.wait(5)
+        raise KeyboardInterrupt
+
+    mocker.patch(TESTED + '.wait', side_effect=interrupt)
+
+    with pytest.raises(KeyboardInterrupt):
+        migration._run_jobs(job, [(1,), (2,), (3,)], 1, stop)
+
+    # Jobs that were not started are cancelled
+    assert stop.is_set()
+    assert calls == [1]
+
+
+def test_migrate_influxdb_jobs(m_utils, m_sh, mocker):
+    m_utils.ctx_opts.return_value.dry_run = False
+    m_utils.path_exists.return_value = True
+    mocker.patch(TESTED + '._influx_stats').return_value = {
+        's1': migration.InfluxStats(10, 1000, 2000),
+        's2': migration.InfluxStats(10, 1000, 2000),
+        's3': migration.InfluxStats(10, 1000, 2000),
+    }
+    m_copy = mocker.patch(TESTED + '._copy_influx_measurement')
+
+    migration.migrate_influxdb(['victoria'], '1d', ['s1', 's2', 's3'], [('s2', 100)], jobs=2)
+    assert m_copy.call_count == 3
+    m_copy.assert_any_call('s2', '1d', mocker.ANY, 100, True, mocker.ANY, 1, mocker.ANY, mocker.ANY,
+                           'downsample_1m', False, mocker.ANY, 'influxdb-migrate')
+    assert m_utils.with_ctx.call_count == 3
+
+    # Remaining services are exported before the error is raised
+    m_copy.reset_mock()
+    m_copy.side_effect = [RuntimeError, None, None]
+    with pytest.raises(RuntimeError):
+        migration.migrate_influxdb(['victoria'], '1d', ['s1', 's2', 's3'], jobs=2)
+    assert m_copy.call_count == 3
+
+
+def test_migrate_influxdb_concurrency(m_utils, m_sh, mocker):
+    m_utils.ctx_opts.return_value.dry_run = False
+    m_utils.path_exists.return_value = True
+    mocker.patch(TESTED + '._influx_stats').return_value = {
+        's1': migration.InfluxStats(10, 1000, 2000),
+    }
+    m_copy = mocker.patch(TESTED + '._copy_influx_measurement')
+    m_run = mocker.patch(TESTED + '._run_jobs')
+
+    migration.migrate_influxdb(['victoria'], '1d', [], jobs=4, windows=4)
+    assert m_run.call_args[0][2] == 2
+    assert 'Limiting concurrent queries to 8' in m_utils.warn.call_args[0][0]
+
+    migration.migrate_influxdb(['victoria'], '1d', [], jobs=4, windows=20)
+    assert m_copy.call_args[0][6] == 8
+
+
+def test_migrate_influxdb_inspect(m_utils, m_sh, mocker):
+    m_utils.ctx_opts.return_value.dry_run = False
+    m_utils.path_exists.return_value = True
+    m_copy = mocker.patch(TESTED + '._copy_influx_measurement')
+    m_shards = mocker.patch(TESTED + '._copy_influx_shards')
+    mocker.patch(TESTED + '._influx_stats').return_value = {
+        's1': migration.InfluxStats(10, 1000, 2000),
+        's2': migration.InfluxStats(10, 1000, 2000),
+    }
+
+    migration.migrate_influxdb(['file'], '1d', ['s1', 's2'], engine='inspect')
+    assert m_copy.call_count == 0
+    m_shards.assert_called_once_with(['s1', 's2'], '1d', mocker.ANY, True, mocker.ANY, mocker.ANY,
+                                     'downsample_1m', False, 'influxdb-migrate')
+    assert m_shards.call_args[0][2].name == 'file'
+
+    # Invalid targets are rejected before InfluxDB is started
+    m_sh.reset_mock()
+    with pytest.raises(ValueError):
+        migration.migrate_influxdb('space magic', '1d', ['s1'])
+    assert m_sh.call_count == 0
+
+
+def test_parse_duration():
+    assert migration._parse_duration('30d') == timedelta(days=30)
+    assert migration._parse_duration('1w2d12h') == timedelta(days=9, hours=12)
+    assert migration._parse_duration('1y10m500ms') == timedelta(days=365, minutes=10, milliseconds=500)
+
+    for invalid in ['', 'd', '10', '1d 2h', '1x']:
+        with pytest.raises(ValueError):
+            migration._parse_duration(invalid)
+
+
+def test_influx_shards(m_utils):
+    def stream(cmd):
+        yield 'name,id,database,retention_policy,shard_group,start_time,end_time,expiry_time,owners'
+        yield '_internal,1,_internal,monitor,1,2021-07-12T00:00:00Z,2021-07-13T00:00:00Z,2021-07-20T00:00:00Z,'
+        yield ''
+        yield 'name,id,database,retention_policy,shard_group,start_time,end_time,expiry_time,owners'
+        yield 'brewblox,5,brewblox,downsample_1m,5,2021-07-12T00:00:00Z,2021-07-19T00:00:00Z,2121-07-19T00:00:00Z,'
+        yield 'brewblox,3,brewblox,autogen,3,2021-07-05T00:00:00Z,2021-07-12T00:00:00Z,2021-07-19T00:00:00Z,'
+        yield 'brewblox,4,brewblox,downsample_1m,4,2021-07-05T00:00:00Z,2021-07-12T00:00:00Z,2121-07-12T00:00:00Z,'
+
+    m_utils.sh_stream.side_effect = stream
+    assert migration._influx_shards() == [
+        migration.InfluxShard('4', datetime(2021, 7, 5), datetime(2021, 7, 12)),
+        migration.InfluxShard('5', datetime(2021, 7, 12), datetime(2021, 7, 19)),
+    ]
+    assert migration._influx_shards('autogen') == [
+        migration.InfluxShard('3', datetime(2021, 7, 5), datetime(2021, 7, 12)),
+    ]
+
+
+def test_convert_exported_line():
+    convert = migration._convert_exported_line
+    assert convert('# DML') is None
+    assert convert('# CONTEXT-DATABASE:brewblox') is None
+    assert convert('CREATE DATABASE brewblox WITH NAME autogen') is None
+    assert convert('') is None
+
+    assert convert('sparkey m_k1=1.5 1626096480000000000') == \
+        ('sparkey', 'sparkey k1=1.5 1626096480000000000\n')
+    assert convert('spark\\ key m_k\\ 1=1.5,m_k2=2i,other="a, b=c" 1626096480000000000') == \
+        ('spark key', 'spark\\ key k\\ 1=1.5,k2=2i,other="a, b=c" 1626096480000000000\n')
+    assert convert('spark\\,key,tag=value m_k1=true 1626096480000000000') == \
+        ('spark,key', 'spark\\,key,tag=value k1=true 1626096480000000000\n')
+    assert convert('sparkey m_k1=1.5 1626096480000000000', ',policy=autogen') == \
+        ('sparkey', 'sparkey,policy=autogen k1=1.5 1626096480000000000\n')
+
+
+def inspect_stream(cmd):
+    yield '# DDL'
+    yield 'CREATE DATABASE brewblox WITH NAME autogen'
+    yield '# DML'
+    yield '# CONTEXT-DATABASE:brewblox'
+    yield '# CONTEXT-RETENTION-POLICY:downsample_1m'
+    yield '# writing tsm data'
+    yield 'sparkey m_k1=1 1626096480000000000'
+    yield 'sparkey m_k1=2 1626096480000000001'
+    yield 'sparkey m_k1=3 1626096480000000002'
+    yield 'ignored m_k1=4 1626096480000000000'
+    yield 'sparkey m_k2=5 1626096480000000000'
+    yield 'plaato m_k1=6 1626096480000000000'
+    yield ''
+
+
+def test_inspect_batches(m_utils):
+    m_utils.sh_stream.side_effect = inspect_stream
+    sizer = migration.BatchSizer(2)
+    batches = list(migration._inspect_batches(datetime(2021, 7, 5),
+                                              datetime(2021, 7, 12),
+                                              {'sparkey', 'plaato'},
+                                              sizer))
+    assert [(svc, b.count, b.time) for svc, b in batches] == [
+        ('sparkey', 2, '1626096480000000001'),
+        ('sparkey', 2, '1626096480000000000'),
+        ('plaato', 1, '1626096480000000000'),
+    ]
+    assert batches[0][1].data == 'sparkey k1=1 1626096480000000000\nsparkey k1=2 1626096480000000001\n'
+
+    cmd = m_utils.sh_stream.call_args[0][0]
+    assert '-start 2021-07-05T00:00:00Z -end 2021-07-11T23:59:59.999999999Z' in cmd
+
+
+def test_inspect_batches_empty(m_utils):
+    m_utils.sh_stream.side_effect = lambda cmd: iter(['# DDL', ''])
+    batches = migration._inspect_batches(datetime(2021, 7, 5),
+                                         datetime(2021, 7, 12),
+                                         {'sparkey'},
+                                         migration.BatchSizer())
+    assert list(batches) == []
+
+
+def test_copy_influx_shards(m_utils, m_sh, mocker, tmp_path):
+    m_utils.sh_stream.side_effect = inspect_stream
+    mocker.patch(TESTED + '.FILE_DIR', str(tmp_path))
+    m_shards = mocker.patch(TESTED + '._influx_shards')
+    m_shards.return_value = [
+        migration.InfluxShard('4', datetime(2021, 7, 5), datetime(2021, 7, 12)),
+        migration.InfluxShard('5', datetime(2021, 7, 12), datetime(2021, 7, 19)),
+    ]
+
+    migration._copy_influx_shards(['sparkey', 'plaato'], '', migration.FileSink('today', '', 'none'))
+    assert m_utils.sh_stream.call_count == 2
+    assert (tmp_path / 'sparkey__today__all__001.lines').read_text().count('\n') == 2 * 4
+    assert (tmp_path / 'plaato__today__all__001.lines').read_text().count('\n') == 2 * 1
+    assert migration._read_checkpoint('file', migration.SHARDS_CHECKPOINT) == {
+        'services': ['plaato', 'sparkey'],
+        'duration': '',
+        'shards': ['4', '5'],
+        'lines': 10,
+    }
+
+    # Completed shards are skipped
+    m_utils.sh_stream.reset_mock()
+    m_shards.return_value.append(
+        migration.InfluxShard('6', datetime(2021, 7, 19), datetime(2021, 7, 26)))
+    migration._copy_influx_shards(['plaato', 'sparkey'], '', migration.FileSink('today', ''))
+    assert m_utils.sh_stream.call_count == 1
+    assert migration._read_checkpoint('file', migration.SHARDS_CHECKPOINT)['lines'] == 15
+
+    # Checkpoint does not match services
+    m_utils.sh_stream.reset_mock()
+    migration._copy_influx_shards(['sparkey'], '', migration.FileSink('today', ''))
+    assert m_utils.sh_stream.call_count == 3
+
+    # Not resumed
+    m_utils.sh_stream.reset_mock()
+    migration._copy_influx_shards(['sparkey'], '', migration.FileSink('today', ''), resume=False)
+    assert m_utils.sh_stream.call_count == 3
+
+
+def test_copy_influx_shards_duration(m_utils, m_sh, mocker):
+    m_utils.sh_stream.side_effect = inspect_stream
+    sink = mocker.Mock(spec=migration.VictoriaSink)
+    sink.name = 'victoria'
+    sink.write.return_value = 10
+    now = datetime.utcnow()
+    mocker.patch(TESTED + '._influx_shards').return_value = [
+        migration.InfluxShard('4', now - timedelta(days=14), now - timedelta(days=7)),
+        migration.InfluxShard('5', now - timedelta(days=7), now + timedelta(days=1)),
+    ]
+
+    migration._copy_influx_shards(['sparkey'], '1d', sink)
+    assert m_utils.sh_stream.call_count == 1
+    assert m_sh.call_count == 0
+    assert sink.write.call_count == 1
+    start = (now - timedelta(days=1)).strftime('%Y-%m-%dT%H:%M')
+    assert f'-start {start}' in m_utils.sh_stream.call_args[0][0]
+
+
+def test_copy_influx_shards_policy(m_utils, m_sh, mocker):
+    m_utils.sh_stream.side_effect = inspect_stream
+    sink = mocker.Mock(spec=migration.VictoriaSink)
+    sink.name = 'victoria'
+    sink.write.return_value = 10
+    m_shards = mocker.patch(TESTED + '._influx_shards')
+    m_shards.return_value = [
+        migration.InfluxShard('4', datetime(2021, 7, 5), datetime(2021, 7, 12)),
+        migration.InfluxShard('5', datetime(2021, 7, 12), datetime(2021, 7, 19)),
+    ]
+
+    migration._copy_influx_shards(['sparkey'], '', sink, policy='autogen', newest_first=True)
+    m_shards.assert_called_once_with('autogen', 'influxdb-migrate')
+    cmds = [c[0][0] for c in m_utils.sh_stream.call_args_list]
+    assert '-retention autogen -start 2021-07-12T00:00:00Z' in cmds[0]
+    assert '-retention autogen -start 2021-07-05T00:00:00Z' in cmds[1]
+    assert sink.write.call_args[0][0] == 'sparkey@autogen'
+    assert sink.write.call_args[0][1].startswith('sparkey,policy=autogen k1=1 ')
+    assert 'sparkey,policy=autogen k2=5 ' in sink.write.call_args[0][1]
+    assert migration._read_checkpoint('victoria', '.shards@autogen')['shards'] == ['5', '4']
+    assert migration._read_checkpoint('victoria', migration.SHARDS_CHECKPOINT) is None
+
+
+def test_export_files(mocker, tmp_path):
+    mocker.patch(TESTED + '.FILE_DIR', str(tmp_path))
+    for name in ['b.lines', 'a.lines.gz', 'c.lines.zst', 'a.lines.gz.json', 'd.txt']:
+        (tmp_path / name).write_text('')
+    assert [p.name for p in migration._export_files()] == ['a.lines.gz', 'b.lines', 'c.lines.zst']
+
+
+def test_file_batches(mocker, tmp_path):
+    mocker.patch(TESTED + '.IMPORT_BATCH_BYTES', 20)
+    data = ''.join(f'sparkey k1={v} {v}\n' for v in range(5))
+
+    (tmp_path / 'plain.lines').write_text(data)
+    (tmp_path / 'packed.lines.gz').write_bytes(gzip.compress(data[:30].encode()) + gzip.compress(data[30:].encode()))
+
+    for name in ['plain.lines', 'packed.lines.gz']:
+        batches = list(migration._file_batches(tmp_path / name))
+        assert [count for _, count, _ in batches] == [2, 2, 1]
+        assert ''.join(data for data, _, _ in batches) == data
+
+
+def test_open_export_file_zstd(mocker, tmp_path):
+    m_zstd = mocker.patch(TESTED + '.zstandard')
+    m_reader = m_zstd.ZstdDecompressor.return_value.stream_reader
+    m_reader.side_effect = lambda f, **kwargs: f
+    fname = tmp_path / 'sparkey.lines.zst'
+    fname.write_text('sparkey k1=1 1\n')
+
+    with migration._open_export_file(fname) as f:
+        assert f.read() == 'sparkey k1=1 1\n'
+    assert m_reader.call_args[1] == {'read_across_frames': True}
+
+    mocker.patch(TESTED + '.zstandard', None)
+    with pytest.raises(ValueError):
+        migration._open_export_file(fname)
+
+
+def test_import_influxdb_files(m_utils, m_progress, mocker, tmp_path):
+    mocker.patch(TESTED + '.FILE_DIR', str(tmp_path))
+    m_write = mocker.patch(TESTED + '.VictoriaSink.write', return_value=10)
+    for idx in range(3):
+        (tmp_path / f'sparkey__today__all__00{idx}.lines').write_text('sparkey k1=1 1\n' * (idx + 1))
+
+    # Dry run noop
+    m_utils.ctx_opts.return_value.dry_run = True
+    migration.import_influxdb_files()
+    assert m_write.call_count == 0
+
+    m_utils.ctx_opts.return_value.dry_run = False
+    migration.import_influxdb_files(jobs=2)
+    assert m_write.call_count == 3
+    assert sorted(migration._read_checkpoint('victoria', migration.IMPORT_CHECKPOINT)['files']) == [
+        'sparkey__today__all__000.lines',
+        'sparkey__today__all__001.lines',
+        'sparkey__today__all__002.lines',
+    ]
+    assert 'Processed 6 lines' in m_progress.info.call_args[0][0]
+
+    # Completed files are skipped
+    m_write.reset_mock()
+    migration.import_influxdb_files()
+    assert m_write.call_count == 0
+
+    # Import all files again
+    migration.import_influxdb_files([str(tmp_path / 'sparkey__today__all__001.lines')], resume=False)
+    assert m_write.call_count == 1
+    assert 'lines/s' in m_progress.info.call_args[0][0]
+
+    # Remaining files are imported before the error is raised
+    m_write.reset_mock()
+    m_write.side_effect = [RuntimeError, 10, 10]
+    with pytest.raises(RuntimeError):
+        migration.import_influxdb_files(jobs=2, resume=False)
+    assert m_write.call_count == 3
+
+    # Stopped files are not completed
+    m_write.reset_mock()
+    m_write.side_effect = None
+    stop = migration.Event()
+    stop.set()
+    events = iter([stop])
+    mocker.patch(TESTED + '.Event', side_effect=lambda: next(events, None) or threading.Event())
+    migration._write_checkpoint('victoria', migration.IMPORT_CHECKPOINT, {'files': []})
+    migration.import_influxdb_files()
+    assert m_write.call_count == 3
+    assert migration._read_checkpoint('victoria', migration.IMPORT_CHECKPOINT)['files'] == []
+
+
+def test_export_file_lines(tmp_path):
+    fname = tmp_path / 'sparkey.lines.gz'
+    assert migration._export_file_lines(fname) is None
+
+    (tmp_path / 'sparkey.lines.gz.json').write_text(json.dumps({'lines': 10}))
+    assert migration._export_file_lines(fname) == 10
+
+    (tmp_path / 'sparkey.lines.gz.json').write_text('{')
+    assert migration._export_file_lines(fname) is None
+
+
+def test_last_exported_time(f_checkpoint_dir):
+    stats = migration.InfluxStats(10, 1000, 2000)
+    assert migration._last_exported_time('victoria', 'sparkey', stats) == 2000
+
+    migration._write_checkpoint('victoria', 'sparkey', {'windows': [
+        {'start': None, 'end': 2000, 'time': '1999', 'lines': 5},
+        {'start': 2000, 'end': None, 'time': '2500', 'lines': 5},
+        {'start': 2500, 'end': None, 'time': None, 'lines': 0},
+    ]})
+    assert migration._last_exported_time('victoria', 'sparkey', stats) == 2500
+
+    migration._write_checkpoint('victoria', migration.FOLLOW_CHECKPOINT, {'times': {'sparkey': 3000}})
+    assert migration._last_exported_time('victoria', 'sparkey', stats) == 3000
+    assert migration._last_exported_time('victoria', 'plaato', stats) == 2000
+
+    # Newest-first checkpoints hold the oldest exported time
+    migration._write_checkpoint('victoria', 'plaato', {'order': 'desc', 'windows': [
+        {'start': None, 'end': None, 'time': '2500', 'lines': 5},
+    ]})
+    assert migration._last_exported_time('victoria', 'plaato', stats) == 2000
+
+
+def test_follow_influx(m_utils, m_sh, m_sleep, mocker):
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    m_stats = mocker.patch(TESTED + '._influx_stats')
+    m_stats.return_value = {
+        'sparkey': migration.InfluxStats(12, 1000, 1626096480000000002),
+        'plaato': migration.InfluxStats(1, 1000, 1000),
+    }
+    sink = mocker.Mock(spec=migration.VictoriaSink)
+    sink.name = 'victoria'
+    sink.write.return_value = 10
+    m_sleep.side_effect = [None, KeyboardInterrupt]
+
+    with pytest.raises(KeyboardInterrupt):
+        migration._follow_influx({'sparkey': 1000, 'plaato': 1000, 'unknown': 1000}, sink, 30, 'influx')
+
+    # Only services with new data are queried
+    assert sink.write.call_count == 3
+    assert m_stats.call_args_list[0] == mocker.call('where time > 1000', container='influx', policy='downsample_1m')
+    # Later polls only scan recent points, even if a service is idle
+    recent = int((datetime.now().timestamp() - migration.FOLLOW_MARGIN_S - 10) * 1e9)
+    assert int(m_stats.call_args_list[1][0][0].split(' > ')[1]) > recent
+    assert 'docker exec influx influx' in m_utils.sh_stream.call_args_list[0][0][0]
+    assert 'where time > 1000 ORDER BY' in m_utils.sh_stream.call_args_list[0][0][0]
+    assert m_sleep.call_args[0][0] == 30
+    assert migration._read_checkpoint('victoria', migration.FOLLOW_CHECKPOINT) == {
+        'times': {'sparkey': 1626096480000000003, 'plaato': 1000, 'unknown': 1000}
+    }
+
+    # Nothing to follow
+    m_stats.reset_mock()
+    migration._follow_influx({}, sink)
+    assert m_stats.call_count == 0
+
+
+def test_follow_influx_policies(m_utils, m_sh, m_sleep, mocker):
+    m_utils.sh_stream.side_effect = partial(csv_data_stream, {})
+    m_stats = mocker.patch(TESTED + '._influx_stats')
+    m_stats.side_effect = lambda args, container, policy: {
+        'sparkey': migration.InfluxStats(12, 1000, 1626096480000000002),
+    }
+    sink = mocker.Mock(spec=migration.VictoriaSink)
+    sink.name = 'victoria'
+    sink.write.return_value = 10
+    m_sleep.side_effect = KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        migration._follow_influx({'sparkey@autogen': 1000}, sink, policies=['downsample_1m', 'autogen'])
+
+    assert [c[1]['policy'] for c in m_stats.call_args_list] == ['downsample_1m', 'autogen']
+    assert {c[0][0] for c in sink.write.call_args_list} == {'sparkey@autogen'}
+    assert '"brewblox"."autogen"."sparkey"' in m_utils.sh_stream.call_args_list[0][0][0]
+
+
+def test_migrate_influxdb_follow(m_utils, m_sh, mocker):
+    m_utils.ctx_opts.return_value.dry_run = False
+    m_utils.path_exists.return_value = True
+    mocker.patch(TESTED + '._copy_influx_measurement')
+    mocker.patch(TESTED + '._influx_stats').return_value = {
+        's1': migration.InfluxStats(10, 1000, 2000),
+    }
+    m_follow = mocker.patch(TESTED + '._follow_influx', side_effect=KeyboardInterrupt)
+
+    migration.migrate_influxdb(['victoria'], '1d', [], follow=True, follow_interval=5, container='influx')
+    m_follow.assert_called_once_with({'s1': 2000}, mocker.ANY, 5, 'influx', mocker.ANY, ['downsample_1m'])
+    assert m_utils.info.call_args[0][0] == 'Stopped following'
+
+    # No temporary container is started or stopped
+    assert m_sh.call_count == 1
+    assert 'docker exec influx bash' in m_sh.call_args[0][0]
+
+    # The temporary container does not receive new data
+    with pytest.raises(ValueError):
+        migration.migrate_influxdb(['victoria'], '1d', [], follow=True)
+
+
+def test_influx_buckets(m_utils, m_sh):
+    m_sh.side_effect = None
+    m_sh.return_value = json.dumps({'results': [{'series': [{
+        'name': 'sparkey',
+        'columns': ['time', 'count_m_k1', 'count_m_k2', 'sum_m_k1', 'sum_m_k2'],
+        'values': [
+            [1000, 2, 1, 3.5, True],
+            [2000, 1, None, 1.0, None],
+        ],
+    }]}]})
+
+    assert migration._influx_buckets('sparkey', 1500, '1s') == {
+        1000: {'k1': (2, 3.5), 'k2': (1, True)},
+        2000: {'k1': (1, 1.0)},
+    }
+    assert 'WHERE time >= 1500 GROUP BY time(1s) fill(none)' in m_sh.call_args[0][0]
+    assert '"brewblox"."downsample_1m"."sparkey"' in m_sh.call_args[0][0]
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_victoria_bucket(m_utils):
+    m_utils.host_url.return_value = 'https://localhost'
+    httpretty.register_uri(
+        httpretty.GET,
+        'https://localhost/victoria/api/v1/export',
+        body='\n'.join([
+            json.dumps({'metric': {'__name__': 'spark-one/k1'}, 'values': [1, 2.5], 'timestamps': [1, 2]}),
+            '',
+            json.dumps({'metric': {'__name__': 'spark-one/k 2'}, 'values': [3], 'timestamps': [1]}),
+        ]))
+
+    assert migration._victoria_bucket('spark-one', 1626096480000000000, 1626096540000000000) == {
+        'k1': (2, 3.5),
+        'k 2': (1, 3),
+    }
+    query = httpretty.last_request().querystring
+    assert query['match[]'] == ['{__name__=~"spark\\\\-one/.*",policy=""}']
+    assert query['start'] == ['1626096480.000']
+    assert query['end'] == ['1626096539.999']
+
+    migration._victoria_bucket('sparkey', 1626096480000000000, 1626096540000000000, 'autogen')
+    assert httpretty.last_request().querystring['match[]'] == ['{__name__=~"sparkey/.*",policy="autogen"}']
+
+
+def test_compare_bucket():
+    assert migration._compare_bucket('s1', 0, 10, {'k1': (2, 3.0), 'k2': (1, True)}, {'k1': (2, 3.0000000001)}) == [
+        migration.BucketMismatch('s1', 0, 10, 'k2', 1, 0, True, None),
+    ]
+    assert migration._compare_bucket('s1', 0, 10, {'k1': (2, 3.0)}, {'k1': (2, 4.0), 'k2': (1, 1)}) == [
+        migration.BucketMismatch('s1', 0, 10, 'k1', 2, 2, 3.0, 4.0),
+        migration.BucketMismatch('s1', 0, 10, 'k2', 0, 1, None, 1),
+    ]
+
+
+def test_verify_influxdb(m_utils, m_sh, mocker):
+    day = 24 * 3600 * 10**9
+    m_utils.ctx_opts.return_value.dry_run = False
+    m_utils.ctx_opts.return_value.quiet = False
+    m_utils.path_exists.return_value = True
+    m_stats = mocker.patch(TESTED + '._influx_stats')
+    m_stats.return_value = {
+        's1': migration.InfluxStats(10, day + 1000, 3 * day),
+        's2': migration.InfluxStats(10, day, 2 * day),
+    }
+    m_buckets = mocker.patch(TESTED + '._influx_buckets')
+    m_buckets.side_effect = lambda svc, since, bucket, policy, container: {
+        day: {'k1': (2, 3.0)},
+        2 * day: {'k1': (1, 1.0)},
+    }
+    m_victoria = mocker.patch(TESTED + '._victoria_bucket')
+    m_victoria.side_effect = lambda svc, start, end, policy: \
+        {'k1': (1, 1.0)} if svc == 's1' and start >= 2 * day else {'k1': (2, 3.0)}
+
+    # Dry run noop
+    m_utils.ctx_opts.return_value.dry_run = True
+    assert migration.verify_influxdb() == []
+    assert m_sh.call_count == 0
+
+    # No influx data dir found
+    m_utils.ctx_opts.return_value.dry_run = False
+    m_utils.path_exists.return_value = False
+    assert migration.verify_influxdb() == []
+    assert m_sh.call_count == 0
+
+    m_utils.path_exists.return_value = True
+    mismatches = migration.verify_influxdb('', ['s1', 's3'], '1d', 2)
+    m_buckets.assert_called_once_with('s1', day + 1000, '1d', 'downsample_1m', 'influxdb-migrate')
+    assert sorted(c[0][:3] for c in m_victoria.call_args_list) == [
+        ('s1', day, 2 * day),
+        ('s1', 2 * day, 3 * day),
+    ]
+    assert mismatches == []
+    assert any('No data found for s3' in c[0][0] for c in m_utils.info.call_args_list)
+    assert 'All buckets match' in m_utils.info.call_args[0][0]
+    # Temporary container is started and stopped
+    assert 'docker run' in m_sh.call_args_list[1][0][0]
+    assert 'docker stop' in m_sh.call_args[0][0]
+
+    # Mismatches are listed
+    m_sh.reset_mock()
+    m_victoria.side_effect = lambda svc, start, end, policy: {'k1': (1, 1.0)}
+    mismatches = migration.verify_influxdb('', [], '1d', 2, 'influx', ['autogen'])
+    assert mismatches == [
+        migration.BucketMismatch('s1@autogen', day, 2 * day, 'k1', 2, 1, 3.0, 1.0),
+        migration.BucketMismatch('s2@autogen', day, 2 * day, 'k1', 2, 1, 3.0, 1.0),
+    ]
+    assert m_sh.call_count == 1
+    assert 'docker exec influx bash' in m_sh.call_args[0][0]
+    assert '2 mismatched fields in 2 buckets' in m_utils.warn.call_args[0][0]
+    assert any('s1@autogen: 3 values in InfluxDB, 2 values in Victoria' in c[0][0]
+               for c in m_utils.info.call_args_list)
+
+    # Quiet mode prints JSON events
+    m_utils.ctx_opts.return_value.quiet = True
+    m_echo = mocker.patch(TESTED + '.click.echo')
+    migration.verify_influxdb('1d', ['s2'], '1d', 1, 'influx')
+    since = m_buckets.call_args[0][1]
+    assert since > day
+    assert since % 10**6 == 0
+    assert json.loads(m_echo.call_args[0][0]) == {
+        'event': 'mismatch',
+        'service': 's2',
+        'start': since,
+        'end': 2 * day,
+        'field': 'k1',
+        'influx_count': 2,
+        'influx_sum': 3.0,
+        'victoria_count': 1,
+        'victoria_sum': 1.0,
+    }
@@ -0,0 +1,122 @@
+"""
+Tests brewblox_ctl_lib.progress
+"""
+
+import json
+
+import pytest
+from brewblox_ctl_lib import progress
+
+TESTED = progress.__name__
+
+
+@pytest.fixture
+def m_utils(mocker):
+    m = mocker.patch(TESTED + '.utils')
+    m.ctx_opts.return_value.quiet = False
+    return m
+
+
+@pytest.fixture
+def m_monotonic(mocker):
+    m = mocker.patch(TESTED + '.monotonic')
+    m.return_value = 1000
+    return m
+
+
+@pytest.fixture
+def m_echo(mocker):
+    return mocker.patch(TESTED + '.click.echo')
+
+
+def test_format_duration():
+    assert progress.format_duration(None) == '?'
+    assert progress.format_duration(12.5) == '12s'
+    assert progress.format_duration(125) == '2m05s'
+    assert progress.format_duration(3 * 3600 + 65) == '3h01m'
+
+
+def test_rolling_rate(m_monotonic):
+    rate = progress.RollingRate(window_s=10)
+    m_monotonic.return_value = 1010
+    rate.add(100, 1000)
+    assert rate.rates() == (10, 100)
+
+    # Old samples are dropped
+    m_monotonic.return_value = 1020
+    rate.add(200, 1000)
+    m_monotonic.return_value = 1030
+    rate.add(100, 1000)
+    assert rate.lines == 400
+    assert rate.rates() == (300 / 20, 2000 / 20)
+
+
+def test_progress(m_utils, m_monotonic):
+    prog = progress.Progress()
+    prog.add('sparkey', 1000, 100)
+    prog.add('plaato')
+    assert m_utils.info.call_args_list[0][0][0] == 'sparkey: started (100/1000 lines)'
+    assert m_utils.info.call_args_list[1][0][0] == 'plaato: started (0/? lines)'
+
+    m_monotonic.return_value = 1010
+    prog.update('sparkey', 300, 3000, 1000, 5000, query=1, convert=1, upload=2, custom=4)
+    msg = m_utils.info.call_args[0][0]
+    assert msg.startswith('sparkey: 400/1000 lines | batch size 5000 | 30 lines/s')
+    assert '0.0/0.0 MB written' in msg
+    assert 'ETA 20s (all: ?)' in msg
+    assert msg.endswith('query 12% convert 12% upload 25% custom 50%')
+
+    prog.done('sparkey')
+    prog.done('unknown')
+    assert m_utils.info.call_args_list[-2][0][0] == 'sparkey: done (400 lines)'
+    assert m_utils.info.call_args_list[-1][0][0] == 'unknown: done (0 lines)'
+
+    m_monotonic.return_value = 1020
+    prog.summary()
+    assert m_utils.info.call_args[0][0] == \
+        'Processed 300 lines in 20s | 15 lines/s | 0.0/0.0 MB written | query 12% convert 12% upload 25% custom 50%'
+
+
+def test_progress_overall_eta(m_utils, m_monotonic):
+    prog = progress.Progress()
+    prog.add('sparkey', 1000)
+    prog.plan('plaato', 500)
+    assert m_utils.info.call_count == 1
+
+    m_monotonic.return_value = 1010
+    prog.update('sparkey', 100)
+    assert m_utils.info.call_args[0][0].endswith('MB written | ETA 1m30s (all: 2m20s)')
+
+    # Unregistered tasks have no total
+    prog.update('extra', 100)
+    assert 'ETA ? (all: ?)' in m_utils.info.call_args[0][0]
+
+
+def test_progress_quiet(m_utils, m_monotonic, m_echo):
+    m_utils.ctx_opts.return_value.quiet = True
+    prog = progress.Progress()
+    prog.add('sparkey', 1000)
+
+    m_monotonic.return_value = 1010
+    prog.update('sparkey', 100, 2000, batch_size=500, upload=1)
+    prog.done('sparkey')
+    prog.summary()
+
+    assert m_utils.info.call_count == 0
+    events = [json.loads(c[0][0]) for c in m_echo.call_args_list]
+    assert [e['event'] for e in events] == ['start', 'progress', 'done', 'summary']
+    assert events[1] == {
+        'event': 'progress',
+        'task': 'sparkey',
+        'done': 100,
+        'total': 1000,
+        'batch_size': 500,
+        'lines_per_sec': 10,
+        'bytes_per_sec': 200,
+        'raw_bytes': 2000,
+        'written_bytes': 2000,
+        'eta_s': 90,
+        'overall_eta_s': 90,
+        'stages': {'upload': 1},
+    }
+    assert events[3]['done'] == 100
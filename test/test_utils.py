@@ -3,6 +3,7 @@ Tests brewblox_ctl_lib.utils
 """
 
 import json
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import call
 
 import click
@@ -147,6 +148,23 @@ def test_sh_stream_empty(mocker):
     assert list(utils.sh_stream('cmd')) == []
 
 
+def test_with_ctx():
+    def current():
+        return click.get_current_context(silent=True)
+
+    # No context active -> function is called as-is
+    assert utils.with_ctx(current)() is None
+
+    ctx = click.Context(click.Command('cmd'))
+    with ctx:
+        wrapped = utils.with_ctx(current)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(current).result() is None
+        assert executor.submit(wrapped).result() is ctx
+        assert executor.submit(current).result() is None
+
+
 def test_pip_install(mocker, m_getenv, m_sh):
     mocker.patch(TESTED + '.Path')
     mocker.patch(TESTED + '.const.PY', '/PY')